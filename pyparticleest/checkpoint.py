@@ -0,0 +1,223 @@
+"""
+Checkpoints of running particle filters
+
+A checkpoint is a directory containing
+ - 'checkpoint.json': format version, the construction arguments of the
+   ParticleTrajectory, the time index counters, the log-likelihood estimate
+   and the state of the random number generator of the filter
+ - 'part.npy', 'w.npy', 'ancestors.npy', 'w_offset.npy': (T, N, ...),
+   (T, N), (T, N) and (T,) arrays of the stored time steps
+ - 'head.npy': the particles of the latest time step in the precision used
+   for the computations
+ - 'u.npy', 'y.npy', 't.npy', 'ymask.npy': the inputs, measurements, time
+   stamps and measurement mask
+ - 'fixed_lag_est.npy': the fixed-lag estimate, if available
+
+Since the arrays are stored as .npy files they can be memory mapped when
+restoring the filter, with array storage only the pages that are accessed
+are then read from the disk.
+
+Example:
+    pt.save('/var/lib/tracker/checkpoint')
+    ...
+    pt = ParticleTrajectory.load('/var/lib/tracker/checkpoint', model)
+    pt.forward(u, y)
+
+@author: Jerker Nordh
+"""
+
+import json
+import os
+import numpy
+from pyparticleest.filter import ParticleTrajectory, ParticleApproximation, \
+    TrajectoryStep
+from pyparticleest.utils.rng import get_state, from_state
+
+FORMAT_VERSION = 1
+
+
+def _save_rows(fname, traj, get, dtype):
+    """
+    Write get(step) for all the steps in traj as one array, one row at a
+    time so the data doesn't have to fit in memory
+    """
+    first = numpy.asarray(get(traj[0]))
+    out = numpy.lib.format.open_memmap(fname, mode='w+', dtype=dtype,
+                                       shape=(len(traj),) + first.shape)
+    for t in range(len(traj)):
+        out[t] = get(traj[t])
+    out.flush()
+    del out
+
+
+def _ancestors(step):
+    if (step.ancestors is None):
+        return numpy.arange(len(step.pa.part), dtype=int)
+    return step.ancestors
+
+
+def save(pt, path):
+    """
+    Save a checkpoint of a ParticleTrajectory. Requires the particles to be
+    represented as a numeric numpy array and a constant number of
+    particles.
+
+    The random number generator of the model is not part of the checkpoint.
+
+    Args:
+     - pt (ParticleTrajectory): the filter to save
+     - path (string): directory to write the checkpoint to, created if it
+       doesn't exist
+    """
+    traj = pt.traj
+    if (len(traj) == 0):
+        raise ValueError('Can not save an empty trajectory')
+    head = numpy.asarray(traj[-1].pa.part)
+    if (head.dtype == object):
+        raise ValueError('Checkpoints require the particles to be stored in a numeric array')
+    if (isinstance(traj, list)):
+        if (any(len(step.pa.part) != len(head) for step in traj)):
+            raise ValueError('Checkpoints require a constant number of particles')
+    if (not os.path.isdir(path)):
+        os.makedirs(path)
+
+    if (isinstance(traj, list) or hasattr(traj, 'readahead')):
+        # Copy one time step at a time
+        dtype = numpy.asarray(traj[0].pa.part).dtype
+        _save_rows(os.path.join(path, 'part.npy'), traj,
+                   lambda step: step.pa.part, dtype)
+        _save_rows(os.path.join(path, 'w.npy'), traj, lambda step: step.pa.w,
+                   float)
+        _save_rows(os.path.join(path, 'ancestors.npy'), traj, _ancestors,
+                   numpy.asarray(_ancestors(traj[0])).dtype)
+        w_offset = numpy.asarray([step.pa.w_offset for step in traj], dtype=float)
+    else:
+        numpy.save(os.path.join(path, 'part.npy'), traj.part)
+        numpy.save(os.path.join(path, 'w.npy'), traj.w)
+        numpy.save(os.path.join(path, 'ancestors.npy'), traj.ancestors)
+        w_offset = traj.w_offset
+    numpy.save(os.path.join(path, 'w_offset.npy'), w_offset)
+    numpy.save(os.path.join(path, 'head.npy'), head)
+
+    n = pt.ind + 1
+    for (name, arr) in (('u', pt.uvec), ('y', pt.yvec), ('t', pt.tvec),
+                        ('ymask', pt.ymask)):
+        # Inputs and measurements stored as objects require pickling
+        numpy.save(os.path.join(path, name + '.npy'), arr[:n],
+                   allow_pickle=(arr.dtype == object))
+    if (pt.fixed_lag_est is not None):
+        numpy.save(os.path.join(path, 'fixed_lag_est.npy'), pt.fixed_lag_est)
+
+    storage_options = None
+    if (pt.storage_options is not None):
+        # The files of a memory mapped storage belong to the saved filter
+        storage_options = dict((key, val) for (key, val) in pt.storage_options.items()
+                               if key != 'path')
+    resampler = pt.resampler
+    if (resampler is not None and not isinstance(resampler, str)):
+        resampler = None
+    fixed_lag_t = pt.fixed_lag_t
+    if (fixed_lag_t is not None):
+        fixed_lag_t = int(fixed_lag_t)
+    meta = {'version': FORMAT_VERSION,
+            'filter': pt.filter_type,
+            'N': int(pt.N),
+            'resample': float(pt.res),
+            'resampler': resampler,
+            'storage': pt.storage,
+            'storage_options': storage_options,
+            'max_lag': pt.max_lag,
+            'lag_smoother': pt.lag_smoother,
+            'lag_options': pt.lag_options,
+            'precision': pt.precision,
+            'ind': int(pt.ind),
+            'offset': int(pt.offset),
+            'logp_y': float(pt.logp_y),
+            'fixed_lag_t': fixed_lag_t,
+            'rng': get_state(pt.pf.rng)}
+    with open(os.path.join(path, 'checkpoint.json'), 'w') as f:
+        json.dump(meta, f)
+
+
+def load(path, model, filter_options=None, resampler=None, rng=None,
+         storage=None, storage_options=None, mmap=True):
+    """
+    Restore a ParticleTrajectory saved with 'save'
+
+    Args:
+     - path (string): directory containing the checkpoint
+     - model (ParticleFiltering): object describing the model specifics
+     - filter_options (dictionary): options passed to the filter, required
+       e.g. for the conditional particle filters (see ParticleTrajectory)
+     - resampler (string/callable): resampling algorithm, defaults to the
+       saved one. Functions are not saved and must be given again.
+     - rng: random number generator for the filter, defaults to a
+       generator restored from the saved state
+     - storage (string): how to store the time steps, defaults to the
+       saved storage type
+     - storage_options (dict): options for the storage, defaults to the
+       saved options
+     - mmap (bool): memory map the arrays instead of reading them. With
+       'array' storage the memory mapped arrays are used directly (copy on
+       write, the checkpoint is never modified) until the storage grows.
+
+    Returns:
+     (ParticleTrajectory) the restored filter
+    """
+    with open(os.path.join(path, 'checkpoint.json'), 'r') as f:
+        meta = json.load(f)
+    if (meta.get('version', None) != FORMAT_VERSION):
+        raise ValueError('Unsupported checkpoint version: %s' % meta.get('version', None))
+
+    if (rng is None and meta['rng'] is not None):
+        rng = from_state(meta['rng'])
+    if (resampler is None):
+        resampler = meta['resampler']
+    if (storage is None):
+        storage = meta['storage']
+        if (storage_options is None):
+            storage_options = meta['storage_options']
+
+    pt = ParticleTrajectory(model, meta['N'], resample=meta['resample'],
+                            filter=meta['filter'], filter_options=filter_options,
+                            resampler=resampler, storage=storage,
+                            max_lag=meta['max_lag'],
+                            lag_smoother=meta.get('lag_smoother', 'ancestor'),
+                            lag_options=meta.get('lag_options', None), rng=rng,
+                            precision=meta['precision'],
+                            storage_options=storage_options)
+
+    mmap_mode = None
+    if (mmap):
+        mmap_mode = 'c'
+    arrays = dict((name, numpy.load(os.path.join(path, name + '.npy'),
+                                    mmap_mode=mmap_mode))
+                  for name in ('part', 'w', 'ancestors', 'w_offset'))
+    head = numpy.load(os.path.join(path, 'head.npy'))
+
+    T = len(arrays['part'])
+    pa = ParticleApproximation(head, arrays['w'][T - 1])
+    pa.w_offset = float(arrays['w_offset'][T - 1])
+    head = TrajectoryStep(pa, numpy.array(arrays['ancestors'][T - 1]))
+    if (isinstance(pt.traj, list)):
+        for t in range(T - 1):
+            pa = ParticleApproximation(arrays['part'][t], arrays['w'][t])
+            pa.w_offset = float(arrays['w_offset'][t])
+            pt.traj.append(TrajectoryStep(pa, numpy.array(arrays['ancestors'][t])))
+        pt.traj.append(head)
+    else:
+        pt.traj.attach(arrays['part'], arrays['w'], arrays['ancestors'],
+                       arrays['w_offset'], head)
+
+    pt.uvec = numpy.load(os.path.join(path, 'u.npy'), allow_pickle=True)
+    pt.yvec = numpy.load(os.path.join(path, 'y.npy'), allow_pickle=True)
+    pt.tvec = numpy.load(os.path.join(path, 't.npy'))
+    pt.ymask = numpy.load(os.path.join(path, 'ymask.npy'))
+    pt.T = len(pt.tvec)
+    pt.ind = meta['ind']
+    pt.offset = meta['offset']
+    pt.logp_y = meta['logp_y']
+    pt.fixed_lag_t = meta['fixed_lag_t']
+    if (pt.fixed_lag_t is not None):
+        pt.fixed_lag_est = numpy.load(os.path.join(path, 'fixed_lag_est.npy'))
+    return pt
@@ -6,8 +6,12 @@
 import numpy
 import math
 import copy
+from pyparticleest.utils.resample import systematic, systematic_segmented, \
+    get_resampler, AliasTable
+from pyparticleest.utils.rng import get_rng
+import pyparticleest.interfaces as interfaces
 
-def sample(w, n):
+def sample(w, n, rng=None):
     """
     Return n random indices, where the probability if index
     is given by w[i].
@@ -15,12 +19,133 @@ def sample(w, n):
     Args:
     - w (array_like): probability weights
     - n (int):  number of indices to sample
+    - rng: random number generator, defaults to numpy.random. See
+      pyparticleest.utils.rng
     """
 
-    wc = numpy.cumsum(w)
-    wc /= wc[-1] # Normalize
-    u = (range(n) + numpy.random.rand(1)) / n
-    return numpy.searchsorted(wc, u)
+    return systematic(w, n, rng)
+
+def to_working_precision(part):
+    """
+    Return the particles in the precision used for the computations,
+    particles stored in single precision (see the 'precision' argument of
+    ParticleTrajectory) are converted to double precision before they are
+    passed to the model.
+
+    Args:
+     - part (array-like): particles
+
+    Returns:
+     (array-like) part, or a double precision copy of it
+    """
+    if (isinstance(part, numpy.ndarray) and part.dtype == numpy.float32):
+        return part.astype(numpy.float64)
+    return part
+
+def _compact_step(step):
+    """
+    Convert a TrajectoryStep to the single precision storage format, float32
+    particles and int32 ancestral indices
+    """
+    part = step.pa.part
+    if (isinstance(part, numpy.ndarray) and part.dtype == numpy.float64):
+        step.pa.part = part.astype(numpy.float32)
+    if (step.ancestors is not None):
+        step.ancestors = numpy.asarray(step.ancestors, dtype=numpy.int32)
+
+def has_measurement(y):
+    """
+    Check if a measurement is available. Missing measurements are represented
+    by None, or by NaN when stored in a numeric buffer.
+
+    Args:
+     - y (array-like): measurement
+
+    Returns:
+     (bool) False if the measurement is missing
+    """
+    if (y is None):
+        return False
+    try:
+        return not numpy.all(numpy.isnan(y))
+    except TypeError:
+        return True
+
+def logsumexp(w):
+    """
+    Compute log(sum(exp(w))) without overflow
+
+    Args:
+     - w (array-like): log-weights
+
+    Returns:
+     (float)
+    """
+    m = numpy.max(w)
+    if (not numpy.isfinite(m)):
+        return m
+    return m + math.log(numpy.sum(numpy.exp(w - m)))
+
+def _same_method(cls, name, base):
+    """
+    Check if cls uses the implementation of method 'name' from class base
+    """
+    method = getattr(cls, name, None)
+    default = getattr(base, name)
+    return getattr(method, '__func__', method) is getattr(default, '__func__', default)
+
+def _has_particle_bounds(model):
+    """
+    Check if the model provides its own per-particle bounds for the rejection
+    sampling smoothers (logp_xnext_max_full_particles or, for FFBSiRS models,
+    logp_xnext_max_particles) instead of the default implementations which
+    repeat the scalar bound of logp_xnext_max_full
+
+    Args:
+     - model: object describing the model
+
+    Returns:
+     (bool)
+    """
+    cls = type(model)
+    name = 'logp_xnext_max_full_particles'
+    if (getattr(cls, name, None) is None or
+        _same_method(cls, name, interfaces.FFBSiRSNonMarkov)):
+        return False
+    if (_same_method(cls, name, interfaces.FFBSiRS)):
+        return not _same_method(cls, 'logp_xnext_max_particles', interfaces.FFBSiRS)
+    return True
+
+def _grow_buffer(buf, T):
+    """
+    Reallocate buf to length T, keeping the existing data
+    """
+    new = numpy.empty((T,) + buf.shape[1:], dtype=buf.dtype)
+    new[:len(buf)] = buf
+    return new
+
+def _store_value(buf, ind, val):
+    """
+    Store val at index ind of the data buffer buf. For numeric buffers the
+    shape of the elements is determined by the first non-scalar value stored,
+    missing values (None) are stored as NaN.
+
+    Returns:
+     (array-like) buf, reallocated if the element shape had to be changed
+    """
+    if (buf.dtype == object):
+        buf[ind] = val
+        return buf
+    if (val is None):
+        buf[ind] = numpy.nan
+        return buf
+    val = numpy.asarray(val)
+    if (buf.ndim == 1 and val.ndim > 0):
+        new = numpy.empty(buf.shape + val.shape, dtype=buf.dtype)
+        new[:] = buf.reshape(buf.shape + (1,) * val.ndim)
+        buf = new
+    buf[ind] = val
+    return buf
 
 
 class ParticleFilter(object):
@@ -33,12 +158,26 @@ class ParticleFilter(object):
      - model (ParticleFiltering): object describing the model to be used
      - res (float): 0 .. 1 , the ratio of effective number of particles that
        triggers resampling. 0 disables resampling
+     - resampler (string/callable): resampling algorithm, see
+       pyparticleest.utils.resample (default is systematic resampling)
+     - adaptive (callable): if not None the number of particles is adapted
+       at each time step, f(pa) should return the number of particles to
+       use. See pyparticleest.utils.adaptive
+     - rng: random number generator used by the filter, defaults to
+       numpy.random
+     - resample_order (callable): f(part) returning the order in which the
+       particles are passed to the resampler, see ParticleApproximation.resample
     """
 
-    def __init__(self, model, res=0):
+    def __init__(self, model, res=0, resampler=None, adaptive=None, rng=None,
+                 resample_order=None):
 
         self.res = res
         self.model = model
+        self.rng = get_rng(rng)
+        self.resampler = get_resampler(resampler, self.rng)
+        self.adaptive = adaptive
+        self.resample_order = resample_order
 
 
     def create_initial_estimate(self, N):
@@ -54,6 +193,21 @@ class ParticleFilter(object):
         """
         return self.model.create_initial_estimate(N)
 
+    def calc_next_N(self, pa):
+        """
+        Determine the number of particles to use for the next time step
+
+        Args:
+         - pa (ParticleApproximation): the current particle approximation
+
+        Returns:
+         (int) number of particles, pa.num unless using an adaptive
+         number of particles
+        """
+        if (self.adaptive is None):
+            return pa.num
+        return int(self.adaptive(pa))
+
     def forward(self, traj, yvec, uvec, tvec, cur_ind):
         """
         Forward the estimate stored in traj from t to t+1 using the motion model
@@ -75,9 +229,13 @@ class ParticleFilter(object):
         pa = ParticleApproximation(traj[-1].pa.part, traj[-1].pa.w)
 
         resampled = False
-        if (self.res > 0 and pa.calc_Neff() < self.res * pa.num):
+        N = self.calc_next_N(pa)
+        if ((self.res > 0 and pa.calc_Neff() < self.res * pa.num) or
+            N != pa.num):
             # Store the ancestor of each resampled particle
-            ancestors = pa.resample(self.model, pa.num)
+            ancestors = pa.resample(self.model, N,
+                                    resampler=self.resampler,
+                                    order=self.resample_order)
             resampled = True
         else:
             ancestors = numpy.arange(pa.num, dtype=int)
@@ -87,7 +245,7 @@ class ParticleFilter(object):
                          uvec=uvec, yvec=yvec,
                          tvec=tvec, cur_ind=cur_ind,
                          pa=pa, inplace=True,)
-        if (yvec is not None):
+        if (yvec is not None and has_measurement(yvec[cur_ind + 1])):
             pa = self.measure(traj=traj, ancestors=ancestors, pa=pa,
                               #There is no 'u' for last step yet
                               uvec=uvec, yvec=yvec, tvec=tvec, cur_ind=cur_ind + 1)
@@ -180,12 +338,22 @@ class SIR(object):
      - model (ParticleFiltering): object describing the model to be used
      - res (float): 0 .. 1 , the ratio of effective number of particles that
        triggers resampling. 0 disables resampling
+     - resampler (string/callable): resampling algorithm, see
+       pyparticleest.utils.resample (default is systematic resampling)
+     - rng: random number generator used by the filter, defaults to
+       numpy.random
+     - resample_order (callable): f(part) returning the order in which the
+       particles are passed to the resampler, see ParticleApproximation.resample
     """
 
-    def __init__(self, model, res=0):
+    def __init__(self, model, res=0, resampler=None, rng=None,
+                 resample_order=None):
 
         self.res = res
         self.model = model
+        self.rng = get_rng(rng)
+        self.resampler = get_resampler(resampler, self.rng)
+        self.resample_order = resample_order
 
 
     def create_initial_estimate(self, N):
@@ -224,7 +392,9 @@ class SIR(object):
         resampled = False
         if (self.res > 0 and pa.calc_Neff() < self.res * pa.num):
             # Store the ancestor of each resampled particle
-            ancestors = pa.resample(self.model, pa.num)
+            ancestors = pa.resample(self.model, pa.num,
+                                    resampler=self.resampler,
+                                    order=self.resample_order)
             resampled = True
         else:
             ancestors = numpy.arange(pa.num, dtype=int)
@@ -326,10 +496,24 @@ class SIR(object):
         return pa
 
 class CSIRAS(SIR):
-    def __init__(self, model, cond_traj):
+    def __init__(self, model, cond_traj, resampler=None, rng=None):
 
         self.ctraj = cond_traj
         self.model = model
+        self.rng = get_rng(rng)
+        self.resampler = get_resampler(resampler, self.rng)
+
+    def set_cond_traj(self, cond_traj):
+        """
+        Replace the trajectory the filter is conditioned on. The trajectory
+        is copied into storage owned by the filter, which is reused for
+        subsequent calls, so the filter can be rerun without being recreated.
+        Requires the particles to be represented as a numpy array.
+
+        Args:
+         - cond_traj (array-like): sequence of TrajectorySteps
+        """
+        self.ctraj = _store_cond_traj(cond_traj, self.ctraj)
 
     def forward(self, traj, yvec, uvec, tvec, cur_ind):
         """
@@ -350,13 +534,12 @@ class CSIRAS(SIR):
         """
         N = len(traj[-1].pa.part)
         ancestors = numpy.empty((N,), dtype=int)
-        tmp = numpy.exp(traj[-1].pa.w)
-        tmp /= numpy.sum(tmp)
-        ancestors[:-1] = sample(tmp, N - 1)
+        tmp = traj[-1].pa.get_normalized_weights()
+        ancestors[:-1] = self.resampler(tmp, N - 1)
 
         #select ancestor for conditional trajectory
-        pind = numpy.asarray(range(N), dtype=numpy.int)
-        find = numpy.zeros((N,), dtype=numpy.int)
+        pind = numpy.asarray(range(N), dtype=int)
+        find = numpy.zeros((N,), dtype=int)
 
         wtrans = self.model.logp_xnext(particles=traj[cur_ind].pa.part,
                                        next_part=self.ctraj[cur_ind + 1].pa.part[find],
@@ -366,11 +549,12 @@ class CSIRAS(SIR):
         wanc -= numpy.max(wanc)
         tmp = numpy.exp(wanc)
         tmp /= numpy.sum(tmp)
-        condind = sample(tmp, 1)
+        condind = sample(tmp, 1, self.rng)
         ancestors[-1] = condind
 
         pa = ParticleApproximation(self.model.copy_ind(traj[-1].pa.part,
                                                        ancestors))
+        pa.w_offset = traj[-1].pa.get_log_normalizer() - math.log(N)
 
         pnext = self.model.qsample(particles=pa.part, u=uvec[cur_ind],
                                    y=yvec[cur_ind + 1], t=tvec[cur_ind])
@@ -404,13 +588,23 @@ class FFPropY(object):
      - model (ParticleFiltering): object describing the model to be used
      - res (float): 0 .. 1 , the ratio of effective number of particles that
        triggers resampling. 0 disables resampling
+     - resampler (string/callable): resampling algorithm, see
+       pyparticleest.utils.resample (default is systematic resampling)
+     - rng: random number generator used by the filter, defaults to
+       numpy.random
+     - resample_order (callable): f(part) returning the order in which the
+       particles are passed to the resampler, see ParticleApproximation.resample
     """
 
-    def __init__(self, model, N, res=0):
+    def __init__(self, model, N, res=0, resampler=None, rng=None,
+                 resample_order=None):
 
         self.res = res
         self.model = model
         self.N = N
+        self.rng = get_rng(rng)
+        self.resampler = get_resampler(resampler, self.rng)
+        self.resample_order = resample_order
 
     def create_initial_estimate(self, N):
         """
@@ -450,7 +644,9 @@ class FFPropY(object):
         resampled = False
         if (self.res > 0 and pa.calc_Neff() < self.res * pa.num):
             # Store the ancestor of each resampled particle
-            ancestors = pa.resample(self.model, pa.num)
+            ancestors = pa.resample(self.model, pa.num,
+                                    resampler=self.resampler,
+                                    order=self.resample_order)
             resampled = True
         else:
             ancestors = numpy.arange(pa.num, dtype=int)
@@ -504,6 +700,29 @@ class FFPropY(object):
         pa = ParticleApproximation(part)
         return pa
 
+def _store_cond_traj(cond_traj, store):
+    """
+    Copy the conditional trajectory into store (an ArrayTrajectory), the
+    arrays of store are reused if it has enough capacity. A new store is
+    created if store is not an ArrayTrajectory.
+
+    Args:
+     - cond_traj (array-like): sequence of TrajectorySteps
+     - store (ArrayTrajectory): storage to reuse
+
+    Returns:
+     (ArrayTrajectory) the storage containing the conditional trajectory
+    """
+    from pyparticleest.storage import ArrayTrajectory
+    if (cond_traj is store):
+        return store
+    if (not isinstance(store, ArrayTrajectory)):
+        store = ArrayTrajectory(len(cond_traj))
+    store.clear()
+    for step in cond_traj:
+        store.append(step)
+    return store
+
 class CPF(ParticleFilter):
     """
     Particle Filter class, creates filter estimates by calling appropriate
@@ -516,10 +735,26 @@ class CPF(ParticleFilter):
        triggers resampling. 0 disables resampling
     """
 
-    def __init__(self, model, cond_traj):
+    def __init__(self, model, cond_traj, resampler=None, rng=None):
 
         self.ctraj = cond_traj
         self.model = model
+        self.rng = get_rng(rng)
+        self.resampler = get_resampler(resampler, self.rng)
+        # Future indices for the ancestor sampling in CPFAS, reused
+        self._find = None
+
+    def set_cond_traj(self, cond_traj):
+        """
+        Replace the trajectory the filter is conditioned on. The trajectory
+        is copied into storage owned by the filter, which is reused for
+        subsequent calls, so the filter can be rerun without being recreated.
+        Requires the particles to be represented as a numpy array.
+
+        Args:
+         - cond_traj (array-like): sequence of TrajectorySteps
+        """
+        self.ctraj = _store_cond_traj(cond_traj, self.ctraj)
 
     def create_initial_estimate(self, N):
         """
@@ -554,28 +789,76 @@ class CPF(ParticleFilter):
          - ancestors (array-like): anecstral indices for particles at time t+1
         """
         N = len(traj[cur_ind].pa.part)
-        ancestors = numpy.empty((N,), dtype=int)
-        tmp = numpy.exp(traj[-1].pa.w)
-        tmp /= numpy.sum(tmp)
-        ancestors[:-1] = sample(tmp, N - 1)
+        step = self._next_step(traj)
+        ancestors = step.ancestors
+        tmp = traj[-1].pa.get_normalized_weights()
+        ancestors[:-1] = self.resampler(tmp, N - 1)
 
         ancestors[-1] = N - 1 #condind
 
-        pa = ParticleApproximation(self.model.copy_ind(traj[-1].pa.part,
-                                                       ancestors))
+        pa = self._propagate(traj=traj, step=step, uvec=uvec, yvec=yvec,
+                             tvec=tvec, cur_ind=cur_ind)
+        resampled = True
+        return (pa, resampled, ancestors)
 
+    def _next_step(self, traj):
+        """
+        Get the step object the next time step is written into. When traj
+        is an ArrayTrajectory this is the next row of its arrays (see
+        ArrayTrajectory.next_step), so running the filter doesn't allocate
+        any new particle, weight or ancestor arrays. Otherwise a new
+        TrajectoryStep is created, its particles are allocated by _propagate.
 
-        resampled = True
+        Args:
+         - traj (array-like): approximation for time 0:t
+
+        Returns:
+         (TrajectoryStep) step whose ancestors can be written to
+        """
+        step = None
+        if (hasattr(traj, 'next_step')):
+            step = traj.next_step()
+        if (step is None):
+            N = len(traj[-1].pa.part)
+            step = TrajectoryStep(None, ancestors=numpy.empty((N,), dtype=int))
+        return step
+
+    def _propagate(self, traj, step, uvec, yvec, tvec, cur_ind):
+        """
+        Propagate the particles selected by step.ancestors to time t+1,
+        replacing the last one with the conditional trajectory, and weight
+        them using the measurement at time t+1
+
+        Args:
+         - traj (array-like): approximation for time 0:t
+         - step (TrajectoryStep): from _next_step, with the ancestors set
+         - uvec (array-like): input signals
+         - yvec (array-like): measurements
+         - tvec (array-like): time stamps
+         - cur_ind (int): index of current time-step in (uvec, uvec, tvec)
+
+        Returns:
+         (ParticleApproximation) approximation for time t+1
+        """
+        ancestors = step.ancestors
+        pa = step.pa
+        if (pa is None):
+            pa = ParticleApproximation(self.model.copy_ind(traj[-1].pa.part,
+                                                           ancestors))
+        else:
+            numpy.take(traj[-1].pa.part, ancestors, axis=0, out=pa.part)
+            pa.w[:] = -math.log(len(ancestors))
+            pa.invalidate_weights()
+        pa.w_offset = traj[-1].pa.get_log_normalizer()
 
         pa = self.update(traj=traj, ancestors=ancestors, uvec=uvec, yvec=yvec,
                          tvec=tvec, cur_ind=cur_ind, pa=pa, inplace=True)
         pa.part[-1] = self.ctraj[cur_ind + 1].pa.part[0]
 
-        if (yvec is not None and yvec[cur_ind + 1] is not None):
+        if (yvec is not None and has_measurement(yvec[cur_ind + 1])):
             pa = self.measure(traj=traj, ancestors=ancestors, pa=pa, uvec=uvec,
                               yvec=yvec, tvec=tvec, cur_ind=cur_ind + 1)
-
-        return (pa, resampled, ancestors)
+        return pa
 
 class CPFAS(CPF):
     """
@@ -607,44 +890,34 @@ class CPFAS(CPF):
          - ancestors (array-like): anecstral indices for particles at time t+1
         """
         N = len(traj[-1].pa.part)
-        ancestors = numpy.empty((N,), dtype=int)
-        tmp = numpy.exp(traj[-1].pa.w)
-        tmp /= numpy.sum(tmp)
-        ancestors[:-1] = sample(tmp, N - 1)
+        step = self._next_step(traj)
+        ancestors = step.ancestors
+        tmp = traj[-1].pa.get_normalized_weights()
+        ancestors[:-1] = self.resampler(tmp, N - 1)
 
         #select ancestor for conditional trajectory
-        pind = numpy.asarray(range(N), dtype=numpy.int)
-        find = numpy.zeros((N,), dtype=numpy.int)
+        if (self._find is None or len(self._find) != N):
+            self._find = numpy.zeros((N,), dtype=int)
 
-        wtrans = self.model.logp_xnext_singlestep(part=traj[cur_ind].pa.part[pind],
+        # All particles at time t are candidate ancestors, in order
+        wtrans = self.model.logp_xnext_singlestep(part=traj[cur_ind].pa.part,
                                                   past_trajs=traj[:cur_ind],
-                                                  pind=traj[cur_ind].ancestors[pind],
+                                                  pind=traj[cur_ind].ancestors,
                                                   # Single future timestep
                                                   future_parts=self.ctraj[cur_ind + 1].pa.part,
-                                                  find=find,
+                                                  find=self._find,
                                                   ut=uvec, yt=yvec, tt=tvec,
                                                   cur_ind=cur_ind)
-        wanc = wtrans + traj[-1].pa.w[pind]
+        wanc = wtrans + traj[-1].pa.w
         wanc -= numpy.max(wanc)
         tmp = numpy.exp(wanc)
         tmp /= numpy.sum(tmp)
-        condind = sample(tmp, 1)
+        condind = sample(tmp, 1, self.rng)
         ancestors[-1] = condind
 
-        pa = ParticleApproximation(self.model.copy_ind(traj[-1].pa.part,
-                                                       ancestors))
-
-
+        pa = self._propagate(traj=traj, step=step, uvec=uvec, yvec=yvec,
+                             tvec=tvec, cur_ind=cur_ind)
         resampled = True
-
-        pa = self.update(traj=traj, ancestors=ancestors, uvec=uvec, yvec=yvec,
-                         tvec=tvec, cur_ind=cur_ind, pa=pa, inplace=True)
-        pa.part[-1] = self.ctraj[cur_ind + 1].pa.part[0]
-
-        if (yvec is not None and yvec[cur_ind + 1] is not None):
-            pa = self.measure(traj=traj, ancestors=ancestors, pa=pa, uvec=uvec,
-                              yvec=yvec, tvec=tvec, cur_ind=cur_ind + 1)
-
         return (pa, resampled, ancestors)
 
 
@@ -652,7 +925,26 @@ class CPFAS(CPF):
 class AuxiliaryParticleFilter(ParticleFilter):
     """ Auxiliary Particle Filer class, creates filter estimates by calling appropriate
         methods in the supplied particle objects and handles resampling when
-        a specified threshold is reach """
+        a specified threshold is reach
+
+    Args:
+     - adapted (bool): use the fully adapted filter, the first stage weights
+       are then the exact predictive likelihood p(y_{t+1}|x_t) and the
+       particles are propagated using p(x_{t+1}|x_t, y_{t+1}), so the second
+       stage weights are identically one. Requires the model to implement
+       'eval_predictive_loglik' and 'sample_adapted', see
+       pyparticleest.models.nlg.NonlinearGaussian.get_meas_dynamics
+
+    See ParticleFilter for the remaining arguments
+    """
+
+    def __init__(self, model, res=0, resampler=None, adaptive=None, rng=None,
+                 resample_order=None, adapted=False):
+        super(AuxiliaryParticleFilter, self).__init__(model=model, res=res,
+                                                      resampler=resampler,
+                                                      adaptive=adaptive, rng=rng,
+                                                      resample_order=resample_order)
+        self.adapted = adapted
 
     def forward(self, traj, yvec, uvec, tvec, cur_ind):
         """
@@ -677,42 +969,66 @@ class AuxiliaryParticleFilter(ParticleFilter):
 
         resampled = False
 
-        if (yvec is not None and yvec[cur_ind + 1] is not None):
+        meas = (yvec is not None and has_measurement(yvec[cur_ind + 1]))
+        if (meas):
             # TODO Generalize to non-Markovian
-            l1w = self.model.eval_1st_stage_weights(pa.part, uvec[cur_ind],
-                                                    yvec[cur_ind + 1],
-                                                    tvec[cur_ind])
+            if (self.adapted):
+                l1w = self.model.eval_predictive_loglik(pa.part, uvec[cur_ind],
+                                                        yvec[cur_ind + 1],
+                                                        tvec[cur_ind])
+            else:
+                l1w = self.model.eval_1st_stage_weights(pa.part, uvec[cur_ind],
+                                                        yvec[cur_ind + 1],
+                                                        tvec[cur_ind])
             pa.w += l1w
-            pa.w -= numpy.max(pa.w)
-
-        if (self.res and pa.calc_Neff() < self.res * pa.num):
-            ancestors = pa.resample(self.model, pa.num)
+            m = numpy.max(pa.w)
+            pa.w_offset += m
+            pa.w -= m
+
+        N = self.calc_next_N(pa)
+        if ((self.res and pa.calc_Neff() < self.res * pa.num) or
+            N != pa.num):
+            ancestors = pa.resample(self.model, N,
+                                    resampler=self.resampler,
+                                    order=self.resample_order)
             resampled = True
-            l1w = l1w[ancestors]
+            if (meas):
+                l1w = l1w[ancestors]
         else:
             ancestors = numpy.arange(pa.num, dtype=int)
 
+        if (meas and self.adapted):
+            # Sampling from the optimal proposal, the second stage weights
+            # are identically one
+            pa.part = self.model.sample_adapted(pa.part, uvec[cur_ind],
+                                                yvec[cur_ind + 1], tvec[cur_ind])
+            return (pa, resampled, ancestors)
+
         pa = self.update(traj=traj, ancestors=ancestors,
                          uvec=uvec, yvec=yvec,
                          tvec=tvec, cur_ind=cur_ind,
                          pa=pa, inplace=True,)
 
-        if (yvec is not None):
+        if (meas):
             pa = self.measure(traj=traj, ancestors=ancestors, pa=pa,
                               #There is no 'u' for last step yet
                               uvec=uvec, yvec=yvec, tvec=tvec, cur_ind=cur_ind + 1)
             pa.w -= l1w
-            pa.w -= numpy.max(pa.w)
+            m = numpy.max(pa.w)
+            pa.w_offset += m
+            pa.w -= m
 
         return (pa, resampled, ancestors)
 
 
 
 class CPFYAS(CPFAS):
-    def __init__(self, model, N, cond_traj):
+    def __init__(self, model, N, cond_traj, resampler=None, rng=None):
         self.ctraj = numpy.copy(cond_traj)
         self.model = model
         self.N = N
+        self.rng = get_rng(rng)
+        self.resampler = get_resampler(resampler, self.rng)
 
     def forward(self, traj, yvec, uvec, tvec, cur_ind):
         """
@@ -733,13 +1049,12 @@ class CPFYAS(CPFAS):
         """
 
         ancestors = numpy.empty((self.N,), dtype=int)
-        tmp = numpy.exp(traj[cur_ind].pa.w)
-        tmp /= numpy.sum(tmp)
-        ancestors[:-1] = sample(tmp, self.N - 1)
+        tmp = traj[cur_ind].pa.get_normalized_weights()
+        ancestors[:-1] = self.resampler(tmp, self.N - 1)
 
         #select ancestor for conditional trajectory
-        pind = numpy.arange(self.N, dtype=numpy.int)
-        find = numpy.zeros((self.N,), dtype=numpy.int)
+        pind = numpy.arange(self.N, dtype=int)
+        find = numpy.zeros((self.N,), dtype=int)
 
         wtrans = self.model.logp_xnext_singlestep(part=traj[cur_ind].pa.part[pind],
                                                   past_trajs=traj[:cur_ind],
@@ -754,7 +1069,7 @@ class CPFYAS(CPFAS):
         wanc -= numpy.max(wanc)
         tmp = numpy.exp(wanc)
         tmp /= numpy.sum(tmp)
-        condind = sample(tmp, 1)
+        condind = sample(tmp, 1, self.rng)
         ancestors[-1] = condind
         resampled = True
 
@@ -773,7 +1088,7 @@ class CPFYAS(CPFAS):
         m = numpy.max(wn)
         wn -= m
         pa = ParticleApproximation(partn, wn)
-        pa.w_offset += m
+        pa.w_offset += m + traj[cur_ind].pa.get_log_normalizer() - math.log(self.N)
         return (pa, resampled, ancestors)
 
     def measure(self, traj, ancestors, pa, uvec, yvec, tvec, cur_ind, inplace=True):
@@ -803,6 +1118,172 @@ class CPFYAS(CPFAS):
         return pa
 
 
+class ReplicatedParticleFilter(object):
+    """
+    Run K independent particle filters for the same model and dataset, useful
+    for e.g. characterising the variance of an estimator. The particles of all
+    replicates are stored in one array with K*N elements, where the particles
+    of replicate k are at indices k*N:(k+1)*N. The model methods are called
+    once per time step for all the replicates, the weight normalization,
+    resampling and computation of the estimates are performed independently
+    for each segment.
+
+    Requires a Markovian model (ParticleFiltering) where the particles are
+    represented by a numpy array.
+
+    Args:
+     - model (ParticleFiltering): object describing the model to be used
+     - N (int): number of particles in each replicate
+     - K (int): number of replicates
+     - res (float): 0 .. 1 , the ratio of effective number of particles that
+       triggers resampling of a replicate. 0 disables resampling
+     - resampler (string/callable): resampling algorithm, the default is
+       systematic resampling performed for all the segments at once. Other
+       resamplers are called separately for each replicate.
+     - rng: random number generator used for the resampling, defaults to
+       numpy.random
+    """
+
+    def __init__(self, model, N, K, res=2.0 / 3.0, resampler=None, rng=None):
+        self.model = model
+        self.N = N
+        self.K = K
+        self.res = res
+        self.rng = get_rng(rng)
+        if (resampler is None):
+            self.resampler = None
+        else:
+            self.resampler = get_resampler(resampler, self.rng)
+        self.part = None
+        # Log-weights, normalized so that the weights of each replicate sum to one
+        self.w = None
+        # Estimates of log p(y_{0:t}) for each replicate
+        self.logp_y = numpy.zeros(K)
+        self.t = 0
+        self.means = []
+
+    def create_initial_estimate(self):
+        """
+        Sample the initial particles for all the replicates
+        """
+        self.part = self.model.create_initial_estimate(self.K * self.N)
+        self.w = -math.log(self.N) * numpy.ones((self.K, self.N))
+        self.t = 0
+
+    def calc_Neff(self):
+        """
+        Calculate number of effective particles for each replicate
+
+        Returns:
+         (array-like) with length K
+        """
+        tmp = numpy.exp(self.w - numpy.max(self.w, 1)[:, numpy.newaxis])
+        tmp /= numpy.sum(tmp, 1)[:, numpy.newaxis]
+        return 1.0 / numpy.sum(numpy.square(tmp), 1)
+
+    def resample(self):
+        """
+        Resample the replicates whose effective number of particles is below
+        the threshold
+
+        Returns:
+         (array-like) boolean array with length K, True for the replicates
+         that were resampled
+        """
+        resampled = numpy.zeros(self.K, dtype=bool)
+        if (self.res <= 0):
+            return resampled
+        rows = numpy.nonzero(self.calc_Neff() < self.res * self.N)[0]
+        if (len(rows) == 0):
+            return resampled
+
+        w = numpy.exp(self.w[rows] - numpy.max(self.w[rows], 1)[:, numpy.newaxis])
+        if (self.resampler is None):
+            ind = systematic_segmented(w, self.N, self.rng)
+        else:
+            ind = numpy.vstack([self.resampler(w[i], self.N) for i in range(len(rows))])
+        ancestors = numpy.arange(self.K * self.N, dtype=int).reshape((self.K, self.N))
+        ancestors[rows] = ind + self.N * rows[:, numpy.newaxis]
+        self.part = self.model.copy_ind(self.part, ancestors.ravel())
+        self.w[rows] = -math.log(self.N)
+        resampled[rows] = True
+        return resampled
+
+    def forward(self, u, y):
+        """
+        Propagate all the replicates from t to t+1 and update them using the
+        measurement y
+
+        Args:
+         - u (array-like): Input to go from x_t -> x_{t+1}
+         - y (array-like): Measurement of x_{t+1}
+
+        Returns:
+         (array-like) boolean array with length K, True for the replicates
+         that were resampled
+        """
+        if (self.part is None):
+            self.create_initial_estimate()
+
+        resampled = self.resample()
+        noise = self.model.sample_process_noise(particles=self.part, u=u, t=self.t)
+        self.model.update(particles=self.part, u=u, t=self.t, noise=noise)
+        self.t += 1
+        if (has_measurement(y)):
+            self.measure_int(y)
+        self.means.append(self.calc_mean())
+        return resampled
+
+    def measure(self, y):
+        """
+        Update the estimates of all the replicates using a measurement of the
+        current state
+
+        Args:
+         - y (array-like): Measurement at current time index
+        """
+        if (self.part is None):
+            self.create_initial_estimate()
+        if (has_measurement(y)):
+            self.measure_int(y)
+        if (len(self.means) > self.t):
+            self.means[self.t] = self.calc_mean()
+        else:
+            self.means.append(self.calc_mean())
+
+    def measure_int(self, y):
+        lpy = self.model.measure(particles=self.part, y=y, t=self.t)
+        lw = self.w + numpy.reshape(lpy, (self.K, self.N))
+        # Segmented log-sum-exp, gives the increment of the log-likelihood
+        m = numpy.max(lw, 1)
+        lse = m + numpy.log(numpy.sum(numpy.exp(lw - m[:, numpy.newaxis]), 1))
+        self.logp_y += lse
+        self.w = lw - lse[:, numpy.newaxis]
+
+    def calc_mean(self):
+        """
+        Calculate the weighted mean of the particles of each replicate
+
+        Returns:
+         (array-like) with first dimension = K
+        """
+        part = numpy.reshape(self.part, (self.K, self.N) + self.part.shape[1:])
+        w = numpy.exp(self.w)
+        return numpy.einsum('kn,kn...->k...', w, part)
+
+    def get_filtered_mean(self):
+        """
+        Return the filtered mean for all time steps
+
+        Returns:
+         (T, K, D) array
+
+        T is the length of the dataset, K is the number of replicates and D
+        is the dimension of each particle
+        """
+        return numpy.asarray(self.means)
+
+
 class TrajectoryStep(object):
     """
     Store particle approximation, input, output and timestamp for
@@ -835,18 +1316,131 @@ class ParticleTrajectory(object):
      - t0 (float): time stamp for intial time
      - filter (string): Which filtering algorihms to use
      - filter_options (dictionary): options passed to the filter
+        - 'cond_traj': the conditional trajectory for the conditional
+          particle filters
+        - 'adaptive': strategy for adapting the number of particles for
+          the 'pf' and 'apf' filters, see pyparticleest.utils.adaptive. N
+          is then only the initial number of particles. Can not be combined
+          with storage='array'.
+        - 'resample_order': f(part) returning the order in which the
+          particles are resampled for the 'pf', 'apf', 'sir' and 'pfy'
+          filters, see pyparticleest.utils.correlated
+        - 'adapted': use the fully adapted auxiliary particle filter
+          (filter='apf'), see AuxiliaryParticleFilter
      - T (int): Length of dataset (for non-online computations), pre-allocates
-       space for input/output/time vectors
+       space for input/output/time vectors. When the length is exceeded the
+       storage is doubled.
      - utype (array): the datatype of the input signals
-     - ytype (array): the datatype of the measurements
+     - ytype (array): the datatype of the measurements. The default
+       (numpy.ndarray) stores a reference to each measurement. For a numeric
+       type (e.g. float) the measurements are instead copied into a
+       contiguous (T, dy) array, where dy is the shape of the first
+       measurement, and missing measurements (None) are stored as NaN. The
+       same holds for utype and the input signals.
+     - resampler (string/callable): resampling algorithm used by the filter,
+       see pyparticleest.utils.resample
+     - storage (string): how to store the time steps
+        - 'list': list of separately allocated TrajectoryStep objects
+        - 'array': contiguous (T, N, ...) arrays, see
+          pyparticleest.storage.ArrayTrajectory. Requires the particles
+          to be represented as a numpy array.
+        - 'memmap': like 'array' but the data is stored in memory mapped
+          files, for datasets that don't fit in memory. See
+          pyparticleest.storage.MemmapTrajectory
+     - storage_options (dict): options for the 'memmap' storage
+        - 'path': directory for the files, defaults to a temporary
+          directory
+        - 'chunk_size': number of time steps in each file
+        - 'cache_chunks': number of chunks kept in memory when smoothing
+     - max_lag (int): if not None only the last max_lag+1 time steps
+       are retained (together with the corresponding inputs and
+       measurements), so the memory usage is bounded when running the
+       filter online. After each call to 'forward' the fixed-lag estimate
+       of the mean of x_{t-max_lag} (see lag_smoother) is available in the
+       members 'fixed_lag_est' and 'fixed_lag_t'. Indices into traj, uvec,
+       yvec and tvec are relative to the oldest retained time step, whose
+       absolute index is stored in 'offset'. Can not be combined with the
+       conditional particle filters or the 'memmap' storage.
+     - lag_smoother (string): how to compute the fixed-lag estimates
+        - 'ancestor': from the ancestral lineages of the particles, see
+          pyparticleest.smoother.AncestralLagSmoother
+        - 'bsi': using backward simulation over the last max_lag+1 time
+          steps, see pyparticleest.smoother.BSILagSmoother
+     - lag_options (dict): options for the 'bsi' lag smoother
+        - 'M': number of backward trajectories (default 10)
+     - rng: random number generator used by the filter (e.g. for the
+       resampling) and by default also by the smoothers, defaults to
+       numpy.random. Seeds and numpy.random.Generator objects are accepted,
+       see pyparticleest.utils.rng. The random numbers of the model are drawn
+       from the member 'rng' of the model, to drive all the randomness from
+       one source set it to the same object. See
+       pyparticleest.utils.correlated for correlated random numbers.
+     - precision (string): precision used to store the time steps
+        - 'double': the particles are stored as returned by the model
+        - 'single': float64 particles are stored as float32 and the
+          ancestral indices as int32, roughly halving the memory used. Only
+          the stored history is affected, the latest time step (which the
+          filter continues from) and all the computations are kept in double
+          precision.
+
+    An estimate of the log-likelihood log p(y_{0:t}) is accumulated in the
+    member 'logp_y'. For the 'pf', 'apf' and 'sir' filters the estimate of
+    p(y_{0:t}) is unbiased. For the conditional filters it is the same
+    estimator evaluated conditionally on the reference trajectory, which is
+    not unbiased. For the 'pfy' and 'cpfyas' filters the particles are
+    proposed from the measurements, the estimate then excludes the
+    normalization of the proposal (the terms log int p(y_t|x_t) dx_t) and
+    the prior of the initial state.
     """
 
     def __init__(self, model, N, resample=2.0 / 3.0, t0=0,
                  filter='PF', filter_options={}, T=None,
-                 utype=numpy.ndarray, ytype=numpy.ndarray):
+                 utype=numpy.ndarray, ytype=numpy.ndarray, resampler=None,
+                 storage='list', max_lag=None, rng=None, precision='double',
+                 storage_options=None, lag_smoother='ancestor', lag_options=None):
 
         self.using_pfy = False
         self.N = N
+        # Construction arguments, stored when saving a checkpoint
+        self.filter_type = filter.lower()
+        self.res = resample
+        self.resampler = resampler
+        self.storage = storage
+        self.storage_options = storage_options
+        if (precision not in ('double', 'single')):
+            raise ValueError('Bad precision')
+        self.precision = precision
+        if (filter_options is None):
+            filter_options = {}
+        adaptive = filter_options.get('adaptive', None)
+        resample_order = filter_options.get('resample_order', None)
+        if (adaptive is not None and filter.lower() not in ('pf', 'apf')):
+            raise ValueError('Adaptive number of particles requires the pf or apf filter')
+        if (adaptive is not None and storage != 'list'):
+            raise ValueError('Adaptive number of particles requires list storage')
+        if (max_lag is not None and storage == 'memmap'):
+            raise ValueError('max_lag not supported for memmap storage')
+        self.max_lag = max_lag
+        self.lag_smoother = lag_smoother
+        self.lag_options = lag_options
+        self.lag_estimator = None
+        if (max_lag is not None):
+            from pyparticleest.smoother import AncestralLagSmoother, BSILagSmoother
+            if (lag_options is None):
+                lag_options = {}
+            if (lag_smoother == 'ancestor'):
+                self.lag_estimator = AncestralLagSmoother(max_lag)
+            elif (lag_smoother == 'bsi'):
+                self.lag_estimator = BSILagSmoother(max_lag, **lag_options)
+            else:
+                raise ValueError('Bad lag smoother type')
+        self.offset = 0
+        self.fixed_lag_est = None
+        self.fixed_lag_t = None
+        self.logp_y = 0.0
+        if (max_lag is not None and filter.lower() in ('cpf', 'cpfas',
+                                                       'cpfyas', 'csiras')):
+            raise ValueError('max_lag not supported for conditional filters')
         if (T is not None):
             assert(utype is not None)
             assert(ytype is not None)
@@ -857,34 +1451,67 @@ class ParticleTrajectory(object):
         else:
             self.uvec = numpy.empty(1, dtype=utype)
             self.yvec = numpy.empty(1, dtype=ytype)
-            self.tvec = numpy.empty(1, dtype=numpy.float)
-            self.T = 0
+            self.tvec = numpy.empty(1, dtype=float)
+            self.T = 1
+        # True for the time indices where a measurement is available
+        self.ymask = numpy.zeros(self.T, dtype=bool)
         #TODO, this isn't correctly used in the code, assumed = 0
         assert(t0 == 0)
         self.tvec[0] = t0
         self.ind = -1
         if (filter.lower() == 'pf'):
-            self.pf = ParticleFilter(model=model, res=resample)
+            self.pf = ParticleFilter(model=model, res=resample,
+                                     resampler=resampler, adaptive=adaptive,
+                                     rng=rng, resample_order=resample_order)
         elif (filter.lower() == 'apf'):
-            self.pf = AuxiliaryParticleFilter(model=model, res=resample)
+            self.pf = AuxiliaryParticleFilter(model=model, res=resample,
+                                              resampler=resampler,
+                                              adaptive=adaptive, rng=rng,
+                                              resample_order=resample_order,
+                                              adapted=filter_options.get('adapted', False))
         elif (filter.lower() == 'pfy'):
-            self.pf = FFPropY(model=model, N=N, res=resample)
+            self.pf = FFPropY(model=model, N=N, res=resample,
+                              resampler=resampler, rng=rng,
+                              resample_order=resample_order)
             self.using_pfy = True
         elif (filter.lower() == 'cpfyas'):
-            self.pf = CPFYAS(model=model, N=N, cond_traj=filter_options['cond_traj'])
+            self.pf = CPFYAS(model=model, N=N, cond_traj=filter_options['cond_traj'],
+                             resampler=resampler, rng=rng)
             self.using_pfy = True
         elif (filter.lower() == 'cpfas'):
-            self.pf = CPFAS(model=model, cond_traj=filter_options['cond_traj'])
+            self.pf = CPFAS(model=model, cond_traj=filter_options['cond_traj'],
+                            resampler=resampler, rng=rng)
         elif (filter.lower() == 'cpf'):
-            self.pf = CPF(model=model, cond_traj=filter_options['cond_traj'])
+            self.pf = CPF(model=model, cond_traj=filter_options['cond_traj'],
+                          resampler=resampler, rng=rng)
         elif (filter.lower() == 'sir'):
-            self.pf = SIR(model=model, res=resample)
+            self.pf = SIR(model=model, res=resample, resampler=resampler, rng=rng,
+                          resample_order=resample_order)
         elif (filter.lower() == 'csiras'):
-            self.pf = CSIRAS(model=model, cond_traj=filter_options['cond_traj'])
+            self.pf = CSIRAS(model=model, cond_traj=filter_options['cond_traj'],
+                             resampler=resampler, rng=rng)
         else:
             raise ValueError('Bad filter type')
 
-        self.traj = []
+        if (storage == 'list'):
+            self.traj = []
+        elif (storage == 'array' or storage == 'memmap'):
+            from pyparticleest.storage import ArrayTrajectory, MemmapTrajectory
+            if (precision == 'single'):
+                (dtype, index_dtype) = (numpy.float32, numpy.int32)
+            else:
+                (dtype, index_dtype) = (None, None)
+            if (storage == 'memmap'):
+                if (storage_options is None):
+                    storage_options = {}
+                self.traj = MemmapTrajectory(dtype=dtype, index_dtype=index_dtype,
+                                             **storage_options)
+            elif (T is not None):
+                self.traj = ArrayTrajectory(T + 1, dtype, index_dtype)
+            else:
+                self.traj = ArrayTrajectory(None, dtype, index_dtype)
+        else:
+            raise ValueError('Bad storage type')
 
         return
 
@@ -904,35 +1531,128 @@ class ParticleTrajectory(object):
             self.ind = 0
             particles = self.pf.create_initial_estimate(self.N)
             pa = ParticleApproximation(particles=particles)
-            self.traj.append(TrajectoryStep(pa, ancestors=numpy.arange(self.N)))
-
-        if (self.ind + 1 >= self.T):
-            ushape = numpy.asarray(self.uvec.shape)
-            ushape[0] = self.ind + 1
-            self.uvec.resize(ushape)
-            yshape = numpy.asarray(self.yvec.shape)
-            yshape[0] = self.ind + 2
-            self.yvec.resize(yshape)
-            tshape = numpy.asarray(self.tvec.shape)
-            tshape[0] = self.ind + 2
-            self.tvec.resize(tshape)
-            self.T = self.ind + 2
+            self.append(TrajectoryStep(pa, ancestors=numpy.arange(self.N)))
+
+        self.reserve(self.ind + 2)
 
         ind = self.ind
-        self.uvec[ind] = u
-        self.yvec[ind + 1] = y
-        self.tvec[ind + 1] = ind + 1
+        self.uvec = _store_value(self.uvec, ind, u)
+        self.yvec = _store_value(self.yvec, ind + 1, y)
+        self.ymask[ind + 1] = has_measurement(y)
+        self.tvec[ind + 1] = self.offset + ind + 1
         self.ind += 1
 
+        lw_prev = self.traj[-1].pa.get_log_normalizer()
+
         (pa_nxt, resampled, ancestors) = self.pf.forward(traj=self.traj,
-                                                         yvec=self.yvec,
-                                                         uvec=self.uvec,
-                                                         tvec=self.tvec,
+                                                         yvec=self.yvec[:ind + 2],
+                                                         uvec=self.uvec[:ind + 1],
+                                                         tvec=self.tvec[:ind + 2],
                                                          cur_ind=ind)
-        self.traj.append(TrajectoryStep(pa_nxt, ancestors=ancestors))
+        self.append(TrajectoryStep(pa_nxt, ancestors=ancestors))
+
+        # The filters start from the weights of the previous step (excluding
+        # w_offset) and accumulate all the rescalings of the weights in
+        # w_offset of the new approximation, including the resampling
+        self.logp_y += pa_nxt.get_log_normalizer() + pa_nxt.w_offset - lw_prev
+
+        if (self.max_lag is not None):
+            self.discard_history()
+            self.calc_fixed_lag_estimate()
 
         return resampled
 
+    def append(self, step):
+        """
+        Add a time step to the trajectory, with single precision storage the
+        previous time step is converted to the storage format
+
+        Args:
+         - step (TrajectoryStep): time step to add
+        """
+        if (self.precision == 'single' and isinstance(self.traj, list) and
+            len(self.traj) > 0):
+            _compact_step(self.traj[-1])
+        self.traj.append(step)
+
+    def reset(self):
+        """
+        Remove all time steps so the filter can be run again from the
+        initial time, the storage allocated for the time steps and the
+        input/output/time vectors is kept and reused
+        """
+        self.ind = -1
+        self.offset = 0
+        self.fixed_lag_est = None
+        self.fixed_lag_t = None
+        self.logp_y = 0.0
+        if (self.lag_estimator is not None):
+            self.lag_estimator.reset()
+        self.ymask[:] = False
+        self.tvec[0] = 0
+        if (isinstance(self.traj, list)):
+            del self.traj[:]
+        else:
+            self.traj.clear()
+
+    def reserve(self, T):
+        """
+        Make sure there is space for at least T time steps in the
+        input/output/time vectors, the storage is grown geometrically to
+        get a constant amortized cost when running the filter online
+
+        Args:
+         - T (int): number of time steps
+        """
+        if (T <= self.T):
+            return
+        T = max(T, 2 * self.T)
+        self.uvec = _grow_buffer(self.uvec, T)
+        self.yvec = _grow_buffer(self.yvec, T)
+        self.tvec = _grow_buffer(self.tvec, T)
+        self.ymask = _grow_buffer(self.ymask, T)
+        self.T = T
+
+    def discard_history(self):
+        """
+        Discard the time steps older than max_lag. To get a constant amortized
+        cost the data is only moved when twice the number of needed time steps
+        are stored.
+        """
+        keep = self.max_lag + 1
+        if (len(self.traj) < 2 * keep):
+            return
+        k = len(self.traj) - keep
+        if (isinstance(self.traj, list)):
+            del self.traj[:k]
+        else:
+            self.traj.discard(k)
+
+        # uvec contains data up to ind-1, yvec and tvec up to ind
+        self.uvec[:self.ind - k] = self.uvec[k:self.ind]
+        self.yvec[:self.ind + 1 - k] = self.yvec[k:self.ind + 1]
+        self.ymask[:self.ind + 1 - k] = self.ymask[k:self.ind + 1]
+        self.tvec[:self.ind + 1 - k] = self.tvec[k:self.ind + 1]
+        self.ind -= k
+        self.offset += k
+
+    def calc_fixed_lag_estimate(self):
+        """
+        Calculate the fixed-lag estimate of the mean of x_{t-max_lag} using
+        the lag smoother. The result is stored in 'fixed_lag_est', with the
+        time index of the estimate in 'fixed_lag_t'.
+
+        Returns:
+         (array-like) the fixed-lag estimate, None if less than max_lag
+         time steps have been processed
+        """
+        est = self.lag_estimator.update(self)
+        if (est is None):
+            return None
+        self.fixed_lag_est = est
+        self.fixed_lag_t = self.offset + len(self.traj) - 1 - self.max_lag
+        return self.fixed_lag_est
+
     def measure(self, y):
         """
         Update estimate using new measurement
@@ -944,48 +1664,72 @@ class ParticleTrajectory(object):
          None
         """
 
-        if (self.ind + 1 >= self.T):
-            ushape = numpy.asarray(self.uvec.shape)
-            ushape[0] = self.ind + 2
-            self.uvec.resize(ushape)
-            yshape = numpy.asarray(self.yvec.shape)
-            yshape[0] = self.ind + 2
-            self.yvec.resize(yshape)
-            tshape = numpy.asarray(self.tvec.shape)
-            tshape[0] = self.ind + 2
-            self.tvec.resize(tshape)
-            self.T = self.ind + 2
+        self.reserve(self.ind + 2)
 
         if (self.using_pfy):
             self.ind += 1
-            self.yvec[self.ind] = y
-            self.tvec[self.ind] = self.ind
+            self.yvec = _store_value(self.yvec, self.ind, y)
+            self.ymask[self.ind] = has_measurement(y)
+            self.tvec[self.ind] = self.offset + self.ind
 
             ancestors = numpy.arange(self.N, dtype=int)
             pa = self.pf.measure(traj=self.traj,
                                  ancestors=ancestors,
                                  pa=None,
-                                 uvec=self.uvec,
-                                 yvec=self.yvec,
-                                 tvec=self.tvec,
+                                 uvec=self.uvec[:self.ind + 1],
+                                 yvec=self.yvec[:self.ind + 1],
+                                 tvec=self.tvec[:self.ind + 1],
                                  cur_ind=self.ind,
                                  inplace=False)
-            self.traj.append(TrajectoryStep(pa, ancestors=ancestors))
+            self.append(TrajectoryStep(pa, ancestors=ancestors))
         else:
             if (len(self.traj) == 0):
                 self.ind = 0
                 particles = self.pf.create_initial_estimate(self.N)
                 pa = ParticleApproximation(particles=particles)
                 ancestors = numpy.arange(self.N, dtype=int)
-                self.traj.append(TrajectoryStep(pa, ancestors=ancestors))
+                self.append(TrajectoryStep(pa, ancestors=ancestors))
+
+            self.yvec = _store_value(self.yvec, self.ind, y)
+            self.ymask[self.ind] = has_measurement(y)
+            self.tvec[self.ind] = self.offset + self.ind
+
+            if (self.ymask[self.ind]):
+                pa = self.traj[-1].pa
+                self.logp_y -= pa.get_log_normalizer() + pa.w_offset
+                self.pf.measure(traj=self.traj, ancestors=self.traj[-1].ancestors,
+                                pa=pa, uvec=self.uvec[:self.ind + 1],
+                                yvec=self.yvec[:self.ind + 1],
+                                tvec=self.tvec[:self.ind + 1],
+                                cur_ind=self.ind, inplace=True)
+                self.logp_y += pa.get_log_normalizer() + pa.w_offset
+
+    def save(self, path):
+        """
+        Save a checkpoint of the filter to the directory path, the filter can
+        then be resumed using 'ParticleTrajectory.load'. See
+        pyparticleest.checkpoint for the format.
+
+        Args:
+         - path (string): directory to write the checkpoint to
+        """
+        from pyparticleest.checkpoint import save
+        save(self, path)
 
-            self.yvec[self.ind] = y
-            self.tvec[self.ind] = self.ind
+    @staticmethod
+    def load(path, model, filter_options=None, resampler=None, rng=None,
+             storage=None, storage_options=None, mmap=True):
+        """
+        Restore a filter saved with 'save', see pyparticleest.checkpoint.load
+        for the arguments
 
-            self.pf.measure(traj=self.traj, ancestors=self.traj[-1].ancestors,
-                            pa=self.traj[-1].pa, uvec=self.uvec,
-                            yvec=self.yvec, tvec=self.tvec,
-                            cur_ind=self.ind, inplace=True)
+        Returns:
+         (ParticleTrajectory) the restored filter
+        """
+        from pyparticleest.checkpoint import load
+        return load(path, model, filter_options=filter_options,
+                    resampler=resampler, rng=rng, storage=storage,
+                    storage_options=storage_options, mmap=mmap)
 
     def __len__(self):
         return len(self.traj)
@@ -1017,16 +1761,31 @@ class ParticleTrajectory(object):
 
         options = {}
         if (method == 'rs' or method == 'rsas'):
-            # Calculate coefficients needed for rejection sampling in the backward smoothing
-            coeffs = numpy.empty(len(self.traj), dtype=float)
+            # Calculate coefficients needed for rejection sampling in the backward smoothing,
+            # one bound for each particle when the model provides them
+            model = self.pf.model
+            particle_bounds = _has_particle_bounds(model)
+            if (particle_bounds):
+                coeffs = numpy.empty(len(self.traj), dtype=object)
+                bound = model.logp_xnext_max_full_particles
+            else:
+                coeffs = numpy.empty(len(self.traj), dtype=float)
+                bound = model.logp_xnext_max_full
             for k in range(len(self.traj) - 1):
-                coeffs[k] = self.pf.model.logp_xnext_max_full(part=self.traj[k].pa.part,
-                                                              past_trajs=self.traj[:k],
-                                                              pind=self.traj[k].ancestors,
-                                                              uvec=self.uvec,
-                                                              yvec=self.yvec,
-                                                              tvec=self.tvec,
-                                                              cur_ind=k)
+                coeffs[k] = bound(part=to_working_precision(self.traj[k].pa.part),
+                                  past_trajs=self.traj[:k],
+                                  pind=self.traj[k].ancestors,
+                                  uvec=self.uvec,
+                                  yvec=self.yvec,
+                                  tvec=self.tvec,
+                                  cur_ind=k)
+            if (particle_bounds and
+                all(numpy.all(b == b[0]) for b in coeffs[:-1])):
+                # The bounds don't depend on the particle, use the cheaper
+                # scalar rejection sampler
+                scalar = numpy.zeros(len(self.traj), dtype=float)
+                scalar[:-1] = [b[0] for b in coeffs[:-1]]
+                coeffs = scalar
             options['maxpdf'] = coeffs
             if (method == 'rs'):
                 # Default for max number of attempts before resoriting to evaluate all weights
@@ -1062,6 +1821,12 @@ class ParticleApproximation(object):
      - seed (array-like): value to initialize all particles with
      - num (int): number of particles
 
+    The normalized weights, cumulative weights, number of effective particles,
+    the normalization constant and the alias table for drawing samples are
+    computed when first needed and cached until the log-weights are
+    reassigned (pa.w = ..., pa.w -= ...). Code that modifies individual
+    elements of pa.w in-place, or writes to the arrays of an ArrayTrajectory
+    directly, must call 'invalidate_weights' afterwards.
     """
     def __init__(self, particles=None, logw=None, seed=None, num=None):
         if (particles is not None):
@@ -1086,6 +1851,86 @@ class ParticleApproximation(object):
     def __len__(self):
         return len(self.part)
 
+    @property
+    def w(self):
+        return self._w
+
+    @w.setter
+    def w(self, value):
+        self._w = value
+        self.invalidate_weights()
+
+    def invalidate_weights(self):
+        """
+        Discard the cached values computed from the log-weights
+        """
+        self._wnorm = None
+        self._wcum = None
+        self._neff = None
+        self._lognorm = None
+        self._alias = None
+
+    def _calc_normalized(self):
+        m = numpy.max(self.w)
+        wnorm = numpy.exp(self.w - m)
+        s = numpy.sum(wnorm)
+        wnorm /= s
+        wnorm.flags.writeable = False
+        self._wnorm = wnorm
+        self._lognorm = m + math.log(s)
+
+    def get_normalized_weights(self):
+        """
+        Return the weights normalized to sum to one, the returned array must
+        not be modified
+
+        Returns:
+         (array-like) normalized weights
+        """
+        if (self._wnorm is None):
+            self._calc_normalized()
+        return self._wnorm
+
+    def get_cumulative_weights(self):
+        """
+        Return the cumulative sum of the normalized weights, the last element
+        is exactly one. The returned array must not be modified.
+
+        Returns:
+         (array-like) cumulative weights
+        """
+        if (self._wcum is None):
+            wcum = numpy.cumsum(self.get_normalized_weights())
+            wcum[-1] = 1.0
+            wcum.flags.writeable = False
+            self._wcum = wcum
+        return self._wcum
+
+    def get_alias_table(self):
+        """
+        Return an alias table for drawing independent samples according to
+        the weights, useful when drawing repeatedly from the same
+        approximation
+
+        Returns:
+         (AliasTable) see pyparticleest.utils.resample
+        """
+        if (self._alias is None):
+            self._alias = AliasTable(self.get_normalized_weights())
+        return self._alias
+
+    def get_log_normalizer(self):
+        """
+        Return log(sum(exp(w))) for the log-weights w (not including
+        w_offset)
+
+        Returns:
+         (float)
+        """
+        if (self._lognorm is None):
+            self._calc_normalized()
+        return self._lognorm
+
     def calc_Neff(self):
         """
         Calculate number of effective particles, common metric used to determine
@@ -1094,11 +1939,11 @@ class ParticleApproximation(object):
         Returns:
          (float) number of effective particles
         """
-        tmp = numpy.exp(self.w - numpy.max(self.w))
-        tmp /= numpy.sum(tmp)
-        return 1.0 / numpy.sum(numpy.square(tmp))
+        if (self._neff is None):
+            self._neff = 1.0 / numpy.sum(numpy.square(self.get_normalized_weights()))
+        return self._neff
 
-    def resample(self, model, N=None):
+    def resample(self, model, N=None, resampler=None, order=None):
         """
         Resample approximation so all particles have the same weight
 
@@ -1106,20 +1951,32 @@ class ParticleApproximation(object):
          - model: object containing problem specific methods
          - N: new number of particles is N. If 'None' out the number of
            particles remains the same
+         - resampler (callable): function f(w, n) returning n indices drawn
+           according to the weights w, defaults to systematic resampling
+         - order (callable): if not None, f(part) returning a permutation of
+           the particles, the resampler is then applied to the particles in
+           that order. See pyparticleest.utils.correlated
         """
 
         if (N is None):
             N = self.num
+        if (resampler is None):
+            resampler = systematic
 
-        # Alwyays keep the largest weight at 0 in logaritmic representation
-        tmp = self.w - numpy.max(self.w)
-        new_ind = sample(numpy.exp(tmp), N)
+        if (order is None):
+            new_ind = resampler(self.get_normalized_weights(), N)
+        else:
+            perm = numpy.asarray(order(self.part), dtype=int)
+            new_ind = perm[resampler(self.get_normalized_weights()[perm], N)]
         new_part = model.copy_ind(self.part, new_ind)
 
-        self.w = numpy.log(numpy.ones(N, dtype=numpy.float) / N)
+        # The total mass of the weights is moved to w_offset, so
+        # logsumexp(w) + w_offset is unchanged by the resampling
+        lognorm = self.get_log_normalizer()
+        self.w = numpy.full(N, -math.log(N))
         self.part = new_part
         self.num = N
-        self.w_offset = 0.0
+        self.w_offset += lognorm
         return new_ind
 
     def sample(self):
@@ -1128,7 +1985,7 @@ class ParticleApproximation(object):
 
         Returns:
          (array-like) sampled particle"""
-        return self.part[sample(numpy.exp(self.w), 1)[0]]
+        return self.part[sample(self.get_normalized_weights(), 1)[0]]
 
     def find_best_particles(self, n=1):
         """
@@ -63,6 +63,10 @@ class SIR():
 class ParticleFilteringNonMarkov():
     __metaclass__ = abc.ABCMeta
 
+    # Random number generator the model should use when sampling, replace
+    # it to use a separate stream, see pyparticleest.utils.rng
+    rng = numpy.random
+
     @abc.abstractmethod
     def update_full(self, particles, traj, uvec, yvec, tvec, ancestors, noise):
         """
@@ -342,6 +346,12 @@ class FFBSi(FFBSiNonMarkov):
     """
     Base class for particles to be used with particle smoothing
     (Backward Simulation)
+
+    Models can optionally provide
+    logp_xnext_full_batch(part, past_trajs, pind, future_trajs, find, ut, yt,
+    tt, cur_ind) returning the (len(find), N) matrix of log-pdf values for
+    all pairs of future trajectories and particles, bsi_full then evaluates
+    all the weights for a block of backward trajectories in one call
     """
     __metaclass__ = abc.ABCMeta
 
@@ -452,6 +462,33 @@ class FFBSiRSNonMarkov(FFBSiNonMarkov):
         """
         pass
 
+    def logp_xnext_max_full_particles(self, part, past_trajs, pind, uvec, yvec, tvec, cur_ind):
+        """
+        Return an upper bound of the log-pdf value for all possible future
+        states for each particle. Tighter bounds than logp_xnext_max_full
+        increase the acceptance rate of the rejection samplers, particles can
+        also share the bound of a cluster they belong to. Default
+        implementation uses the bound from logp_xnext_max_full for all
+        particles.
+
+        Args:
+
+         - part  (array-like): Model specific representation
+           of all particles, with first dimension = N (number of particles)
+         - past_trajs: Trajectory leading up to current time
+         - pind: Indices relating part to past_trajs
+         - uvec (array-like): input signals for {1:T}
+         - yvec (array-like): measurements for {1:T}
+         - tvec (array-like): time stamps for {1:T}
+         - cur_ind: index for current time
+
+        Returns:
+         (array-like) of length N, max_{x_{t+1}} logp(x_{t+1}|x_t^i)
+        """
+        bound = self.logp_xnext_max_full(part, past_trajs, pind, uvec, yvec,
+                                         tvec, cur_ind)
+        return numpy.max(bound) * numpy.ones(len(part))
+
 
 class FFBSiRS(FFBSi):
     """
@@ -478,9 +515,108 @@ class FFBSiRS(FFBSi):
         pass
 
 
+    def logp_xnext_max_particles(self, particles, u, t):
+        """
+        Return an upper bound of the log-pdf value for all possible future
+        states for each particle, see
+        FFBSiRSNonMarkov.logp_xnext_max_full_particles. Default implementation
+        uses the bound from logp_xnext_max for all particles.
+
+        Args:
+
+         - particles  (array-like): Model specific representation
+           of all particles, with first dimension = N (number of particles)
+         - u (array-like): input signal
+         - t (float): time stamps
+
+        Returns:
+         (array-like) of length N, max_{x_{t+1}} logp(x_{t+1}|x_t^i)
+        """
+        return numpy.max(self.logp_xnext_max(particles, u, t)) * numpy.ones(len(particles))
+
     def logp_xnext_max_full(self, part, past_trajs, pind, uvec, yvec, tvec, cur_ind):
         return self.logp_xnext_max(part, u=uvec[cur_ind], t=tvec[cur_ind])
 
+    def logp_xnext_max_full_particles(self, part, past_trajs, pind, uvec, yvec, tvec, cur_ind):
+        return self.logp_xnext_max_particles(part, u=uvec[cur_ind], t=tvec[cur_ind])
+
+class TwoFilterSmoothing(FFBSi):
+    """
+    Base class for models to be used with the generalized two-filter smoother.
+    The backward information filter targets the artificial distribution
+    p~(x_t|y_{t:T}) proportional to gamma_t(x_t)*p(y_{t:T}|x_t), where gamma_t
+    is an artificial prior supplied by the model. It must be non-zero wherever
+    p(x_t|y_{0:t-1}) is.
+
+    The models must also implement 'measure' (see ParticleFiltering)
+    """
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def sample_artificial_prior(self, N, t):
+        """
+        Sample N particles from the artificial prior gamma_t
+
+        Args:
+         - N (int): Number of particles to sample
+         - t (float): time stamp
+
+        Returns:
+         (array-like) with first dimension = N, model specific representation
+         of all particles
+        """
+        pass
+
+    @abc.abstractmethod
+    def logp_artificial_prior(self, particles, t):
+        """
+        Evaluate log gamma_t(x_t)
+
+        Args:
+         - particles  (array-like): Model specific representation
+           of all particles, with first dimension = N (number of particles)
+         - t (float): time stamp
+
+        Returns:
+         (array-like) with first dimension = N, log gamma_t(x_t^i)
+        """
+        pass
+
+    def propose_backward(self, next_part, u, y, t):
+        """
+        Sample x_t from the proposal q(x_t|x_{t+1}, y_t) used by the backward
+        information filter, the particles at the end of the dataset are
+        always drawn from the artificial prior. Default implementation samples
+        from the artificial prior.
+
+        Args:
+         - next_part (array-like): resampled particle estimate for t+1
+         - u (array-like): input signal at t
+         - y (array-like): measurement at t
+         - t (float): time stamp
+
+        Returns:
+         (array-like) with first dimension = len(next_part)
+        """
+        return self.sample_artificial_prior(len(next_part), t)
+
+    def logp_propose_backward(self, particles, next_part, u, y, t):
+        """
+        Evaluate log q(x_t|x_{t+1}, y_t) for the proposal in propose_backward
+
+        Args:
+         - particles  (array-like): Model specific representation
+           of all particles, with first dimension = N (number of particles)
+         - next_part (array-like): resampled particle estimate for t+1
+         - u (array-like): input signal at t
+         - y (array-like): measurement at t
+         - t (float): time stamp
+
+        Returns:
+         (array-like) with first dimension = N, log q(x_t^i|x_{t+1}^i, y_t)
+        """
+        return self.logp_artificial_prior(particles, t)
+
 class SampleProposer(object):
     """
     Base class for models to be used with methods that require drawing of new
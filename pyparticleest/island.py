@@ -0,0 +1,382 @@
+""" Island particle filter, the particles are split into several islands that
+are filtered independently (possibly in different processes or on different
+nodes) and interact by resampling the islands according to their weights.
+
+Based on "On parallel implementation of sequential Monte Carlo methods: the
+island particle model" by Verge, Dubarry, Del Moral and Moulines.
+
+@author: Jerker Nordh
+"""
+
+import math
+import numpy
+from multiprocessing import Process, Pipe
+from multiprocessing.connection import Listener, Client
+from pyparticleest.filter import ParticleTrajectory, ParticleApproximation, \
+    TrajectoryStep, logsumexp
+from pyparticleest.utils.resample import get_resampler
+from pyparticleest.utils.rng import spawn
+
+
+class _Island(object):
+    """
+    A particle filter owning one island, only the latest time step is
+    retained. Keeps track of the log-likelihood estimate since the last
+    interaction, this is the log-weight of the island.
+    """
+    def __init__(self, model, N, res, filter, resampler, rng):
+        self.model = model
+        self.rng = rng
+        self.pt = ParticleTrajectory(model, N, res, filter=filter,
+                                     resampler=resampler, max_lag=0, rng=rng)
+
+    def forward(self, u, y):
+        # The model might be shared with other islands in the same process
+        self.model.rng = self.rng
+        self.pt.forward(u, y)
+        return self.summary()
+
+    def measure(self, y):
+        self.model.rng = self.rng
+        self.pt.measure(y)
+        return self.summary()
+
+    def summary(self):
+        pa = self.pt.traj[-1].pa
+        w = pa.get_normalized_weights()
+        mean = numpy.tensordot(w, numpy.asarray(pa.part), axes=(0, 0))
+        return (self.pt.logp_y, mean)
+
+    def get_state(self):
+        pa = self.pt.traj[-1].pa
+        return (numpy.asarray(pa.part), numpy.asarray(pa.w), pa.w_offset)
+
+    def set_state(self, state):
+        (part, w, w_offset) = state
+        pa = ParticleApproximation(part, w)
+        pa.w_offset = w_offset
+        self.pt.traj[-1] = TrajectoryStep(pa, ancestors=numpy.arange(len(w), dtype=int))
+        self.pt.logp_y = 0.0
+
+    def reset_weight(self):
+        self.pt.logp_y = 0.0
+
+
+def _dispatch(state, msg):
+    """
+    Execute command msg = (cmd, args) for the island stored in state['island']
+    """
+    (cmd, args) = msg
+    try:
+        if (cmd == 'init'):
+            state['island'] = _Island(*args)
+            return None
+        return getattr(state['island'], cmd)(*args)
+    except Exception as e:
+        return e
+
+
+def run_island(conn):
+    """
+    Serve the commands of the coordinator received on conn until told to
+    close
+
+    Args:
+     - conn (Connection): connection to the coordinator
+    """
+    state = {}
+    while True:
+        msg = conn.recv()
+        if (msg[0] == 'close'):
+            break
+        conn.send(_dispatch(state, msg))
+    conn.close()
+
+
+def run_island_client(address, authkey=b'pyparticleest'):
+    """
+    Connect to a coordinator using SocketTransport and serve one island, this
+    is what should be run on each of the remote nodes
+
+    Args:
+     - address (tuple): (host, port) the coordinator is listening on
+     - authkey (bytes): shared secret used to authenticate the connection
+    """
+    run_island(Client(address, authkey=authkey))
+
+
+class _LocalConnection(object):
+    """
+    Executes the island commands synchronously in the calling process
+    """
+    def __init__(self):
+        self.state = {}
+        self.reply = None
+
+    def send(self, msg):
+        if (msg[0] != 'close'):
+            self.reply = _dispatch(self.state, msg)
+
+    def recv(self):
+        return self.reply
+
+
+class InProcessTransport(object):
+    """
+    Run all the islands sequentially in the current process, mainly
+    useful for debugging. The islands share the model object, but each
+    island assigns its own random number generator to it before use.
+    """
+    def connect(self, M):
+        return [_LocalConnection() for _i in range(M)]
+
+    def close(self):
+        pass
+
+
+class PipeTransport(object):
+    """
+    Run each island in a separate local process communicating over
+    multiprocessing pipes
+    """
+    def __init__(self):
+        self.procs = []
+
+    def connect(self, M):
+        conns = []
+        for _i in range(M):
+            (local, remote) = Pipe()
+            proc = Process(target=run_island, args=(remote,))
+            proc.daemon = True
+            proc.start()
+            self.procs.append(proc)
+            conns.append(local)
+        return conns
+
+    def close(self):
+        for proc in self.procs:
+            proc.join()
+        self.procs = []
+
+
+class SocketTransport(object):
+    """
+    The coordinator listens on a TCP socket and each island connects to it,
+    the messages are exchanged using multiprocessing.connection. On each
+    remote node 'run_island_client' should be called with the address of the
+    coordinator. If spawn_local is True the islands are instead started as
+    local processes connecting over the loopback interface, this can be
+    used as a stand-in for testing without access to a cluster.
+
+    Args:
+     - address (tuple): (host, port) to listen on, port 0 selects a
+       free port
+     - authkey (bytes): shared secret used to authenticate the islands
+     - spawn_local (bool): start the islands as local processes
+    """
+    def __init__(self, address=('localhost', 0), authkey=b'pyparticleest',
+                 spawn_local=True):
+        self.address = address
+        self.authkey = authkey
+        self.spawn_local = spawn_local
+        self.listener = None
+        self.procs = []
+
+    def connect(self, M):
+        self.listener = Listener(self.address, backlog=M, authkey=self.authkey)
+        if (self.spawn_local):
+            for _i in range(M):
+                proc = Process(target=run_island_client,
+                               args=(self.listener.address, self.authkey))
+                proc.daemon = True
+                proc.start()
+                self.procs.append(proc)
+        return [self.listener.accept() for _i in range(M)]
+
+    def close(self):
+        for proc in self.procs:
+            proc.join()
+        self.procs = []
+        if (self.listener is not None):
+            self.listener.close()
+            self.listener = None
+
+
+class IslandParticleFilter(object):
+    """
+    Island particle filter, M islands of N particles are each filtered by a
+    separate particle filter (resampling locally within the island). The
+    weight of an island is its estimate of the likelihood since the last
+    interaction. Every 'interval' time steps the islands are resampled
+    according to their weights if the effective number of islands is below
+    island_res*M, islands that are not selected are replaced by copies of the
+    selected ones.
+
+    The estimate of the log-likelihood log p(y_{0:t}) for the whole filter is
+    available in the member 'logp_y', it is unbiased (on the linear scale)
+    regardless of the interaction schedule.
+
+    Requires a model that can be pickled (unless using InProcessTransport),
+    and a filter that provides a log-likelihood estimate, see
+    ParticleTrajectory.
+
+    Args:
+     - model (ParticleFiltering): object describing the model to be used
+     - N (int): number of particles in each island
+     - M (int): number of islands
+     - res (float): resampling threshold for the particles within each island
+     - island_res (float): 0 .. 1, the ratio of effective number of islands
+       that triggers resampling of the islands. 0 disables the interaction
+     - interval (int): number of time steps between the interactions
+     - filter (string): filter used for the islands, 'pf' or 'sir'
+     - resampler (string/callable): resampling algorithm, used both within
+       and between the islands
+     - transport: how to communicate with the islands, InProcessTransport,
+       PipeTransport (default) or SocketTransport
+     - seed: seed for the random number generators (see
+       pyparticleest.utils.rng), each island uses an independent stream
+       spawned from it. By default the streams are derived from numpy.random
+    """
+    def __init__(self, model, N, M, res=2.0 / 3.0, island_res=2.0 / 3.0,
+                 interval=1, filter='PF', resampler=None, transport=None,
+                 seed=None):
+        if (filter.lower() not in ('pf', 'sir')):
+            raise ValueError('Island filter requires the pf or sir filter')
+        self.M = M
+        self.island_res = island_res
+        self.interval = interval
+        if (transport is None):
+            transport = PipeTransport()
+        self.transport = transport
+
+        # One stream for the interaction and one for each island
+        rngs = spawn(seed, M + 1)
+        self.rng = rngs[0]
+        self.resampler = get_resampler(resampler, self.rng)
+        self.conns = self.transport.connect(M)
+        self._call_all([('init', (model, N, res, filter, resampler, rng))
+                        for rng in rngs[1:]])
+
+        # Log-weights of the islands, log-likelihood since the last interaction
+        self.lw = numpy.zeros(M)
+        # Log-likelihood up to the last interaction
+        self.logp_y_offset = 0.0
+        self.logp_y = 0.0
+        self.steps = 0
+        self.means = []
+
+    def _call_all(self, msgs, conns=None):
+        """
+        Send one command to each island before waiting for the replies, so
+        the islands work in parallel
+        """
+        if (conns is None):
+            conns = self.conns
+        for (conn, msg) in zip(conns, msgs):
+            conn.send(msg)
+        replies = [conn.recv() for conn in conns]
+        for reply in replies:
+            if (isinstance(reply, Exception)):
+                raise reply
+        return replies
+
+    def _update(self, replies):
+        self.lw = numpy.asarray([r[0] for r in replies], dtype=float)
+        lw_sum = logsumexp(self.lw)
+        self.logp_y = self.logp_y_offset + lw_sum - math.log(self.M)
+        W = numpy.exp(self.lw - lw_sum)
+        self.means.append(numpy.tensordot(W, numpy.asarray([r[1] for r in replies]),
+                                          axes=(0, 0)))
+
+    def calc_Neff(self):
+        """
+        Calculate the effective number of islands
+
+        Returns:
+         (float)
+        """
+        W = numpy.exp(self.lw - numpy.max(self.lw))
+        W /= numpy.sum(W)
+        return 1.0 / numpy.sum(numpy.square(W))
+
+    def interact(self):
+        """
+        Resample the islands according to their weights, the selected
+        islands are copied to the ones that were not selected
+
+        Returns:
+         (array-like) the index of the island each island was copied from
+        """
+        W = numpy.exp(self.lw - numpy.max(self.lw))
+        anc = numpy.asarray(self.resampler(W, self.M), dtype=int)
+        # Keep as many islands as possible in place to minimize the transfers
+        counts = numpy.bincount(anc, minlength=self.M)
+        dest = [m for m in range(self.M) if counts[m] == 0]
+        anc = numpy.arange(self.M, dtype=int)
+        for m in range(self.M):
+            for _i in range(counts[m] - 1):
+                anc[dest.pop()] = m
+
+        moved = numpy.nonzero(anc != numpy.arange(self.M))[0]
+        sources = numpy.unique(anc[moved])
+        states = self._call_all([('get_state', ())] * len(sources),
+                                [self.conns[m] for m in sources])
+        states = dict(zip(sources, states))
+        self._call_all([('set_state', (states[anc[m]],)) for m in moved],
+                       [self.conns[m] for m in moved])
+        kept = numpy.nonzero(anc == numpy.arange(self.M))[0]
+        self._call_all([('reset_weight', ())] * len(kept),
+                       [self.conns[m] for m in kept])
+
+        self.logp_y_offset = self.logp_y
+        self.lw = numpy.zeros(self.M)
+        return anc
+
+    def forward(self, u, y):
+        """
+        Propagate all the islands from t to t+1 using the measurement y,
+        followed by interaction between the islands if scheduled
+
+        Args:
+         - u (array-like): Input to go from x_t -> x_{t+1}
+         - y (array-like): Measurement of x_{t+1}
+
+        Returns:
+         (bool) True if the islands were resampled
+        """
+        replies = self._call_all([('forward', (u, y))] * self.M)
+        self._update(replies)
+        self.steps += 1
+        if (self.island_res > 0 and self.steps % self.interval == 0 and
+            self.calc_Neff() < self.island_res * self.M):
+            self.interact()
+            return True
+        return False
+
+    def measure(self, y):
+        """
+        Update all the islands using a measurement of the initial state
+
+        Args:
+         - y (array-like): Measurement at current time index
+        """
+        replies = self._call_all([('measure', (y,))] * self.M)
+        self._update(replies)
+
+    def get_filtered_mean(self):
+        """
+        Return the filtered mean for all time steps
+
+        Returns:
+         (T, D) array
+        """
+        return numpy.asarray(self.means)
+
+    def close(self):
+        """
+        Shut down the islands
+        """
+        for conn in self.conns:
+            conn.send(('close', ()))
+        self.transport.close()
+        self.conns = []
@@ -172,7 +172,7 @@ class HierarchicalBase(RBPSBase):
             xi = copy.copy(xil[0]).ravel()
             # Sample the linear variables, the full conditional density
             # is recovred later in the post_smoothing step
-            z = numpy.random.multivariate_normal(zl[0].ravel(), Pl[0]).ravel()
+            z = self.rng.multivariate_normal(zl[0].ravel(), Pl[0]).ravel()
             res[j, :(self.lxi + self.kf.lz)] = numpy.hstack((xi, z))
         return res
 
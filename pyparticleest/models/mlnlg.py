@@ -132,7 +132,7 @@ class MixedNLGaussianSampled(RBPSBase):
         zeros = numpy.zeros(dim)
         for i in range(N):
             Sigma = Qxi[i] + Axi[i].dot(Pl[i]).dot(Axi[i].T)
-            noise[i] = numpy.random.multivariate_normal(zeros, Sigma).ravel()
+            noise[i] = self.rng.multivariate_normal(zeros, Sigma).ravel()
         return noise
 
     def calc_xi_next(self, particles, noise, u, t):
@@ -583,8 +583,8 @@ class MixedNLGaussianSampled(RBPSBase):
 
         for j in range(M):
             xi = numpy.copy(xil[j]).ravel()
-            z = numpy.random.multivariate_normal(zl[j].ravel(),
-                                                 Pl[j]).ravel()
+            z = self.rng.multivariate_normal(zl[j].ravel(),
+                                             Pl[j]).ravel()
             res[j] = numpy.hstack((xi, z))
         return res
 
@@ -1067,7 +1067,7 @@ class MixedNLGaussianSampledInitialGaussian(MixedNLGaussianSampled):
         particles = numpy.empty((N, dim))
 
         for i in range(N):
-            particles[i, 0:self.lxi] = numpy.random.multivariate_normal(self.xi0.ravel(), self.Pxi0)
+            particles[i, 0:self.lxi] = self.rng.multivariate_normal(self.xi0.ravel(), self.Pxi0)
             particles[i, self.lxi:(self.lxi + self.kf.lz)] = numpy.copy(self.z0).ravel()
             particles[i, (self.lxi + self.kf.lz):] = numpy.copy(self.Pz0).ravel()
         return particles
@@ -3,6 +3,7 @@
 @author: Jerker Nordh
 """
 import pyparticleest.interfaces as interfaces
+from pyparticleest.utils.rng import get_rng
 import scipy.linalg
 import numpy.random
 import math
@@ -35,6 +36,8 @@ class NonlinearGaussian(interfaces.ParticleFiltering, interfaces.FFBSiRS):
      - g (array-like): g (if constaint)
      - Q (array-like): Q (if constaint)
      - R (array-like): R (if constaint)
+     - rng: random number generator used by the model, defaults to
+       numpy.random. See pyparticleest.utils.rng
      """
 
     __metaclass__ = abc.ABCMeta
@@ -97,7 +100,9 @@ class NonlinearGaussian(interfaces.ParticleFiltering, interfaces.FFBSiRS):
         """
         return None
 
-    def __init__(self, lxi, f=None, g=None, Q=None, R=None):
+    def __init__(self, lxi, f=None, g=None, Q=None, R=None, rng=None):
+        if (rng is not None):
+            self.rng = get_rng(rng)
         if (f is not None):
             self.f = numpy.copy(f)
         else:
@@ -142,7 +147,7 @@ class NonlinearGaussian(interfaces.ParticleFiltering, interfaces.FFBSiRS):
         """
         N = len(particles)
         Q = self.calc_Q(particles=particles, u=u, t=t)
-        noise = numpy.random.normal(size=(self.lxi, N))
+        noise = self.rng.normal(size=(self.lxi, N))
         if (Q is None):
             noise = self.Qcholtri.T.dot(noise)
         else:
@@ -200,7 +205,8 @@ class NonlinearGaussian(interfaces.ParticleFiltering, interfaces.FFBSiRS):
         diff = yrep - g
         if (R is None):
             if (self.Rcholtri.shape[0] == 1):
-                lpy = kalman.lognormpdf_scalar(diff, self.Rcholtri)
+                # The variance is the square of the Cholesky factor
+                lpy = kalman.lognormpdf_scalar(diff, self.Rcholtri ** 2)
             else:
                 lpy = kalman.lognormpdf_cho_vec(diff, self.Rchol)
         else:
@@ -233,6 +239,125 @@ class NonlinearGaussian(interfaces.ParticleFiltering, interfaces.FFBSiRS):
         partn = self.update(part, u, t, noise)
         return self.measure(partn, y, t + 1)
 
+    def get_meas_dynamics(self, t):
+        """
+        Return the matrices of an affine measurement equation, overload this
+        method to use the fully adapted auxiliary particle filter
+        (filter_options={'adapted': True} for the 'apf' filter)
+
+        y_t = C*x_t + h + e, e ~ N(0,R)
+
+        Args:
+         - t (float): time stamp
+
+        Returns:
+         (C, h, R), None for h indicates 0 and None for R that the R given to
+         the constructor should be used. Returns None if the measurement
+         equation isn't affine (default)
+        """
+        return None
+
+    def _adapted_moments(self, particles, u, y, t):
+        """
+        Calculate the predictive distribution of the measurement and the
+        distribution of the next state conditioned on the measurement for an
+        affine measurement equation
+
+        Returns:
+         (diff, f, Schol, K, Pchol, Q_identical) where diff[i] = y - C*f_i - h,
+         Schol is the Cholesky factorization of the innovation covariance and
+         the next state is distributed as N(f_i + K*diff[i], Pchol*Pchol^T).
+         Unless Q_identical is True Schol, K and Pchol are lists with one
+         element for each particle.
+        """
+        dyn = self.get_meas_dynamics(t=t + 1)
+        if (dyn is None):
+            raise ValueError('Fully adapted filtering requires an affine measurement equation, see get_meas_dynamics')
+        (C, h, R) = dyn
+        C = numpy.asarray(C).reshape((-1, self.lxi))
+        if (R is None):
+            R = self.Rcholtri.T.dot(self.Rcholtri)
+        N = len(particles)
+        f = self.calc_f(particles=particles, u=u, t=t)
+        if (f is None):
+            f = numpy.repeat(numpy.asarray(self.f).reshape((1, -1)), N, 0)
+        f = numpy.asarray(f).reshape((N, self.lxi))
+        yhat = f.dot(C.T)
+        if (h is not None):
+            yhat += numpy.asarray(h).reshape((1, -1))
+        diff = numpy.asarray(y).reshape((1, -1)) - yhat
+
+        def moments(Q):
+            S = C.dot(Q).dot(C.T) + R
+            Schol = scipy.linalg.cho_factor(S, check_finite=False)
+            K = scipy.linalg.cho_solve(Schol, C.dot(Q), check_finite=False).T
+            P = Q - K.dot(C).dot(Q)
+            Pchol = scipy.linalg.cholesky((P + P.T) / 2.0, lower=True,
+                                          check_finite=False)
+            return (Schol, K, Pchol)
+
+        Q = self.calc_Q(particles=particles, u=u, t=t)
+        if (Q is None):
+            (Schol, K, Pchol) = moments(self.Qcholtri.T.dot(self.Qcholtri))
+            return (diff, f, Schol, K, Pchol, True)
+        (Schol, K, Pchol) = zip(*[moments(Q[i]) for i in range(N)])
+        return (diff, f, Schol, K, Pchol, False)
+
+    def eval_predictive_loglik(self, particles, u, y, t):
+        """
+        Evaluate the exact first stage weights of the fully adapted auxiliary
+        particle filter, requires an affine measurement equation (see
+        get_meas_dynamics)
+
+        Args:
+
+         - particles  (array-like): Model specific representation
+           of all particles, with first dimension = N (number of particles)
+         - u (array-like): input signal
+         - y (array-like):  measurement of the next state
+         - t (float): time-stamp
+
+        Returns:
+         (array-like) with first dimension = N, logp(y_{t+1}|x_t^i)
+        """
+        (diff, _f, Schol, _K, _Pchol, Q_identical) = self._adapted_moments(particles, u, y, t)
+        if (Q_identical):
+            dim = diff.shape[1]
+            ld = numpy.sum(numpy.log(numpy.diag(Schol[0]))) * 2
+            quad = numpy.sum(diff.T * scipy.linalg.cho_solve(Schol, diff.T,
+                                                            check_finite=False), 0)
+            return -0.5 * (dim * math.log(2 * math.pi) + ld + quad)
+        diff = diff.reshape(diff.shape + (1,))
+        return numpy.asarray([kalman.lognormpdf_cho(diff[i], Schol[i])
+                              for i in range(len(particles))]).ravel()
+
+    def sample_adapted(self, particles, u, y, t):
+        """
+        Propagate the particles by sampling from p(x_{t+1}|x_t, y_{t+1}), the
+        optimal proposal used by the fully adapted auxiliary particle filter.
+        Requires an affine measurement equation (see get_meas_dynamics)
+
+        Args:
+
+         - particles  (array-like): Model specific representation
+           of all particles, with first dimension = N (number of particles)
+         - u (array-like): input signal
+         - y (array-like):  measurement of the next state
+         - t (float): time-stamp
+
+        Returns:
+         (array-like) with first dimension = N, particle estimate at time t+1
+        """
+        N = len(particles)
+        (diff, f, _Schol, K, Pchol, Q_identical) = self._adapted_moments(particles, u, y, t)
+        noise = self.rng.normal(size=(self.lxi, N))
+        if (Q_identical):
+            particles[:] = f + diff.dot(K.T) + Pchol.dot(noise).T
+        else:
+            for i in range(N):
+                particles[i] = f[i] + K[i].dot(diff[i]) + Pchol[i].dot(noise[:, i])
+        return particles
+
     def logp_xnext_max(self, particles, u, t):
         """
         Return the max log-pdf value for all possible future states'
@@ -249,19 +374,39 @@ class NonlinearGaussian(interfaces.ParticleFiltering, interfaces.FFBSiRS):
         Returns:
          (array-like) with first dimension = N, argmax_{x_{t+1}} logp(x_{t+1}|x_t)
         """
+        if (self.calc_Q(particles, u, t) is None):
+            return self.logpdfmax
+        else:
+            return numpy.max(self.logp_xnext_max_particles(particles, u, t))
+
+    def logp_xnext_max_particles(self, particles, u, t):
+        """
+        Return the max log-pdf value for all possible future states for
+        each particle, with state dependent Q this gives much tighter bounds
+        for the rejection samplers than logp_xnext_max
+
+        Args:
+
+         - particles  (array-like): Model specific representation
+           of all particles, with first dimension = N (number of particles)
+         - u (array-like): input signal
+         - t (float): time stamps
+
+        Returns:
+         (array-like) of length N, max_{x_{t+1}} logp(x_{t+1}|x_t^i)
+        """
         Q = self.calc_Q(particles, u, t)
         dim = self.lxi
         l2pi = math.log(2 * math.pi)
+        N = len(particles)
         if (Q is None):
-            return self.logpdfmax
-        else:
-            N = len(particles)
-            pmax = numpy.empty(N)
-            for i in range(N):
-                Qchol = scipy.linalg.cho_factor(Q[i], check_finite=False)
-                ld = numpy.sum(numpy.log(numpy.diag(Qchol[0]))) * 2
-                pmax[i] = -0.5 * (dim * l2pi + ld)
-            return numpy.max(pmax)
+            return self.logpdfmax * numpy.ones(N)
+        pmax = numpy.empty(N)
+        for i in range(N):
+            Qchol = scipy.linalg.cho_factor(Q[i], check_finite=False)
+            ld = numpy.sum(numpy.log(numpy.diag(Qchol[0]))) * 2
+            pmax[i] = -0.5 * (dim * l2pi + ld)
+        return pmax
 
     def logp_xnext(self, particles, next_part, u, t):
         """
@@ -287,7 +432,7 @@ class NonlinearGaussian(interfaces.ParticleFiltering, interfaces.FFBSiRS):
         Q = self.calc_Q(particles, u, t)
         if (Q is None):
             if (self.Qcholtri.shape[0] == 1):
-                lpx = kalman.lognormpdf_scalar(diff, self.Qcholtri)
+                lpx = kalman.lognormpdf_scalar(diff, self.Qcholtri ** 2)
             else:
                 lpx = kalman.lognormpdf_cho_vec(diff, self.Qchol)
         else:
@@ -299,6 +444,80 @@ class NonlinearGaussian(interfaces.ParticleFiltering, interfaces.FFBSiRS):
 
         return lpx
 
+    def whiten_xnext(self, particles, next_part, u, t):
+        """
+        Transform the predicted means f(x_t^i) and the future states
+        x_{t+1}^j to coordinates where the process noise is white, so that
+
+        logp(x_{t+1}^j|x_t^i) = logpdfmax - 0.5*||q_j - z_i||^2
+
+        Used by the spatial index backward kernels ('kdtree' and 'ffbsm'
+        smoothers), requires Q to be the same for all particles.
+
+        Args:
+         - particles  (array-like): Model specific representation
+           of all particles, with first dimension = N (number of particles)
+         - next_part (array-like): particle estimate for t+1
+         - u (array-like): input signal
+         - t (float): time stamps
+
+        Returns:
+         (z, q, logpdfmax), None if Q depends on the particles
+        """
+        if (self.calc_Q(particles, u, t) is not None):
+            return None
+        f = self.calc_f(particles, u, t)
+        if (f is None):
+            f = self.f
+        N = len(particles)
+        f = numpy.broadcast_to(f, (N, self.lxi))
+        # Q = U^T*U, solve U^T*z = f
+        z = scipy.linalg.solve_triangular(self.Qcholtri, f.T, trans='T',
+                                          check_finite=False).T
+        q = scipy.linalg.solve_triangular(self.Qcholtri,
+                                          numpy.reshape(next_part, (-1, self.lxi)).T,
+                                          trans='T', check_finite=False).T
+        return (z, q, self.logpdfmax)
+
+    def logp_xnext_full_batch(self, part, past_trajs, pind,
+                              future_trajs, find, ut, yt, tt, cur_ind):
+        """
+        Return the log-pdf values logp(x_{t+1}^j|x_t^i) for all pairs of the
+        future states future_trajs[0].pa.part[find] and the particles in
+        part, used by bsi_full to avoid one call of logp_xnext_full per
+        backward trajectory
+
+        Args:
+         - part  (array-like): Model specific representation
+           of all particles, with first dimension = N (number of particles)
+         - past_trajs: array of trajectory step objects from previous time-steps,
+           last index is step just before the current
+         - pind (array-like): index of the ancestor of each particle in part
+         - future_trajs (array-like): particle estimate for {t+1:T}
+         - find (array-like): indices in future_trajs, first dimension = M
+         - ut (array-like): input signals for {0:T}
+         - yt (array-like): measurements for {0:T}
+         - tt (array-like): time stamps for {0:T}
+         - cur_ind (int): index of current timestep (in ut, yt and tt)
+
+        Returns:
+         (array-like) of dimension (M, N)
+        """
+        next_part = future_trajs[0].pa.part[find]
+        white = self.whiten_xnext(part, next_part, u=ut[cur_ind], t=tt[cur_ind])
+        if (white is None):
+            N = len(part)
+            lpx = numpy.empty((len(find), N))
+            for j in range(len(find)):
+                lpx[j] = self.logp_xnext(part, next_part[j * numpy.ones((N,), dtype=int)],
+                                         u=ut[cur_ind], t=tt[cur_ind])
+            return lpx
+        (z, q, logpdfmax) = white
+        # ||q_j - z_i||^2 = ||q_j||^2 + ||z_i||^2 - 2*q_j^T*z_i
+        dist = (numpy.sum(q ** 2, axis=1)[:, numpy.newaxis] +
+                numpy.sum(z ** 2, axis=1)[numpy.newaxis, :] - 2.0 * q.dot(z.T))
+        return logpdfmax - 0.5 * numpy.maximum(dist, 0.0)
+
     def propose_smooth(self, ptraj, anc, future_trajs, find, yt, ut, tt, cur_ind):
         """
         Sample from a distribution q(x_t | x_{0:t-1}, x_{t+1:T}, y_t:T)
@@ -413,7 +632,7 @@ class NonlinearGaussianInitialGaussian(NonlinearGaussian):
         particles = numpy.repeat(self.x0, N, 1).T
         if (numpy.any(self.Px0)):
             Pchol = scipy.linalg.cho_factor(self.Px0)[0]
-            noise = numpy.random.normal(size=(self.lxi, N))
+            noise = self.rng.normal(size=(self.lxi, N))
             particles += (Pchol.dot(noise)).T
         return particles
 
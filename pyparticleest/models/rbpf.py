@@ -6,6 +6,7 @@
 
 import abc
 import pyparticleest.interfaces as interfaces
+from pyparticleest.utils.rng import get_rng
 from pyparticleest.filter import ParticleApproximation, TrajectoryStep
 
 try:
@@ -29,11 +30,15 @@ class RBPFBase(interfaces.ParticleFiltering):
        (if constant)
      - C (array-like): Measurement dynamic for linear states (if constant)
      - hz (array-like): Affine measurement term for linear states (if constant)
+     - rng: random number generator used by the model, defaults to
+       numpy.random. See pyparticleest.utils.rng
     """
     __metaclass__ = abc.ABCMeta
 
     def __init__(self, lz, Az=None, fz=None, Qz=None,
-                 C=None , hz=None, R=None, **kwargs):
+                 C=None , hz=None, R=None, rng=None, **kwargs):
+        if (rng is not None):
+            self.rng = get_rng(rng)
 
         self.kf = kalman.KalmanSmoother(lz, A=Az, C=C,
                                         Q=Qz, R=R,
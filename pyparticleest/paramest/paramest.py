@@ -228,14 +228,15 @@ class ParamEstimationPSAEM(Simulator):
         if (callback is None):
             callback = default_callback
 
-        ind = numpy.asarray(range(num_part), dtype=numpy.int)
+        ind = numpy.asarray(range(num_part), dtype=int)
         i = 0;
         while (True):
             i += 1
             self.set_params(params_local)
 
-            self.simulate(num_part, M, filter=filter, filter_options=filter_options,
-                          smoother=smoother, meas_first=meas_first)
+            self.simulate_conditional(num_part, M, filter_options['cond_traj'],
+                                      filter=filter, smoother=smoother,
+                                      meas_first=meas_first)
 
             if (raoblackwell == True):
                 tmp = self.straj.calculate_ancestors(self.pt, ind)
@@ -257,7 +258,7 @@ class ParamEstimationPSAEM(Simulator):
             else:
                 weights = numpy.concatenate(((1.0 - alpha) * weights, alpha * w))
 
-            filter_options['cond_traj'] = numpy.copy(self.straj.traj)
+            filter_options['cond_traj'] = self.straj.traj
             if (callback_sim is not None):
                 callback_sim(self)
 
@@ -331,21 +332,22 @@ class ParamEstimationPSAEM2(Simulator):
         weights = numpy.empty((max_iter * num_part,))
 
         datalen = 0
-        for i in xrange(max_iter):
+        for i in range(max_iter):
             self.set_params(params_local)
 
-            self.simulate(num_part, 1, filter=filter, filter_options=filter_options,
-                          smoother=smoother, smoother_options=smoother_options,
-                          meas_first=meas_first)
+            self.simulate_conditional(num_part, 1, filter_options['cond_traj'],
+                                      filter=filter, smoother=smoother,
+                                      smoother_options=smoother_options,
+                                      meas_first=meas_first)
 
-            tmp = numpy.copy(self.straj.traj)
+            tmp = self.straj.traj
             T = len(tmp)
             N = tmp[0].pa.part.shape[0]
             D = tmp[0].pa.part.shape[1]
 
             newtrajs = numpy.empty((T, N, D))
 
-            for t in xrange(T):
+            for t in range(T):
                 newtrajs[t] = tmp[t].pa.part
 
             w = 1.0
@@ -356,7 +358,7 @@ class ParamEstimationPSAEM2(Simulator):
 
 #            weights[datalen:datalen + 1] = alpha * w
 
-            filter_options['cond_traj'] = numpy.copy(self.straj.traj)
+            filter_options['cond_traj'] = self.straj.traj
             if (callback_sim is not None):
                 callback_sim(self)
 
@@ -5,8 +5,93 @@ framework.
 @author: Jerker Nordh
 """
 
+import os
 import numpy
-from pyparticleest.filter import ParticleTrajectory
+from pyparticleest.filter import ParticleTrajectory, ReplicatedParticleFilter
+from pyparticleest.utils.intrument import Instrumenter
+from pyparticleest.utils.rng import get_rng, spawn
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8, the dataset is instead pickled once for each worker
+    shared_memory = None
+
+# Per-process state of the workers used by Simulator.simulate_many
+_worker = {}
+
+
+class _SharedArray(object):
+    """
+    Description of a numpy array stored in a shared memory block
+    """
+    def __init__(self, shm, arr):
+        self.name = shm.name
+        self.shape = arr.shape
+        self.dtype = arr.dtype.str
+
+
+def _share_array(data, blocks):
+    """
+    Copy data to shared memory if it is a numeric numpy array, the created
+    block is appended to blocks.
+
+    Returns:
+     (_SharedArray) describing the shared copy, or data itself if it can not be
+     shared
+    """
+    if (shared_memory is None or not isinstance(data, numpy.ndarray) or
+        data.dtype.hasobject or data.nbytes == 0):
+        return data
+    shm = shared_memory.SharedMemory(create=True, size=data.nbytes)
+    blocks.append(shm)
+    arr = numpy.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)
+    arr[...] = data
+    return _SharedArray(shm, arr)
+
+
+def _attach_array(desc):
+    if (not isinstance(desc, _SharedArray)):
+        return desc
+    shm = shared_memory.SharedMemory(name=desc.name)
+    # Keep a reference to the block as long as the worker is alive
+    _worker.setdefault('blocks', []).append(shm)
+    arr = numpy.ndarray(desc.shape, dtype=numpy.dtype(desc.dtype), buffer=shm.buf)
+    arr.flags.writeable = False
+    return arr
+
+
+def _init_worker(model, u, y, instrument):
+    _worker['model'] = model
+    _worker['u'] = _attach_array(u)
+    _worker['y'] = _attach_array(y)
+    _worker['instrument'] = instrument
+
+
+def _run_worker(task):
+    (rng, num_part, num_traj, options) = task
+    # Models still drawing from the global generator get a seed derived
+    # from the stream of the run
+    numpy.random.seed(rng.randint(0, 2 ** 31 - 1))
+    model = _worker['model']
+    if (_worker['instrument']):
+        model = Instrumenter(model)
+    sim = Simulator(model, _worker['u'], _worker['y'], rng=rng)
+    sim.simulate(num_part, num_traj, **options)
+    fmean = sim.get_filtered_mean()
+    smean = None
+    if (sim.straj is not None):
+        smean = sim.get_smoothed_mean()
+    oc = None
+    if (_worker['instrument']):
+        oc = model.oc
+    return (fmean, smean, sim.pt.logp_y, oc)
+
+def _run_backward_filter(model, N, u, y, t, rng):
+    from pyparticleest.smoother import backward_information_filter
+    # The copy of the model in the worker must not reuse the stream of the
+    # forward filter
+    model.rng = rng
+    return backward_information_filter(model, N, u, y, t, rng=rng)
 
 class Simulator():
     """
@@ -18,9 +103,12 @@ class Simulator():
        to the particlar model class being used
      - y (array-like):  measurements, first dimension is the time index, the rest is specific
        to the particlar model class being used
+     - rng: random number generator used by the filters and smoothers, defaults
+       to numpy.random. Seeds and numpy.random.Generator objects are accepted,
+       see pyparticleest.utils.rng. If given it is also assigned to model.rng
     """
 
-    def __init__(self, model, u, y):
+    def __init__(self, model, u, y, rng=None):
         if (u is not None):
             self.u = u
         else:
@@ -28,8 +116,15 @@ class Simulator():
         self.y = y
         self.pt = None
         self.straj = None
+        self.rpf = None
+        self.cpt = None
+        self.cpt_key = None
+        self.paris = None
         self.params = None
         self.model = model
+        self.rng = get_rng(rng)
+        if (rng is not None):
+            model.rng = self.rng
 
     def set_params(self, params):
         """
@@ -44,7 +139,8 @@ class Simulator():
     def simulate(self, num_part, num_traj,
                  filter='PF', filter_options=None,
                  smoother='full', smoother_options=None,
-                 res=0.67, meas_first=False):
+                 res=0.67, meas_first=False, resampler=None, storage='list',
+                 precision='double', storage_options=None):
         """
         Solve the estimation problem
 
@@ -57,6 +153,24 @@ class Simulator():
          - res (float): resampling threshold for the forward filter
          - meas_first (bool): Is the first measurement of the initial state
            (true) or after the first time update? (false)
+         - resampler (string/callable): The resampling algorithm to use in the
+           forward filter
+         - storage (string): How to store the forward filter estimates, 'list',
+           'array' or 'memmap' (see ParticleTrajectory)
+         - storage_options (dict): options for the 'memmap' storage (see
+           ParticleTrajectory)
+         - precision (string): Precision used to store the forward filter
+           estimates, 'double' or 'single' (see ParticleTrajectory)
+
+        Supported resamplers:
+            - 'systematic': systematic resampling (default)
+            - 'stratified': stratified resampling
+            - 'residual': residual resampling, remaining particles are drawn
+              using multinomial resampling
+            - 'multinomial': multinomial resampling
+            - 'metropolis': Metropolis resampling, avoids collective
+              operations on the weights but is only approximate
+            - 'rejection': rejection resampling
 
         Supported filters:
             - 'pf': regular particle filter
@@ -66,6 +180,10 @@ class Simulator():
             - 'ancestor': return forward trajectories from particle filtier
               (no extra smoothing step)
             - 'full': Backward simulation evaluating all particle weights
+              Options (also for 'rs', 'rsas', 'mcmc' and 'kdtree'):
+                - workers (int): number of workers to divide the
+                  trajectories between (default is 1)
+                - pool (string): 'process' (default) or 'thread'
             - 'rs': Rejection sampling (with early stopping)
                Options:
                 - R: number of rejection sampling steps before
@@ -87,30 +205,329 @@ class Simulator():
                Options:
                 - R: the number of iterations to run the Markov chain for each
                   time step
+            - 'kdtree': Truncated backward simulation using KD-trees, requires
+              a model with a Gaussian transition density (whiten_xnext)
+               Options:
+                - eps (float): bound on the relative weight of the skipped
+                  particles (default is 1e-3)
+                - leaf_size (int): particles per leaf (default is 16)
+            - 'ffbsm': Weighted marginal smoothing distributions (FFBSm),
+              using KD-trees when the model provides whiten_xnext,
+              num_traj is ignored
+               Options:
+                - eps (float): (default is 1e-3, 0 for exact evaluation)
+                - leaf_size (int): (default is 16)
+            - 'twofilter': Weighted marginal smoothing distributions using the
+              generalized two-filter smoother, requires a model implementing
+              TwoFilterSmoothing, num_traj is ignored
+               Options:
+                - N (int): particles in the backward information filter
+                  (default is num_part)
+                - concurrent (bool): run the backward filter in a separate
+                  process while the forward filter runs, the model must be
+                  picklable (default is False)
+                - eps (float): (default is 1e-3, 0 for exact evaluation)
+                - leaf_size (int): (default is 16)
         """
-        resamplings = 0
-
         # Initialise a particle filter with our particle approximation of the initial state,
         # set the resampling threshold to 0.67 (effective particles / total particles )
         self.pt = ParticleTrajectory(self.model, num_part, res, filter=filter,
-                                     filter_options=filter_options)
+                                     filter_options=filter_options,
+                                     resampler=resampler, storage=storage,
+                                     rng=self.rng, precision=precision,
+                                     storage_options=storage_options)
+
+        pool = None
+        if (smoother == 'twofilter' and num_traj > 0 and
+            smoother_options is not None and smoother_options.get('concurrent', False)):
+            (pool, backward) = self._start_backward_filter(num_part, meas_first,
+                                                           smoother_options)
+        try:
+            resamplings = self._run_filter(meas_first)
+            if (pool is not None):
+                smoother_options = dict(smoother_options)
+                smoother_options['backward'] = backward.result()
+        finally:
+            if (pool is not None):
+                pool.shutdown()
 
+        # Use the filtered estimates above to created smoothed estimates
+        if (smoother is not None and num_traj > 0):
+            self.straj = self.pt.perform_smoothing(num_traj, method=smoother,
+                                                   smoother_options=smoother_options)
+        return resamplings
+
+    def _start_backward_filter(self, num_part, meas_first, smoother_options):
+        """
+        Start the backward information filter of the two-filter smoother in
+        a separate process, using the same time indexing as the forward filter
+
+        Returns:
+         (pool, future) the process pool and the future of the result
+        """
+        from concurrent.futures import ProcessPoolExecutor
+
+        if (meas_first):
+            y = list(self.y)
+            u = list(self.u)
+        else:
+            # The initial state is not measured
+            y = [None] + list(self.y)
+            u = list(self.u) + [None]
+        t = numpy.arange(len(y))
+        N = smoother_options.get('N', num_part)
+        rng = spawn(self.rng, 1)[0]
+        pool = ProcessPoolExecutor(max_workers=1)
+        return (pool, pool.submit(_run_backward_filter, self.model, N,
+                                  u, y, t, rng))
+
+    def _run_filter(self, meas_first, callback=None):
+        """
+        Run the particle filter stored in self.pt over the dataset
+
+        Args:
+         - meas_first (bool): Is the first measurement of the initial state
+         - callback (callable): called as callback(pt) after each time step
+
+        Returns:
+         (int) number of resamplings
+        """
+        resamplings = 0
         offset = 0
         # Run particle filter
         if (meas_first):
             self.pt.measure(self.y[0])
             offset = 1
+            if (callback is not None):
+                callback(self.pt)
         for i in range(offset, len(self.y)):
             # Run PF using noise corrupted input signal
             if (self.pt.forward(self.u[i - offset], self.y[i])):
                 resamplings = resamplings + 1
+            if (callback is not None):
+                callback(self.pt)
+        return resamplings
+
+    def smooth_additive(self, num_part, func, K=2, R=10, filter='PF',
+                        filter_options=None, res=0.67, meas_first=False,
+                        resampler=None):
+        """
+        Estimate the smoothed expectation of the additive functional
+        sum_t h_t(x_{t-1}, x_t) in a single forward pass using PaRIS, only
+        the last time steps of the filter are kept so the memory usage does
+        not grow with the length of the dataset. See
+        pyparticleest.smoother.PaRIS.
+
+        Args:
+         - num_part (int): Number of particles used in the forward filter.
+         - func (callable): the terms of the functional, see PaRIS
+         - K (int): Number of backward draws for each particle
+         - R (int): Number of rejection sampling proposals before falling
+           back to evaluating all the densities
+         - filter (string): The filter algorithm to use
+         - filter_options (dict): options passed to the filter
+         - res (float): resampling threshold for the forward filter
+         - meas_first (bool): Is the first measurement of the initial state
+           (true) or after the first time update? (false)
+         - resampler (string/callable): The resampling algorithm to use in the
+           forward filter
+
+        Returns:
+         (array-like) the estimate of E[sum_t h_t(x_{t-1}, x_t) | y_{0:T}]
+        """
+        from pyparticleest.smoother import PaRIS
+        self.pt = ParticleTrajectory(self.model, num_part, res, filter=filter,
+                                     filter_options=filter_options,
+                                     resampler=resampler, max_lag=1,
+                                     rng=self.rng)
+        self.paris = PaRIS(func, K=K, R=R)
+        self.straj = None
+        self._run_filter(meas_first, callback=self.paris.update)
+        return self.paris.get_estimate(self.pt)
+
+    def simulate_conditional(self, num_part, num_traj, cond_traj,
+                             filter='cpfas', smoother='ancestor',
+                             smoother_options=None, meas_first=False,
+                             resampler=None, storage='array'):
+        """
+        Run a conditional particle filter (particle Gibbs) followed by the
+        smoother. Intended to be called repeatedly, e.g. by PSAEM: the
+        filter and the storage for the time steps are created on the first
+        call and then kept, later calls with the same settings only replace
+        the conditional trajectory (it is copied into storage owned by the
+        filter) and rerun the filter, reusing all the allocated arrays.
+
+        Requires the particles to be represented as a numpy array.
+
+        Args:
+         - num_part (int): Number of particles used in the forward filter.
+         - num_traj (int): Number of trajectories generated by the smoother.
+         - cond_traj (array-like): sequence of TrajectorySteps to condition
+           on, typically the 'traj' member of a previous smoothed estimate
+         - filter (string): The conditional filter to use, 'cpf', 'cpfas',
+           'cpfyas' or 'csiras'
+         - smoother (string): The smoothing algorithm to use, see 'simulate'
+         - smoother_options (dict): algorithm specific smoother options
+         - meas_first (bool): Is the first measurement of the initial state
+           (true) or after the first time update? (false)
+         - resampler (string/callable): The resampling algorithm to use in the
+           forward filter
+         - storage (string): How to store the forward filter estimates, 'list'
+           or 'array' (see ParticleTrajectory). With 'array' the same arrays
+           are reused for all the calls, and the 'cpf' and 'cpfas' filters
+           write each time step directly into them.
+
+        Returns:
+         (int) number of resamplings
+        """
+        key = (filter.lower(), num_part, resampler, storage)
+        if (self.cpt is None or self.cpt_key != key):
+            self.cpt = ParticleTrajectory(self.model, num_part, filter=filter,
+                                          filter_options={'cond_traj': cond_traj},
+                                          resampler=resampler, T=len(self.y),
+                                          storage=storage, rng=self.rng)
+            self.cpt_key = key
+        else:
+            self.cpt.reset()
+        self.cpt.pf.set_cond_traj(cond_traj)
+        self.pt = self.cpt
+
+        resamplings = self._run_filter(meas_first)
 
-        # Use the filtered estimates above to created smoothed estimates
         if (smoother is not None and num_traj > 0):
             self.straj = self.pt.perform_smoothing(num_traj, method=smoother,
                                                    smoother_options=smoother_options)
         return resamplings
 
+    def simulate_many(self, n_runs, num_part, num_traj, workers=None,
+                      simulate_options=None, instrument=True, seeds=None):
+        """
+        Run n_runs independent instances of 'simulate' in a pool of worker
+        processes. The model and the dataset are transferred once to each
+        worker, numeric datasets are placed in shared memory instead of
+        being copied. Only the estimated means, log-likelihoods and operation
+        counts are returned from the workers. The model must be picklable.
+
+        Args:
+         - n_runs (int): Number of independent runs
+         - num_part (int): Number of particles used in the forward filter.
+         - num_traj (int): Number of backward trajectories generated by the smoother.
+         - workers (int): Number of worker processes, defaults to the number
+           of cpus
+         - simulate_options (dict): additional arguments passed to 'simulate',
+           e.g. filter, smoother, smoother_options, res, meas_first
+         - instrument (bool): count the operations performed in each run,
+           see pyparticleest.utils.intrument
+         - seeds (array-like): seeds for the random number generator for each
+           run, by default independent streams are spawned from the generator
+           of the simulator (see pyparticleest.utils.rng.spawn)
+
+        Returns (fmean, smean, logp_y, opcounts)
+         - fmean: (n_runs, T, D) array of filtered means
+         - smean: (n_runs, T, D) array of smoothed means, None if no smoother
+           was used
+         - logp_y: (n_runs,) array of the log-likelihood estimates (see
+           ParticleTrajectory)
+         - opcounts: list of OpCount objects (None if instrument is False)
+        """
+        from concurrent.futures import ProcessPoolExecutor
+
+        if (simulate_options is None):
+            simulate_options = {}
+        if (seeds is None):
+            rngs = spawn(self.rng, n_runs)
+        else:
+            rngs = [get_rng(int(seed)) for seed in seeds]
+        tasks = [(rng, num_part, num_traj, simulate_options) for rng in rngs]
+
+        # Same default as ProcessPoolExecutor
+        workers = workers or os.cpu_count() or 1
+        blocks = []
+        try:
+            u = _share_array(self.u, blocks)
+            y = _share_array(self.y, blocks)
+            with ProcessPoolExecutor(max_workers=workers,
+                                     initializer=_init_worker,
+                                     initargs=(self.model, u, y, instrument)) as pool:
+                chunksize = max(1, n_runs // (4 * workers))
+                res = list(pool.map(_run_worker, tasks, chunksize=chunksize))
+        finally:
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+
+        fmean = numpy.asarray([r[0] for r in res])
+        smean = None
+        if (res and res[0][1] is not None):
+            smean = numpy.asarray([r[1] for r in res])
+        logp_y = numpy.asarray([r[2] for r in res])
+        opcounts = [r[3] for r in res]
+        return (fmean, smean, logp_y, opcounts)
+
+    def simulate_replicates(self, num_part, num_rep, res=0.67, meas_first=False,
+                            resampler=None):
+        """
+        Run num_rep independent particle filters on the dataset, all the
+        replicates are propagated together using one array of
+        num_part*num_rep particles (see ReplicatedParticleFilter). Requires
+        a Markovian model with the particles stored in a numpy array.
+
+        Args:
+         - num_part (int): Number of particles in each replicate
+         - num_rep (int): Number of replicates
+         - res (float): resampling threshold for the filters
+         - meas_first (bool): Is the first measurement of the initial state
+           (true) or after the first time update? (false)
+         - resampler (string/callable): The resampling algorithm to use, see
+           'simulate'
+
+        Returns:
+         (array-like) the number of times each replicate was resampled
+        """
+        resamplings = numpy.zeros(num_rep, dtype=int)
+        self.rpf = ReplicatedParticleFilter(self.model, num_part, num_rep,
+                                            res, resampler=resampler,
+                                            rng=self.rng)
+
+        offset = 0
+        if (meas_first):
+            self.rpf.measure(self.y[0])
+            offset = 1
+        for i in range(offset, len(self.y)):
+            resamplings += self.rpf.forward(self.u[i - offset], self.y[i])
+        return resamplings
+
+    def get_replicated_mean(self):
+        """
+        Return the filtered mean of each replicate (must first have called
+        'simulate_replicates')
+
+        Returns:
+         - (T, K, D) array
+
+        T is the length of the dataset, K is the number of replicates and
+        D is the dimension of each particle
+        """
+        return self.rpf.get_filtered_mean()
+
+    def get_replicated_loglikelihood(self):
+        """
+        Return the estimate of log p(y_{0:T}) from each replicate (must first
+        have called 'simulate_replicates')
+
+        Returns:
+         - (K,) array
+        """
+        return numpy.copy(self.rpf.logp_y)
+
+    def get_loglikelihood(self):
+        """
+        Return the estimate of log p(y_{0:T}) from the forward filter (must
+        first have called 'simulate'), see ParticleTrajectory for its
+        properties for the different filters
+        """
+        return self.pt.logp_y
+
     def get_filtered_estimates(self):
         """
         Returns type (est, w) (must first have called 'simulate')
@@ -118,20 +535,31 @@ class Simulator():
          - w: (T,D) array containing all particle weights
 
         T is the length of the dataset, N is the number of particles and
-        D is the dimension of each particle
+        D is the dimension of each particle. Requires the number of particles
+        to be the same for all time steps.
         """
 
+        if (hasattr(self.pt.traj, 'part')):
+            # Array storage, no need to collect the data from each time step
+            est = numpy.copy(self.pt.traj.part)
+            w = self.pt.traj.w - numpy.max(self.pt.traj.w, 1)[:, numpy.newaxis]
+            w = numpy.exp(w)
+            w /= numpy.sum(w, 1)[:, numpy.newaxis]
+            return (est, w)
+
         T = len(self.pt.traj)
         N = self.pt.traj[0].pa.part.shape[0]
         D = self.pt.traj[0].pa.part.shape[1]
+        for t in range(T):
+            if (len(self.pt.traj[t].pa.part) != N):
+                raise ValueError('The number of particles varies over time')
 
         est = numpy.empty((T, N, D))
 
         w = numpy.empty((T, N))
 
         for t in range(T):
-            wtmp = numpy.exp(self.pt.traj[t].pa.w)
-            w[t] = wtmp / numpy.sum(wtmp)
+            w[t] = self.pt.traj[t].pa.get_normalized_weights()
             est[t] = self.pt.traj[t].pa.part
 
         return (est, w)
@@ -147,16 +575,19 @@ class Simulator():
         T is the length of the dataset, N is the number of particles and
         D is the dimension of each particle
         """
-        (est, w) = self.get_filtered_estimates()
+        if (not hasattr(self.pt.traj, 'part')):
+            # The number of particles might vary between the time steps
+            T = len(self.pt.traj)
+            D = self.pt.traj[0].pa.part.shape[1]
+            mean = numpy.empty((T, D))
+            for t in range(T):
+                pa = self.pt.traj[t].pa
+                mean[t] = pa.get_normalized_weights().dot(pa.part)
+            return mean
 
-        T = len(self.pt.traj)
-        D = self.pt.traj[0].pa.part.shape[1]
-
-        mean = numpy.empty((T, D))
-        for t in range(T):
-            mean[t] = numpy.sum((w[t].ravel() * est[t].T).T, 0)
+        (est, w) = self.get_filtered_estimates()
 
-        return mean
+        return numpy.sum(w[:, :, numpy.newaxis] * est, 1)
 
     def get_smoothed_estimates(self):
         """
@@ -182,4 +613,8 @@ class Simulator():
         T is the length of the dataset, N is the number of particles and
         D is the dimension of each particle
         """
+        if (self.straj.weighted):
+            # The weighted smoothers reuse the forward particles, the number
+            # of particles might vary between the time steps
+            return self.straj.get_smoothed_mean()
         return numpy.mean(self.get_smoothed_estimates(), 1)
@@ -6,14 +6,95 @@
 import numpy
 import pyparticleest.filter as pf
 import copy
+import scipy.special
 from pyparticleest.filter import ParticleApproximation, TrajectoryStep
+from pyparticleest.utils.resample import AliasTable
+from pyparticleest.utils.rng import get_rng, spawn
+from pyparticleest.utils.kdtree import KDTree
 
-def bsi_full(model, pa, ptraj, pind, future_trajs, find, ut, yt, tt, cur_ind):
+
+def _readahead(pt, t):
+    """ Let out-of-core storage prepare for backward access of time index t """
+    if hasattr(pt.traj, 'readahead'):
+        pt.traj.readahead(t)
+
+class BackwardCache(object):
+    """
+    Record of the log-densities logp(x_{t+1:T}^j|x_t^i) evaluated by the
+    rejection samplers, so that the exact fallback (bsi_full) only has to
+    evaluate the remaining particles for each future trajectory j.
+
+    Args:
+     - N (int): number of particles
+    """
+
+    def __init__(self, N):
+        self.N = N
+        self.keys = []
+        self.logp = []
+        self.table = None
+
+    def record(self, find, ind, logp):
+        """
+        Store the log-densities logp[k] = logp(x_{t+1:T}^{find[k]}|x_t^{ind[k]})
+        """
+        self.keys.append(numpy.asarray(find) * self.N + numpy.asarray(ind))
+        self.logp.append(numpy.asarray(logp, dtype=float))
+        self.table = None
+
+    def _build(self):
+        if (len(self.keys) > 0):
+            (keys, first) = numpy.unique(numpy.concatenate(self.keys),
+                                         return_index=True)
+            logp = numpy.concatenate(self.logp)[first]
+        else:
+            keys = numpy.empty(0, dtype=int)
+            logp = numpy.empty(0)
+        self.table = {}
+        if (len(keys) > 0):
+            find = keys // self.N
+            splits = numpy.flatnonzero(numpy.diff(find)) + 1
+            for (k, l) in zip(numpy.split(keys, splits), numpy.split(logp, splits)):
+                self.table[k[0] // self.N] = (k % self.N, l)
+
+    def get(self, j):
+        """
+        Return (ind, logp) the particle indices with a stored log-density for
+        the future trajectory j and the corresponding values
+        """
+        if (self.table is None):
+            self._build()
+        return self.table.get(j, (numpy.empty(0, dtype=int), numpy.empty(0)))
+
+    def mean_count(self, find):
+        """
+        Return the mean number of distinct particles with a stored
+        log-density for the future trajectories find
+        """
+        if (self.table is None):
+            self._build()
+        if (len(find) == 0):
+            return 0.0
+        return numpy.mean([len(self.get(j)[0]) for j in find])
+
+
+# Maximum number of elements in each block of log-densities evaluated by
+# bsi_full for models providing logp_xnext_full_batch
+BATCH_ELEMENTS = 2 ** 20
+
+
+def bsi_full(model, pa, ptraj, pind, future_trajs, find, ut, yt, tt, cur_ind,
+             rng=None, cache=None):
     """
     Perform backward simulation by drawing particles from
     the categorical distribution with weights given by
     \omega_{t|T}^i = \omega_{t|t}^i*p(x_{t+1}|x^i)
 
+    Models providing logp_xnext_full_batch get all the log-densities in
+    blocks of at most BATCH_ELEMENTS elements, and the indices for a whole
+    block are drawn at once by inverting the cumulative weights. Otherwise
+    the log-densities already stored in cache are reused.
+
     Args:
     - pa (ParticleApproximation): particles approximation from which to sample
     - model (FFBSi): model defining probability density function
@@ -21,27 +102,118 @@ def bsi_full(model, pa, ptraj, pind, future_trajs, find, ut, yt, tt, cur_ind):
     - ut (array-like): inputs signal for {t:T}
     - yt (array-like): measurements for {t:T}
     - tt (array-like): time stamps for {t:T}
+    - rng: random number generator, defaults to numpy.random
+    - cache (BackwardCache): log-densities already evaluated
     """
 
     M = len(find)
     N = len(pa.w)
     res = numpy.empty(M, dtype=int)
+    part = pf.to_working_precision(pa.part)
+    if hasattr(model, 'logp_xnext_full_batch'):
+        rng = get_rng(rng)
+        chunk = max(1, BATCH_ELEMENTS // N)
+        for start in range(0, M, chunk):
+            end = min(start + chunk, M)
+            p_next = model.logp_xnext_full_batch(part, ptraj, pind,
+                                                 future_trajs, find[start:end],
+                                                 ut=ut, yt=yt, tt=tt, cur_ind=cur_ind)
+            w = pa.w + p_next
+            w -= numpy.max(w, axis=1)[:, numpy.newaxis]
+            wc = numpy.cumsum(numpy.exp(w), axis=1)
+            u = rng.random_sample(end - start) * wc[:, -1]
+            ind = numpy.sum(wc <= u[:, numpy.newaxis], axis=1)
+            res[start:end] = numpy.minimum(ind, N - 1)
+        return res
+
     #pind = numpy.asarray(range(N))
     for j in range(M):
         currfind = find[j] * numpy.ones((N,), dtype=int)
-        p_next = model.logp_xnext_full(pa.part, ptraj, pind,
-                                       future_trajs, currfind,
-                                       ut=ut, yt=yt, tt=tt, cur_ind=cur_ind)
+        if (cache is None):
+            p_next = model.logp_xnext_full(part, ptraj, pind,
+                                           future_trajs, currfind,
+                                           ut=ut, yt=yt, tt=tt, cur_ind=cur_ind)
+        else:
+            (cind, clogp) = cache.get(find[j])
+            p_next = numpy.empty(N)
+            p_next[cind] = clogp
+            missing = numpy.ones(N, dtype=bool)
+            missing[cind] = False
+            if (numpy.any(missing)):
+                p_next[missing] = model.logp_xnext_full(part[missing], ptraj, pind[missing],
+                                                        future_trajs, currfind[missing],
+                                                        ut=ut, yt=yt, tt=tt, cur_ind=cur_ind)
 
         w = pa.w + p_next
         w = w - numpy.max(w)
         w_norm = numpy.exp(w)
         w_norm /= numpy.sum(w_norm)
-        res[j] = pf.sample(w_norm, 1)
+        res[j] = pf.sample(w_norm, 1, rng)
     return res
 
 
-def bsi_rs(model, pa, ptraj, pind, future_trajs, find, ut, yt, tt, cur_ind, maxpdf, max_iter):
+def bsi_kdtree(model, pa, ptraj, pind, future_trajs, find, ut, yt, tt, cur_ind,
+               eps=1e-3, leaf_size=16, rng=None):
+    """
+    Perform truncated backward simulation for models with a Gaussian
+    transition density with constant covariance, the particles are stored
+    in KD-trees and only the weights
+    \omega_{t|T}^i = \omega_{t|t}^i*p(x_{t+1}|x^i)
+    of nearby particles are evaluated (see pyparticleest.utils.kdtree).
+    Falls back to bsi_full if the model doesn't provide whiten_xnext.
+
+    Args:
+     - pa (ParticleApproximation): particles approximation from which to sample
+     - model (FFBSi): model defining probability density function
+     - future_trajs (array-like): trajectory estimate of {t+1:T}
+     - ut (array-like): inputs signal for {t:T}
+     - yt (array-like): measurements for {t:T}
+     - tt (array-like): time stamps for {t:T}
+     - eps (float): bound on the relative weight of the skipped particles
+     - leaf_size (int): number of particles in the leaves of the trees
+     - rng: random number generator, defaults to numpy.random
+    """
+    white = None
+    part = pf.to_working_precision(pa.part)
+    if hasattr(model, 'whiten_xnext'):
+        white = model.whiten_xnext(part, future_trajs[0].pa.part[find],
+                                   u=ut[cur_ind], t=tt[cur_ind])
+    if (white is None):
+        return bsi_full(model, pa, ptraj, pind, future_trajs, find, ut=ut, yt=yt,
+                        tt=tt, cur_ind=cur_ind, rng=rng)
+    (z, q, _logpdfmax) = white
+    ref = KDTree(z, leaf_size)
+    return ref.kernel_sample(KDTree(q, leaf_size), pa.w, eps, get_rng(rng))
+
+
+def _rs_cache(model, N):
+    """
+    Cache for the rejection samplers, None when bsi_full will evaluate all
+    the weights in batches anyway
+    """
+    if hasattr(model, 'logp_xnext_full_batch'):
+        return None
+    return BackwardCache(N)
+
+def _rs_proposal(pa, maxpdf):
+    """
+    Proposal distribution for the rejection samplers. With a bound for each
+    particle the proposals are drawn with probabilities proportional to
+    \omega_{t|t}^i*exp(maxpdf^i) so that particles with tighter bounds are
+    proposed less often, otherwise directly from the filter weights.
+
+    Returns:
+     (sampler, bound) the AliasTable to draw the proposals from and the bound
+     for each particle, None when maxpdf is a scalar
+    """
+    if (numpy.ndim(maxpdf) == 0):
+        return (pa.get_alias_table(), None)
+    bound = numpy.asarray(maxpdf, dtype=float)
+    lw = pa.w + bound
+    return (AliasTable(numpy.exp(lw - numpy.max(lw))), bound)
+
+def bsi_rs(model, pa, ptraj, pind, future_trajs, find, ut, yt, tt, cur_ind, maxpdf, max_iter,
+           rng=None):
     """
     Perform backward simulation by using rejection sampling to draw particles
     from the categorical distribution with weights given by
@@ -54,37 +226,43 @@ def bsi_rs(model, pa, ptraj, pind, future_trajs, find, ut, yt, tt, cur_ind, maxp
      - ut (array-like): inputs signal for {t:T}
      - yt (array-like): measurements for {t:T}
      - tt (array-like): time stamps for {t:T}
-     - maxpdf (float): argmax p(x_{t+1:T}|x_t)
+     - maxpdf (float): argmax p(x_{t+1:T}|x_t), or (array-like) one bound
+       for each particle (see logp_xnext_max_full_particles)
      - max_iter (int): number of attempts before falling back to bsi_full
+     - rng: random number generator, defaults to numpy.random
     """
+    rng = get_rng(rng)
 
     M = len(find)
     todo = numpy.asarray(range(M))
     res = numpy.empty(M, dtype=int)
-    weights = numpy.copy(pa.w)
-    weights -= numpy.max(weights)
-    weights = numpy.exp(weights)
-    weights /= numpy.sum(weights)
+    (sampler, bound) = _rs_proposal(pa, maxpdf)
+    cache = _rs_cache(model, len(pa))
     for _i in range(max_iter):
 
-        ind = numpy.random.permutation(pf.sample(weights, len(todo)))
-        pn = model.logp_xnext_full(pa.part[ind], ptraj, pind[ind],
+        ind = sampler.sample(len(todo), rng)
+        pn = model.logp_xnext_full(pf.to_working_precision(pa.part[ind]), ptraj, pind[ind],
                                    future_trajs, todo,
                                    ut=ut, yt=yt, tt=tt, cur_ind=cur_ind)
-        test = numpy.log(numpy.random.uniform(size=len(todo)))
-        accept = test < pn - maxpdf
+        test = numpy.log(rng.uniform(size=len(todo)))
+        if (bound is not None):
+            accept = test < pn - bound[ind]
+        else:
+            accept = test < pn - maxpdf
         res[todo[accept]] = ind[accept]
+        if (cache is not None):
+            cache.record(todo[~accept], ind[~accept], pn[~accept])
         todo = todo[~accept]
         if (len(todo) == 0):
             return res
 
-    # TODO, is there an efficient way to store those weights
-    # already calculated to avoid double work, or will that
-    # take more time than simply evaulating them all again?
-    res[todo] = bsi_full(model, pa, ptraj, pind, future_trajs, todo, ut=ut, yt=yt, tt=tt, cur_ind=cur_ind)
+    # Reuse the weights already calculated for the rejected proposals
+    res[todo] = bsi_full(model, pa, ptraj, pind, future_trajs, todo, ut=ut, yt=yt, tt=tt, cur_ind=cur_ind,
+                         rng=rng, cache=cache)
     return res
 
-def bsi_rsas(model, pa, ptraj, pind, future_trajs, find, ut, yt, tt, cur_ind, maxpdf, x1, P1, sv, sw, ratio):
+def bsi_rsas(model, pa, ptraj, pind, future_trajs, find, ut, yt, tt, cur_ind, maxpdf, x1, P1, sv, sw, ratio,
+             rng=None):
     """
     Perform backward simulation by using rejection sampling to draw particles
     from the categorical distribution with weights given by
@@ -104,38 +282,50 @@ def bsi_rsas(model, pa, ptraj, pind, future_trajs, find, ut, yt, tt, cur_ind, ma
      - ut (array-like): inputs signal for {t:T}
      - yt (array-like): measurements for {t:T}
      - tt (array-like): time stamps for {t:T}
-     - maxpdf (float): argmax p(x_{t+1:T}|x_t)
+     - maxpdf (float): argmax p(x_{t+1:T}|x_t), or (array-like) one bound
+       for each particle (see logp_xnext_max_full_particles)
      - x1 (float): initial state of Kalman filter
      - P1 (float): initial covariance of Kalman filter estimate
      - sv (float): process noise (for Kalman filter)
      - sw (float): measurement noise (for Kalman filter)
      - ratio (float): cost ration of running rejection sampling compared to
-       switching to the full bsi (D_0 / D_1)
+       switching to the full bsi (D_0 / D_1), the cost of the full bsi only
+       includes the weights not already evaluated (see BackwardCache)
+     - rng: random number generator, defaults to numpy.random
     """
+    rng = get_rng(rng)
     M = len(find)
     todo = numpy.asarray(range(M))
     res = numpy.empty(M, dtype=int)
-    weights = numpy.copy(pa.w)
-    weights -= numpy.max(weights)
-    weights = numpy.exp(weights)
-    weights /= numpy.sum(weights)
+    (sampler, bound) = _rs_proposal(pa, maxpdf)
     pk = x1
     Pk = P1
-    stop_criteria = ratio / len(pa)
+    N = len(pa)
+    cache = _rs_cache(model, N)
     while (True):
 
-        ind = numpy.random.permutation(pf.sample(weights, len(todo)))
-        pn = model.logp_xnext_full(pa.part[ind], ptraj, pind[ind],
+        ind = sampler.sample(len(todo), rng)
+        pn = model.logp_xnext_full(pf.to_working_precision(pa.part[ind]), ptraj, pind[ind],
                                    future_trajs, todo,
                                    ut=ut, yt=yt, tt=tt, cur_ind=cur_ind)
-        test = numpy.log(numpy.random.uniform(size=len(todo)))
-        accept = test < pn - maxpdf
+        test = numpy.log(rng.uniform(size=len(todo)))
+        if (bound is not None):
+            accept = test < pn - bound[ind]
+        else:
+            accept = test < pn - maxpdf
         ak = numpy.sum(accept)
         mk = len(todo)
         res[todo[accept]] = ind[accept]
+        if (cache is not None):
+            cache.record(todo[~accept], ind[~accept], pn[~accept])
         todo = todo[~accept]
         if (len(todo) == 0):
             return res
+        # The fallback only evaluates the weights that are not already cached
+        cost_full = N
+        if (cache is not None):
+            cost_full = max(N - cache.mean_count(todo), 1.0)
+        stop_criteria = ratio / cost_full
         # meas update for adaptive stop
         mk2 = mk * mk
         sw2 = sw * sw
@@ -147,10 +337,12 @@ def bsi_rsas(model, pa, ptraj, pind, future_trajs, find, ut, yt, tt, cur_ind, ma
         if (pk < stop_criteria):
             break
 
-    res[todo] = bsi_full(model, pa, ptraj, pind, future_trajs, todo, ut=ut, yt=yt, tt=tt, cur_ind=cur_ind)
+    res[todo] = bsi_full(model, pa, ptraj, pind, future_trajs, todo, ut=ut, yt=yt, tt=tt, cur_ind=cur_ind,
+                         rng=rng, cache=cache)
     return res
 
-def bsi_mcmc(model, pa, ptraj, pind, future_trajs, find, ut, yt, tt, cur_ind, R, ancestors):
+def bsi_mcmc(model, pa, ptraj, pind, future_trajs, find, ut, yt, tt, cur_ind, R, ancestors,
+             rng=None):
     """
     Perform backward simulation by using Metropolis-Hastings to draw particles
     from the categorical distribution with weights given by
@@ -165,34 +357,89 @@ def bsi_mcmc(model, pa, ptraj, pind, future_trajs, find, ut, yt, tt, cur_ind, R,
      - tt (array-like): time stamps for {t:T}
      - R (int): number of iterations to run the markov chain
      - ancestor (array-like): ancestor of each particle from the particle filter
+     - rng: random number generator, defaults to numpy.random
     """
+    rng = get_rng(rng)
     # Perform backward simulation using an MCMC sampler proposing new
     # backward particles, initialized with the filtered trajectory
 
     M = len(find)
     ind = ancestors
-    weights = numpy.copy(pa.w)
-    weights -= numpy.max(weights)
-    weights = numpy.exp(weights)
-    weights /= numpy.sum(weights)
+    sampler = pa.get_alias_table()
 
-    pcurr = model.logp_xnext_full(pa.part[ind], ptraj, pind[ind],
+    pcurr = model.logp_xnext_full(pf.to_working_precision(pa.part[ind]), ptraj, pind[ind],
                                   future_trajs, find,
                                   ut=ut, yt=yt, tt=tt, cur_ind=cur_ind)
     for _j in range(R):
-        propind = numpy.random.permutation(pf.sample(weights, M))
-        pprop = model.logp_xnext_full(pa.part[propind], ptraj, pind[propind],
+        propind = sampler.sample(M, rng)
+        pprop = model.logp_xnext_full(pf.to_working_precision(pa.part[propind]), ptraj, pind[propind],
                                    future_trajs, find,
                                    ut=ut, yt=yt, tt=tt, cur_ind=cur_ind)
         diff = pprop - pcurr
         diff[diff > 0.0] = 0.0
-        test = numpy.log(numpy.random.uniform(size=M))
+        test = numpy.log(rng.uniform(size=M))
         accept = test < diff
         ind[accept] = propind[accept]
         pcurr[accept] = pprop[accept]
 
     return ind
 
+def backward_information_filter(model, N, u, y, t, rng=None):
+    """
+    Run the backward information filter of the generalized two-filter
+    smoother, the particles target the artificial distribution
+    p~(x_t|y_{t:T}) proportional to gamma_t(x_t)*p(y_{t:T}|x_t), see
+    interfaces.TwoFilterSmoothing. The filter only depends on the dataset,
+    so it can run concurrently with the forward filter. Each step resamples
+    the particles at t+1 and proposes x_t from q(x_t|x_{t+1}, y_t) with the
+    weights
+
+    \omega~_t^i = p(y_t|x_t^i)*p(x_{t+1}^i|x_t^i)*gamma_t(x_t^i) /
+                (gamma_{t+1}(x_{t+1}^i)*q(x_t^i|x_{t+1}^i, y_t))
+
+    Args:
+     - model (TwoFilterSmoothing): model definition
+     - N (int): number of particles
+     - u (array-like): input signals for {0:T}
+     - y (array-like): measurements for {0:T}, None for missing measurements
+     - t (array-like): time stamps for {0:T}
+     - rng: random number generator, defaults to numpy.random
+
+    Returns:
+     (list) of ParticleApproximations for {0:T}
+    """
+    rng = get_rng(rng)
+    T = len(y)
+    res = [None] * T
+    part = model.sample_artificial_prior(N, t[T - 1])
+    lw = numpy.zeros(N)
+    if (pf.has_measurement(y[T - 1])):
+        lw += model.measure(particles=part, y=y[T - 1], t=t[T - 1])
+    res[T - 1] = ParticleApproximation(part, lw)
+    for cur_ind in reversed(range(T - 1)):
+        ind = pf.sample(res[cur_ind + 1].get_normalized_weights(), N, rng)
+        nxt = res[cur_ind + 1].part[ind]
+        part = model.propose_backward(nxt, u=u[cur_ind], y=y[cur_ind], t=t[cur_ind])
+        lw = (model.logp_xnext(particles=part, next_part=nxt, u=u[cur_ind], t=t[cur_ind]) +
+              model.logp_artificial_prior(part, t[cur_ind]) -
+              model.logp_artificial_prior(nxt, t[cur_ind + 1]) -
+              model.logp_propose_backward(part, nxt, u=u[cur_ind], y=y[cur_ind],
+                                          t=t[cur_ind]))
+        if (pf.has_measurement(y[cur_ind])):
+            lw += model.measure(particles=part, y=y[cur_ind], t=t[cur_ind])
+        res[cur_ind] = ParticleApproximation(part, lw)
+    return res
+
+# Smoother and forward trajectory shared with the forked workers of
+# SmoothTrajectory.perform_bsi_parallel
+_bsi_shared = {}
+
+
+def _run_bsi_part(task):
+    (M, method, options, rng) = task
+    return _bsi_shared['straj'].perform_bsi_part(_bsi_shared['pt'], M, method,
+                                                 options, rng)
+
 class SmoothTrajectory(object):
     """
     Create smoothed trajectory from filtered trajectory
@@ -203,21 +450,48 @@ class SmoothTrajectory(object):
      - M (int): Number of smoothed trajectories to create
      - method (string): Smoothing method to use
      - options (dict): options to pass on to the smoothing algorithm
+     - rng: random number generator, defaults to the one used by the
+       forward filter. See pyparticleest.utils.rng
+
+    The 'ffbsm' and 'twofilter' methods compute weighted marginal smoothing
+    distributions instead of trajectories, M is then ignored and the weights
+    are given by get_smoothed_weights.
+
+    The backward simulation methods ('full', 'mcmc', 'rs', 'rsas' and
+    'kdtree') accept the options 'workers', the number of workers the
+    M trajectories are divided between (default 1), and 'pool', 'process'
+    (default) or 'thread', see perform_bsi_parallel.
     """
 
-    def __init__(self, pt, M=1, method='full', options=None):
+    def __init__(self, pt, M=1, method='full', options=None, rng=None):
 
         self.traj = None
+        if (rng is None):
+            rng = pt.pf.rng
+        self.rng = get_rng(rng)
 
-        self.u = numpy.copy(pt.uvec)
-        self.y = numpy.copy(pt.yvec)
-        self.t = numpy.copy(pt.tvec)
+        self.u = numpy.copy(pt.uvec[:len(pt)])
+        self.y = numpy.copy(pt.yvec[:len(pt)])
+        self.t = numpy.copy(pt.tvec[:len(pt)])
         self.M = M
 
         self.model = pt.pf.model
+        self.weighted = False
         if (method == 'full' or method == 'mcmc' or method == 'rs' or
-            method == 'rsas'):
-            self.perform_bsi(pt=pt, M=M, method=method, options=options)
+            method == 'rsas' or method == 'kdtree'):
+            workers = 1
+            if (options is not None):
+                workers = options.get('workers', 1)
+            if (workers > 1 and M > 1):
+                self.perform_bsi_parallel(pt=pt, M=M, method=method,
+                                          options=options, workers=workers,
+                                          pool=options.get('pool', 'process'))
+            else:
+                self.perform_bsi(pt=pt, M=M, method=method, options=options)
+        elif (method == 'ffbsm'):
+            self.perform_ffbsm(pt=pt, options=options)
+        elif (method == 'twofilter'):
+            self.perform_twofilter(pt=pt, options=options)
         elif (method == 'ancestor'):
             self.perform_ancestors(pt=pt, M=M)
         elif (method == 'mhips' or method == 'mhips_reduced'):
@@ -285,10 +559,11 @@ class SmoothTrajectory(object):
 
         for t in reversed(range(T - 1)):
 
+            _readahead(pt, t)
             ind = ancestors
             ancestors = pt[t].ancestors[ind]
             # Select 'previous' particle
-            traj[t] = TrajectoryStep(ParticleApproximation(self.model.sample_smooth(part=pt[t].pa.part[ind],
+            traj[t] = TrajectoryStep(ParticleApproximation(self.model.sample_smooth(part=pf.to_working_precision(pt[t].pa.part[ind]),
                                                           ptraj=pt[:t],
                                                           anc=ancestors,
                                                           future_trajs=traj[(t + 1):],
@@ -310,11 +585,8 @@ class SmoothTrajectory(object):
          - M (int): number of trajectories to createa
         """
 
-        tmp = numpy.copy(pt[-1].pa.w)
-        tmp -= numpy.max(tmp)
-        tmp = numpy.exp(tmp)
-        tmp = tmp / numpy.sum(tmp)
-        ind = pf.sample(tmp, M)
+        tmp = pt[-1].pa.get_normalized_weights()
+        ind = pf.sample(tmp, M, self.rng)
 
         return self.calculate_ancestors(pt, ind)
 
@@ -330,11 +602,8 @@ class SmoothTrajectory(object):
         """
 
         # Sample from end time estimates
-        tmp = numpy.copy(pt[-1].pa.w)
-        tmp -= numpy.max(tmp)
-        tmp = numpy.exp(tmp)
-        tmp = tmp / numpy.sum(tmp)
-        ind = pf.sample(tmp, M)
+        tmp = pt[-1].pa.get_normalized_weights()
+        ind = pf.sample(tmp, M, self.rng)
         ancestors = pt[-1].ancestors[ind]
         last_part = self.model.sample_smooth(part=pt[-1].pa.part[ind],
                                              ptraj=pt[:-1], anc=ancestors,
@@ -351,6 +620,11 @@ class SmoothTrajectory(object):
             pass
         elif (method == 'rs'):
             max_iter = options['R']
+        elif (method == 'kdtree'):
+            if (options is None):
+                options = {}
+            eps = options.get('eps', 1e-3)
+            leaf_size = options.get('leaf_size', 16)
         elif (method == 'rsas'):
             x1 = options['x1']
             P1 = options['P1']
@@ -360,10 +634,11 @@ class SmoothTrajectory(object):
         else:
             raise ValueError('Unknown sampler: %s' % method)
 
-        find = numpy.arange(M, dtype=numpy.int)
+        find = numpy.arange(M, dtype=int)
 
         for cur_ind in reversed(range(len(pt) - 1)):
 
+            _readahead(pt, cur_ind)
             ft = self.traj[(cur_ind + 1):]
             ut = self.u
             yt = self.y
@@ -375,33 +650,42 @@ class SmoothTrajectory(object):
                              ft, find,
                              ut=ut, yt=yt, tt=tt, cur_ind=cur_ind,
                              maxpdf=options['maxpdf'][cur_ind],
-                             max_iter=int(max_iter))
+                             max_iter=int(max_iter), rng=self.rng)
             elif (method == 'rsas'):
                 ind = bsi_rsas(self.model, pt[cur_ind].pa,
                                pt[:cur_ind], pt[cur_ind].ancestors,
                                ft, find,
                                ut=ut, yt=yt, tt=tt, cur_ind=cur_ind,
                                maxpdf=options['maxpdf'][cur_ind], x1=x1,
-                               P1=P1, sv=sv, sw=sw, ratio=ratio)
+                               P1=P1, sv=sv, sw=sw, ratio=ratio,
+                               rng=self.rng)
             elif (method == 'mcmc'):
                 ind = bsi_mcmc(self.model, pt[cur_ind].pa,
                                pt[:cur_ind], pt[cur_ind].ancestors,
                                ft, find,
                                ut=ut, yt=yt, tt=tt, cur_ind=cur_ind,
-                               R=options['R'], ancestors=ancestors)
+                               R=options['R'], ancestors=ancestors,
+                               rng=self.rng)
                 ancestors = pt[cur_ind].ancestors[ind]
             elif (method == 'full'):
                 ind = bsi_full(self.model, pt[cur_ind].pa,
                                pt[:cur_ind], pt[cur_ind].ancestors,
                                ft, find,
-                               ut=ut, yt=yt, tt=tt, cur_ind=cur_ind)
+                               ut=ut, yt=yt, tt=tt, cur_ind=cur_ind,
+                               rng=self.rng)
+            elif (method == 'kdtree'):
+                ind = bsi_kdtree(self.model, pt[cur_ind].pa,
+                                 pt[:cur_ind], pt[cur_ind].ancestors,
+                                 ft, find,
+                                 ut=ut, yt=yt, tt=tt, cur_ind=cur_ind,
+                                 eps=eps, leaf_size=leaf_size, rng=self.rng)
             elif (method == 'ancestor'):
                 ind = ancestors
 
             ancestors = pt[cur_ind].ancestors[ind]
             # Select 'previous' particle
             find = numpy.arange(M, dtype=int)
-            tmp = self.model.sample_smooth(part=pt[cur_ind].pa.part[ind],
+            tmp = self.model.sample_smooth(part=pf.to_working_precision(pt[cur_ind].pa.part[ind]),
                                            ptraj=pt[:cur_ind],
                                            anc=ancestors,
                                            future_trajs=ft,
@@ -418,6 +702,217 @@ class SmoothTrajectory(object):
 #            self.traj = self.model.post_smoothing(self)
 
 
+    def perform_bsi_part(self, pt, M, method, options, rng):
+        """
+        Run perform_bsi for M trajectories on a copy of the smoother using
+        the random number generator rng. The model is deep-copied, so it can
+        be given the same generator and any internal state of the model isn't
+        shared between the threads of perform_bsi_parallel.
+
+        Returns:
+         (array-like) the smoothed trajectories
+        """
+        straj = copy.copy(self)
+        straj.rng = rng
+        straj.model = copy.deepcopy(self.model)
+        straj.model.rng = rng
+        straj.perform_bsi(pt=pt, M=M, method=method, options=options)
+        return straj.traj
+
+    def perform_bsi_parallel(self, pt, M, method, options, workers, pool='process'):
+        """
+        Create smoothed trajectories using Backward Simulation, the M
+        trajectories are conditionally independent given the forward
+        estimates so they are divided between a pool of workers, each using an
+        independent stream spawned from the random number generator of the
+        smoother (see pyparticleest.utils.rng.spawn).
+
+        With a process pool the workers are forked so the forward estimates
+        are shared instead of copied, only the smoothed trajectories are
+        transferred back. When forking isn't supported, or the trajectory is
+        stored in a MemmapTrajectory (whose background reader thread and
+        lock must not be forked), a thread pool is used instead, which only
+        helps for models that release the GIL (e.g. large numpy operations).
+
+        Args:
+         - pt (ParticleTrajectory): forward trajetories
+         - M (int): number of trajectories to create
+         - method (string): Type of backward simulation to use
+         - options (dict): Parameters to the backward simulator
+         - workers (int): number of workers
+         - pool (string): 'process' or 'thread'
+        """
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+        workers = min(workers, M)
+        sizes = numpy.diff(numpy.linspace(0, M, workers + 1).astype(int))
+        rngs = spawn(self.rng, workers)
+        tasks = [(int(sizes[k]), method, options, rngs[k]) for k in range(workers)]
+
+        if (pool == 'process' and
+            ('fork' not in multiprocessing.get_all_start_methods() or
+             hasattr(pt.traj, 'readahead'))):
+            pool = 'thread'
+        if (pool == 'process'):
+            _bsi_shared['straj'] = self
+            _bsi_shared['pt'] = pt
+            try:
+                ctx = multiprocessing.get_context('fork')
+                with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as ex:
+                    parts = list(ex.map(_run_bsi_part, tasks))
+            finally:
+                _bsi_shared.clear()
+        elif (pool == 'thread'):
+            with ThreadPoolExecutor(max_workers=workers) as ex:
+                parts = list(ex.map(lambda task: self.perform_bsi_part(pt, *task),
+                                    tasks))
+        else:
+            raise ValueError('Unknown pool: %s' % pool)
+
+        T = len(pt)
+        self.traj = numpy.empty((T,), dtype=object)
+        for t in range(T):
+            part = numpy.concatenate([traj[t].pa.part for traj in parts])
+            self.traj[t] = TrajectoryStep(ParticleApproximation(part),
+                                          numpy.arange(M, dtype=int))
+
+    def perform_ffbsm(self, pt, options):
+        """
+        Compute the marginal smoothing distributions using forward filtering
+        backward smoothing (FFBSm). The filtered particles are reused with
+        the weights
+
+        \omega_{t|T}^i = \omega_{t|t}^i * \sum_j \omega_{t+1|T}^j p(x_{t+1}^j|x_t^i) /
+                       \sum_k \omega_{t|t}^k p(x_{t+1}^j|x_t^k)
+
+        For models providing whiten_xnext both sums are evaluated using
+        KD-trees (see pyparticleest.utils.kdtree), otherwise all the N^2
+        densities are evaluated.
+
+        Args:
+         - pt (ParticleTrajectory): forward trajetories
+         - options (dict): 'eps' bound on the relative error of the sums
+           (default 1e-3, 0 for exact evaluation), 'leaf_size' number of
+           particles in the leaves of the trees (default 16)
+        """
+        if (options is None):
+            options = {}
+        eps = options.get('eps', 1e-3)
+        leaf_size = options.get('leaf_size', 16)
+
+        T = len(pt)
+        self.weighted = True
+        self.traj = numpy.empty((T,), dtype=object)
+        lw = pt[T - 1].pa.w - scipy.special.logsumexp(pt[T - 1].pa.w)
+        part = pf.to_working_precision(pt[T - 1].pa.part)
+        self.traj[T - 1] = TrajectoryStep(ParticleApproximation(part, lw),
+                                          numpy.arange(len(lw), dtype=int))
+        for cur_ind in reversed(range(T - 1)):
+            _readahead(pt, cur_ind)
+            pa = pt[cur_ind].pa
+            nxt = part
+            part = pf.to_working_precision(pa.part)
+            N = len(part)
+            white = None
+            if hasattr(self.model, 'whiten_xnext'):
+                white = self.model.whiten_xnext(part, nxt, u=self.u[cur_ind],
+                                                t=self.t[cur_ind])
+            if (white is not None):
+                # The normalization constant of the density cancels
+                (z, q, _logpdfmax) = white
+                ztree = KDTree(z, leaf_size)
+                qtree = KDTree(q, leaf_size)
+                lden = ztree.kernel_sum(qtree, pa.w, eps)
+                lsum = qtree.kernel_sum(ztree, lw - lden, eps)
+            else:
+                logp = numpy.empty((len(nxt), N))
+                for j in range(len(nxt)):
+                    logp[j] = self.model.logp_xnext_singlestep(part=part,
+                                                               past_trajs=pt[:cur_ind],
+                                                               pind=pt[cur_ind].ancestors,
+                                                               future_parts=nxt,
+                                                               find=j * numpy.ones((N,), dtype=int),
+                                                               ut=self.u, yt=self.y,
+                                                               tt=self.t, cur_ind=cur_ind)
+                lden = scipy.special.logsumexp(pa.w + logp, axis=1)
+                lsum = scipy.special.logsumexp((lw - lden)[:, numpy.newaxis] + logp,
+                                               axis=0)
+            lw = pa.w + lsum
+            lw -= scipy.special.logsumexp(lw)
+            self.traj[cur_ind] = TrajectoryStep(ParticleApproximation(part, lw),
+                                                numpy.arange(N, dtype=int))
+
+    def perform_twofilter(self, pt, options):
+        """
+        Compute the marginal smoothing distributions using the generalized
+        two-filter smoother. The filtered particles are reused with the weights
+
+        \omega_{t|T}^i = \omega_{t|t}^i * \sum_j \omega~_{t+1}^j p(x~_{t+1}^j|x_t^i) /
+                       gamma_{t+1}(x~_{t+1}^j)
+
+        where x~_{t+1}^j are the particles of the backward information filter
+        (see backward_information_filter). Each time step only depends on the
+        forward and backward filters, not on the other smoothed estimates.
+        For models providing whiten_xnext the sums are evaluated using
+        KD-trees (see pyparticleest.utils.kdtree), otherwise all the N^2
+        densities are evaluated.
+
+        Args:
+         - pt (ParticleTrajectory): forward trajetories
+         - options (dict): 'backward' precomputed output of
+           backward_information_filter (by default it is computed here),
+           'N' number of particles in the backward filter (default is the
+           same as the forward filter), 'eps' and 'leaf_size' (see 'ffbsm')
+        """
+        if (options is None):
+            options = {}
+        eps = options.get('eps', 1e-3)
+        leaf_size = options.get('leaf_size', 16)
+
+        T = len(pt)
+        backward = options.get('backward', None)
+        if (backward is None):
+            y = [self.y[k] if pt.ymask[k] else None for k in range(T)]
+            N = options.get('N', len(pt[T - 1].pa))
+            backward = backward_information_filter(self.model, N, self.u, y,
+                                                   self.t, rng=self.rng)
+        if (len(backward) != T):
+            raise ValueError('The backward filter does not match the dataset')
+
+        self.weighted = True
+        self.traj = numpy.empty((T,), dtype=object)
+        lw = pt[T - 1].pa.w - scipy.special.logsumexp(pt[T - 1].pa.w)
+        part = pf.to_working_precision(pt[T - 1].pa.part)
+        self.traj[T - 1] = TrajectoryStep(ParticleApproximation(part, lw),
+                                          numpy.arange(len(lw), dtype=int))
+        for cur_ind in reversed(range(T - 1)):
+            _readahead(pt, cur_ind)
+            pa = pt[cur_ind].pa
+            part = pf.to_working_precision(pa.part)
+            N = len(part)
+            nxt = backward[cur_ind + 1].part
+            lwn = (backward[cur_ind + 1].w -
+                   self.model.logp_artificial_prior(nxt, self.t[cur_ind + 1]))
+            white = None
+            if hasattr(self.model, 'whiten_xnext'):
+                white = self.model.whiten_xnext(part, nxt, u=self.u[cur_ind],
+                                                t=self.t[cur_ind])
+            if (white is not None):
+                (z, q, _logpdfmax) = white
+                lsum = KDTree(q, leaf_size).kernel_sum(KDTree(z, leaf_size), lwn, eps)
+            else:
+                logp = numpy.empty((len(nxt), N))
+                for j in range(len(nxt)):
+                    logp[j] = self.model.logp_xnext(particles=part,
+                                                    next_part=nxt[j * numpy.ones((N,), dtype=int)],
+                                                    u=self.u[cur_ind], t=self.t[cur_ind])
+                lsum = scipy.special.logsumexp(lwn[:, numpy.newaxis] + logp, axis=0)
+            lw = pa.w + lsum
+            lw -= scipy.special.logsumexp(lw)
+            self.traj[cur_ind] = TrajectoryStep(ParticleApproximation(part, lw),
+                                                numpy.arange(N, dtype=int))
+
     def perform_mhbp(self, pt, M, R, reduced=False):
         """
         Create smoothed trajectories using Metropolis-Hastings Backward Propeser
@@ -434,11 +929,8 @@ class SmoothTrajectory(object):
         straj = numpy.empty((T,), dtype=object)
 
         # Initialise from end time estimates
-        tmp = numpy.copy(pt[-1].pa.w)
-        tmp -= numpy.max(tmp)
-        tmp = numpy.exp(tmp)
-        tmp = tmp / numpy.sum(tmp)
-        cind = pf.sample(tmp, M)
+        tmp = pt[-1].pa.get_normalized_weights()
+        cind = pf.sample(tmp, M, self.rng)
         find = numpy.arange(M, dtype=int)
 #        anc = pt[-1].ancestors[cind]
 #        last_part = self.model.sample_smooth(part=pt[-1].pa.part[cind],
@@ -451,6 +943,7 @@ class SmoothTrajectory(object):
 
         for t in reversed(range(T)):
 
+            _readahead(pt, t)
             # Initialise from filtered estimate
             if (t < T - 1):
                 ft = straj[(t + 1):]
@@ -458,13 +951,10 @@ class SmoothTrajectory(object):
                 ft = None
 
             # Initialize with filterted estimates
-            pnew = pt[t].pa.part[cind]
+            pnew = pf.to_working_precision(pt[t].pa.part[cind])
             if (t > 0):
                 anc = pt[t].ancestors[cind]
-                tmp = numpy.copy(pt[t - 1].pa.w)
-                tmp -= numpy.max(tmp)
-                tmp = numpy.exp(tmp)
-                tmp = tmp / numpy.sum(tmp)
+                sampler = pt[t - 1].pa.get_alias_table()
                 ptraj = pt[:t]
             else:
                 ptraj = None
@@ -473,7 +963,7 @@ class SmoothTrajectory(object):
 
                 if (t > 0):
                     # Propose new ancestors
-                    panc = pf.sample(tmp, M)
+                    panc = sampler.sample(M, self.rng)
 
 
                 (pnew, acc) = mc_step(model=self.model,
@@ -487,7 +977,7 @@ class SmoothTrajectory(object):
                                       yt=yt,
                                       tt=tt,
                                       cur_ind=t,
-                                      reduced=reduced)
+                                      reduced=reduced, rng=self.rng)
 
                 anc[acc] = panc[acc]
 
@@ -523,7 +1013,7 @@ class SmoothTrajectory(object):
         ut = self.u
         yt = self.y
         tt = self.t
-        pind = numpy.arange(self.M, dtype=numpy.int)
+        pind = numpy.arange(self.M, dtype=int)
 
         straj = numpy.empty((T,), dtype=object)
         pt = self.traj[:T - 1]
@@ -534,7 +1024,7 @@ class SmoothTrajectory(object):
                               pind_curr=pind,
                               future_trajs=None, find=pind,
                               ut=ut, yt=yt, tt=tt, cur_ind=T - 1,
-                              reduced=reduced)
+                              reduced=reduced, rng=self.rng)
 
         tmp = numpy.copy(self.model.sample_smooth(part=part,
                                                   ptraj=pt,
@@ -558,7 +1048,7 @@ class SmoothTrajectory(object):
                                    pind_curr=pind,
                                    future_trajs=ft, find=pind,
                                    ut=ut, yt=yt, tt=tt, cur_ind=i,
-                                   reduced=reduced)
+                                   reduced=reduced, rng=self.rng)
 
             # The data dimension is not necessarily the same, since self.traj
             # contains data that has been processed by "post_smoothing".
@@ -590,7 +1080,7 @@ class SmoothTrajectory(object):
                                future_trajs=ft,
                                find=pind,
                                ut=ut, yt=yt, tt=tt, cur_ind=0,
-                               reduced=reduced)
+                               reduced=reduced, rng=self.rng)
 
         tmp = self.model.sample_smooth(part,
                                        ptraj=None,
@@ -606,6 +1096,44 @@ class SmoothTrajectory(object):
 
         return straj
 
+    def get_smoothed_weights(self):
+        """
+        Return the normalized weights of the smoothed estimates, uniform
+        except for the 'ffbsm' and 'twofilter' methods
+
+        Returns:
+         - (T, N) array
+
+        Requires the number of particles to be the same for all time steps,
+        see get_smoothed_mean otherwise.
+        """
+        self._check_constant_N()
+        return numpy.vstack([self.traj[t].pa.get_normalized_weights()
+                             for t in range(len(self.traj))])
+
+    def _check_constant_N(self):
+        N = len(self.traj[0].pa.part)
+        for t in range(len(self.traj)):
+            if (len(self.traj[t].pa.part) != N):
+                raise ValueError('The number of particles varies over time')
+
+    def get_smoothed_mean(self):
+        """
+        Return the (weighted) mean of the smoothed estimates, the number of
+        particles may vary over time ('ffbsm' and 'twofilter' reuse the
+        particles of the forward filter)
+
+        Returns:
+         - (T, D) array
+        """
+        T = len(self.traj)
+        D = self.traj[0].pa.part.shape[1]
+        mean = numpy.empty((T, D))
+        for t in range(T):
+            pa = self.traj[t].pa
+            mean[t] = pa.get_normalized_weights().dot(pa.part)
+        return mean
+
     def get_smoothed_estimates(self):
         """
         Return smoothed estimates (must first have called 'simulate')
@@ -615,8 +1143,10 @@ class SmoothTrajectory(object):
 
         T is the length of the dataset,
         N is the number of particles
-        D is the dimension of each particle
+        D is the dimension of each particle. Requires the number of particles
+        to be the same for all time steps.
         """
+        self._check_constant_N()
         T = len(self.traj)
         N = self.traj[0].pa.part.shape[0]
         D = self.traj[0].pa.part.shape[1]
@@ -630,7 +1160,7 @@ class SmoothTrajectory(object):
 
 
 def mc_step(model, part, ptraj, pind_prop, pind_curr, future_trajs, find,
-            ut, yt, tt, cur_ind, reduced):
+            ut, yt, tt, cur_ind, reduced, rng=None):
     """
     Perform a single iteration of the MCMC sampler used for MHIPS and MHBP
 
@@ -645,12 +1175,14 @@ def mc_step(model, part, ptraj, pind_prop, pind_curr, future_trajs, find,
      - ut (array-like): input at time t
      - tt (array-like): timestamp at time t
      - future_trajs (array-like): particle approximations of {x_{t+1:T|T}}
+     - rng: random number generator, defaults to numpy.random
     """
+    rng = get_rng(rng)
     # The previously stored values for part already include the measurment from
     # cur_ind, we therefore need to recomputed the sufficient statistics
     # (for Rao-Blackwellized models)
     if (not ptraj is None):
-        oldpart = numpy.copy(ptraj[-1].pa.part[pind_curr])
+        oldpart = pf.to_working_precision(numpy.copy(ptraj[-1].pa.part[pind_curr]))
         part = model.cond_predict_single_step(part=oldpart, past_trajs=ptraj[:-1],
                                               pind=ptraj[-1].ancestors[pind_curr],
                                               future_parts=part, find=numpy.arange(len(pind_curr)),
@@ -665,7 +1197,7 @@ def mc_step(model, part, ptraj, pind_prop, pind_curr, future_trajs, find,
                                                     ut=ut[:cur_ind],
                                                     tt=tt[:cur_ind])
 
-            xprop = numpy.copy(ptraj[-1].pa.part[pind_prop])
+            xprop = pf.to_working_precision(numpy.copy(ptraj[-1].pa.part[pind_prop]))
 
             model.update_full(particles=xprop, traj=ptraj,
                               uvec=ut[:cur_ind], yvec=yt[:cur_ind],
@@ -710,14 +1242,14 @@ def mc_step(model, part, ptraj, pind_prop, pind_curr, future_trajs, find,
                                           cur_ind=cur_ind)
 
         if (ptraj is not None):
-            logp_prev_prop = model.logp_xnext_singlestep(part=ptraj[-1].pa.part[pind_prop],
+            logp_prev_prop = model.logp_xnext_singlestep(part=pf.to_working_precision(ptraj[-1].pa.part[pind_prop]),
                                                          past_trajs=ptraj[:-1],
                                                          pind=ptraj[-1].ancestors[pind_prop],
                                                          future_parts=xprop,
                                                          find=numpy.arange(len(xprop), dtype=int),
                                                          ut=ut, yt=yt, tt=tt,
                                                          cur_ind=cur_ind - 1)
-            logp_prev_curr = model.logp_xnext_singlestep(part=ptraj[-1].pa.part[pind_curr],
+            logp_prev_curr = model.logp_xnext_singlestep(part=pf.to_working_precision(ptraj[-1].pa.part[pind_curr]),
                                                          past_trajs=ptraj[:-1],
                                                          pind=ptraj[-1].ancestors[pind_curr],
                                                          future_parts=part,
@@ -731,7 +1263,7 @@ def mc_step(model, part, ptraj, pind_prop, pind_curr, future_trajs, find,
 
     xpropy = numpy.copy(xprop)
     curparty = numpy.copy(part)
-    if (yt[cur_ind] is not None):
+    if (pf.has_measurement(yt[cur_ind])):
         logp_y_prop = model.measure_full(particles=xpropy, traj=ptraj,
                                          uvec=ut[:cur_ind + 1], yvec=yt[:(cur_ind + 1)],
                                          tvec=tt[:cur_ind + 1], ancestors=pind_prop)
@@ -773,7 +1305,313 @@ def mc_step(model, part, ptraj, pind_prop, pind_curr, future_trajs, find,
              (logp_next_prop - logp_next_curr) +
              (logp_q_curr - logp_q_prop))
 
-    test = numpy.log(numpy.random.uniform(size=len(ratio)))
+    test = numpy.log(rng.uniform(size=len(ratio)))
     acc = test < ratio
     curparty[acc] = xpropy[acc]
     return (curparty, acc)
+
+
+class AncestralLagSmoother(object):
+    """
+    Online fixed-lag estimates of the mean of x_{t-L} using the ancestral
+    lineages of the particles at time t. The composition of the ancestral
+    indices of the last L time steps is maintained as a sliding window
+    aggregate using two stacks, giving an amortized cost of O(N) for each
+    time step instead of following the lineages back L steps.
+
+    Args:
+     - L (int): the lag
+    """
+    def __init__(self, L):
+        self.L = L
+        self.reset()
+
+    def reset(self):
+        """ Forget all the time steps seen so far """
+        # Absolute time index of the latest time step included
+        self.t = None
+        # Compositions of the older maps, front[-1] covers all of them
+        self._front = []
+        # The newer maps (oldest first) and their composition
+        self._back = []
+        self._back_agg = None
+
+    def _push(self, anc):
+        self._back.append(anc)
+        if (self._back_agg is None):
+            self._back_agg = anc
+        else:
+            self._back_agg = self._back_agg[anc]
+
+    def _pop(self):
+        if (len(self._front) == 0):
+            agg = None
+            for anc in reversed(self._back):
+                if (agg is None):
+                    agg = anc
+                else:
+                    agg = anc[agg]
+                self._front.append(agg)
+            self._back = []
+            self._back_agg = None
+        self._front.pop()
+
+    def _rebuild(self, traj):
+        self.reset()
+        for k in range(max(len(traj) - self.L, 1), len(traj)):
+            self._push(numpy.array(traj[k].ancestors, dtype=int))
+
+    def update(self, pt):
+        """
+        Include the latest time step of pt and compute the estimate
+
+        Args:
+         - pt (ParticleTrajectory): the forward filter
+
+        Returns:
+         (array-like) the estimate of the mean of x_{t-L}, None if less than
+         L time steps have been processed
+        """
+        traj = pt.traj
+        t = pt.offset + len(traj) - 1
+        if (self.t is None or t < self.t or t > self.t + 1):
+            self._rebuild(traj)
+        elif (t == self.t + 1 and self.L > 0):
+            self._push(numpy.array(traj[-1].ancestors, dtype=int))
+        self.t = t
+        while (len(self._front) + len(self._back) > self.L):
+            self._pop()
+
+        if (len(traj) <= self.L):
+            return None
+        w = traj[-1].pa.get_normalized_weights()
+        if (len(self._front) > 0 and self._back_agg is not None):
+            ind = self._front[-1][self._back_agg]
+        elif (len(self._front) > 0):
+            ind = self._front[-1]
+        elif (self._back_agg is not None):
+            ind = self._back_agg
+        else:
+            ind = numpy.arange(len(w), dtype=int)
+        part = pf.to_working_precision(numpy.asarray(traj[-(self.L + 1)].pa.part[ind]))
+        return numpy.tensordot(w, part, axes=(0, 0))
+
+
+class BSILagSmoother(object):
+    """
+    Online fixed-lag estimates of the mean of x_{t-L} using backward
+    simulation of M trajectories over the last L+1 time steps. The
+    transition densities log p(x_{s+1}^j|x_s^i) for all i are computed
+    when a backward trajectory first passes through particle j at time
+    s+1, and are kept until time s leaves the window. The cost of each time
+    step is at most O(M*N*L), the densities for each pair of consecutive
+    time steps are computed at most once.
+
+    Args:
+     - L (int): the lag
+     - M (int): number of backward trajectories
+    """
+    def __init__(self, L, M=10):
+        self.L = L
+        self.M = M
+        self.reset()
+
+    def reset(self):
+        """ Forget all the time steps seen so far """
+        # Cached densities indexed by absolute time and particle index at t+1
+        self._cache = {}
+
+    def _logp_next(self, pt, s, j):
+        key = pt.offset + s
+        cache = self._cache.setdefault(key, {})
+        if (j not in cache):
+            traj = pt.traj
+            part = pf.to_working_precision(traj[s].pa.part)
+            nxt = pf.to_working_precision(traj[s + 1].pa.part)
+            cache[j] = pt.pf.model.logp_xnext_singlestep(part=part,
+                                                         past_trajs=traj[:s],
+                                                         pind=traj[s].ancestors,
+                                                         future_parts=nxt,
+                                                         find=j * numpy.ones(len(part), dtype=int),
+                                                         ut=pt.uvec, yt=pt.yvec,
+                                                         tt=pt.tvec, cur_ind=s)
+        return cache[j]
+
+    def update(self, pt):
+        """
+        Include the latest time step of pt and compute the estimate
+
+        Args:
+         - pt (ParticleTrajectory): the forward filter
+
+        Returns:
+         (array-like) the estimate of the mean of x_{t-L}, None if less than
+         L time steps have been processed
+        """
+        traj = pt.traj
+        T = len(traj)
+        first = pt.offset + T - 1 - self.L
+        for key in [key for key in self._cache if key < first]:
+            del self._cache[key]
+        if (T <= self.L):
+            return None
+
+        rng = pt.pf.rng
+        find = pf.sample(traj[-1].pa.get_normalized_weights(), self.M, rng)
+        for s in reversed(range(T - 1 - self.L, T - 1)):
+            lw = traj[s].pa.w
+            ind = numpy.empty(self.M, dtype=int)
+            # Trajectories passing through the same particle share the weights
+            for j in numpy.unique(find):
+                sel = (find == j)
+                w = lw + self._logp_next(pt, s, j)
+                w = numpy.exp(w - numpy.max(w))
+                w /= numpy.sum(w)
+                ind[sel] = pf.sample(w, numpy.count_nonzero(sel), rng)
+            find = ind
+        part = pf.to_working_precision(numpy.asarray(traj[T - 1 - self.L].pa.part[find]))
+        return numpy.mean(part, axis=0)
+
+
+class PaRIS(object):
+    """
+    Forward-only smoothing of additive functionals
+    S_t = sum_{s=0}^t h_s(x_{s-1}, x_s) using the particle-based rapid
+    incremental smoother. Each particle carries an estimate tau^i of
+    E[S_t | x_t = x_t^i], which is updated at each time step using K draws
+    from the backward kernel for each particle,
+
+    tau_{t+1}^i = 1/K * sum_k (tau_t^{J_k} + h_{t+1}(x_t^{J_k}, x_{t+1}^i)),
+
+    so only the last two time steps of the filter are needed (e.g.
+    max_lag=1). The backward indices are drawn using rejection sampling
+    with the bound from 'logp_xnext_max_full' (see FFBSiRS), falling back to
+    evaluating all the densities for the draws not accepted after R
+    proposals, giving a cost linear in N for well behaved models. Models not
+    implementing 'logp_xnext_max_full' always use the full densities.
+
+    Based on "Efficient parameter inference in general hidden Markov
+    models using the filter-derivative approach" by Olsson and Westerborn.
+
+    Args:
+     - func (callable): h_s(x_{s-1}, x_s) evaluated as
+       func(part_prev, part, u, y, t) for pairs of particles, returning an
+       array with first dimension len(part). u is the input that took the
+       state from t-1 to t, y the measurement and t the time stamp of the
+       current time step. For the initial time step part_prev and u are
+       None.
+     - K (int): number of backward draws for each particle
+     - R (int): number of rejection sampling proposals before falling back
+       to evaluating the densities for all particles
+     - rng: random number generator, defaults to the one of the filter
+    """
+    def __init__(self, func, K=2, R=10, rng=None):
+        self.func = func
+        self.K = K
+        self.R = R
+        self.rng = rng
+        self.reset()
+
+    def reset(self):
+        """ Forget all the time steps seen so far """
+        # Absolute time index of the latest time step included
+        self.t = None
+        self.tau = None
+
+    def _backward_draws(self, pt, s, I):
+        """
+        Draw the index of the particle at relative time s for each particle
+        index I at time s+1 from the backward kernel
+        """
+        traj = pt.traj
+        model = pt.pf.model
+        rng = self.rng
+        if (rng is None):
+            rng = pt.pf.rng
+        pa = traj[s].pa
+        part = pf.to_working_precision(pa.part)
+        nxt = pf.to_working_precision(traj[s + 1].pa.part)
+        pind = traj[s].ancestors
+        kwargs = dict(past_trajs=traj[:s], future_parts=nxt, ut=pt.uvec,
+                      yt=pt.yvec, tt=pt.tvec, cur_ind=s)
+
+        J = numpy.empty(len(I), dtype=int)
+        todo = numpy.arange(len(I), dtype=int)
+        if (hasattr(model, 'logp_xnext_max_full')):
+            maxpdf = model.logp_xnext_max_full(part=part, past_trajs=traj[:s],
+                                               pind=pind, uvec=pt.uvec,
+                                               yvec=pt.yvec, tvec=pt.tvec,
+                                               cur_ind=s)
+            sampler = pa.get_alias_table()
+            for _i in range(self.R):
+                if (len(todo) == 0):
+                    break
+                prop = sampler.sample(len(todo), rng)
+                logp = model.logp_xnext_singlestep(part=part[prop],
+                                                   pind=pind[prop],
+                                                   find=I[todo], **kwargs)
+                accept = numpy.log(rng.rand(len(todo))) < logp - maxpdf
+                J[todo[accept]] = prop[accept]
+                todo = todo[~accept]
+
+        # Evaluate all the densities for the remaining draws, draws for the
+        # same particle share the weights
+        for i in numpy.unique(I[todo]):
+            sel = todo[I[todo] == i]
+            w = pa.w + model.logp_xnext_singlestep(part=part, pind=pind,
+                                                   find=i * numpy.ones(len(part), dtype=int),
+                                                   **kwargs)
+            w = numpy.exp(w - numpy.max(w))
+            w /= numpy.sum(w)
+            J[sel] = pf.sample(w, len(sel), rng)
+        return J
+
+    def update(self, pt):
+        """
+        Include the time steps of pt not seen so far, must be called after
+        each time step unless all the time steps are kept by the filter
+
+        Args:
+         - pt (ParticleTrajectory): the forward filter
+        """
+        traj = pt.traj
+        t = pt.offset + len(traj) - 1
+        if (self.t is None or t < self.t):
+            self.reset()
+            start = 0
+        else:
+            start = self.t + 1
+        if (max(start - 1, 0) < pt.offset):
+            raise ValueError('PaRIS must be updated after each time step')
+
+        for s in range(start, t + 1):
+            k = s - pt.offset
+            part = pf.to_working_precision(traj[k].pa.part)
+            if (s == 0):
+                self.tau = numpy.asarray(self.func(None, part, None,
+                                                   pt.yvec[k], pt.tvec[k]),
+                                         dtype=float)
+                continue
+            N = len(part)
+            I = numpy.repeat(numpy.arange(N, dtype=int), self.K)
+            J = self._backward_draws(pt, k - 1, I)
+            prev = pf.to_working_precision(traj[k - 1].pa.part)
+            h = numpy.asarray(self.func(prev[J], part[I], pt.uvec[k - 1],
+                                        pt.yvec[k], pt.tvec[k]), dtype=float)
+            tau = self.tau[J] + h
+            self.tau = numpy.mean(tau.reshape((N, self.K) + tau.shape[1:]), axis=1)
+        self.t = t
+
+    def get_estimate(self, pt):
+        """
+        Return the smoothed estimate of the additive functional
+
+        Args:
+         - pt (ParticleTrajectory): the forward filter, update must have
+           been called for its latest time step
+
+        Returns:
+         (array-like) estimate of E[S_t | y_{0:t}]
+        """
+        w = pt.traj[-1].pa.get_normalized_weights()
+        return numpy.tensordot(w, self.tau, axes=(0, 0))
@@ -0,0 +1,583 @@
+""" Storage backends for the particle approximations of a trajectory
+
+@author: Jerker Nordh
+"""
+
+import collections
+import concurrent.futures
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+import numpy
+from pyparticleest.filter import ParticleApproximation, TrajectoryStep
+
+
+class StoredParticleApproximation(ParticleApproximation):
+    """
+    ParticleApproximation whose particles and weights are views into the
+    arrays of an ArrayTrajectory. Assigning to the attributes writes the
+    new values back into the storage, so code written for the regular
+    ParticleApproximation class works unmodified.
+
+    Args:
+     - store (ArrayTrajectory): the storage containing the data
+     - ind (int): time index in the storage
+    """
+    def __init__(self, store, ind):
+        self._store = store
+        self._ind = ind
+        self.invalidate_weights()
+
+    @property
+    def part(self):
+        return self._store._part[self._ind]
+
+    @part.setter
+    def part(self, value):
+        self._store._part[self._ind] = value
+
+    @property
+    def w(self):
+        return self._store._w[self._ind]
+
+    @w.setter
+    def w(self, value):
+        self._store._w[self._ind] = value
+        self.invalidate_weights()
+
+    @property
+    def w_offset(self):
+        return self._store._w_offset[self._ind]
+
+    @w_offset.setter
+    def w_offset(self, value):
+        self._store._w_offset[self._ind] = value
+
+    @property
+    def num(self):
+        return self._store.N
+
+    @num.setter
+    def num(self, value):
+        if (value != self._store.N):
+            raise ValueError('Array storage requires a constant number of particles')
+
+    def __deepcopy__(self, memo):
+        pa = ParticleApproximation(self.part, self.w)
+        pa.w_offset = self.w_offset
+        return pa
+
+
+class StoredTrajectoryStep(TrajectoryStep):
+    """
+    TrajectoryStep stored in an ArrayTrajectory
+
+    Args:
+     - store (ArrayTrajectory): the storage containing the data
+     - ind (int): time index in the storage
+    """
+    def __init__(self, store, ind):
+        self._store = store
+        self._ind = ind
+        self.pa = StoredParticleApproximation(store, ind)
+
+    @property
+    def ancestors(self):
+        return self._store._anc[self._ind]
+
+    @ancestors.setter
+    def ancestors(self, value):
+        self._store._anc[self._ind] = value
+
+
+class TrajectoryView(object):
+    """
+    Read-only window [start, stop) of an ArrayTrajectory, this is what slicing
+    an ArrayTrajectory returns. Creating a view is O(1) and does not copy
+    any data.
+
+    Args:
+     - store (ArrayTrajectory): the storage containing the data
+     - start (int): first time index of the view
+     - stop (int): one past the last time index of the view
+    """
+    def __init__(self, store, start, stop):
+        self._store = store
+        self._start = start
+        self._stop = max(start, stop)
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def __getitem__(self, index):
+        if (isinstance(index, slice)):
+            (start, stop, step) = index.indices(len(self))
+            if (step != 1):
+                return [self[i] for i in range(start, stop, step)]
+            return TrajectoryView(self._store, self._start + start,
+                                  self._start + stop)
+        if (index < 0):
+            index += len(self)
+        if (index < 0 or index >= len(self)):
+            raise IndexError('trajectory index out of range')
+        return self._store[self._start + index]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def part(self):
+        """ (T, N, ...) array of the particles in the window """
+        self._store.flush()
+        return self._store._part[self._start:self._stop]
+
+    @property
+    def w(self):
+        """ (T, N) array of the log-weights in the window """
+        self._store.flush()
+        return self._store._w[self._start:self._stop]
+
+    @property
+    def ancestors(self):
+        """ (T, N) array of the ancestral indices in the window """
+        self._store.flush()
+        return self._store._anc[self._start:self._stop]
+
+    @property
+    def w_offset(self):
+        """ (T,) array of the weight offsets in the window """
+        return self._store._w_offset[self._start:self._stop]
+
+
+class ArrayTrajectory(TrajectoryView):
+    """
+    Sequence of TrajectorySteps where the particles, log-weights and
+    ancestral indices for all time steps are kept in contiguous
+    (T, N, ...) / (T, N) arrays. The arrays are grown geometrically, so
+    appending a time step has constant amortized cost.
+
+    Indexing returns TrajectoryStep objects whose 'pa.part', 'pa.w' and
+    'ancestors' are views into the storage, the step objects are created once
+    for each time index and then reused. Slicing returns a TrajectoryView
+    without copying any data. The members 'part', 'w' and 'ancestors' give
+    access to the data for all time steps at once.
+
+    Views into the arrays are invalidated when the storage grows, always
+    access the data through the step objects or properties instead of
+    keeping references to the returned arrays.
+
+    Requires the number of particles to be the same for all time steps and
+    that the model represents the particles as a numpy array with the first
+    dimension indexing the particles.
+
+    If dtype is given the particles are stored using that type (e.g.
+    numpy.float32 to halve the memory used), the log-weights are always
+    stored in double precision. The latest time step is then kept as the
+    appended TrajectoryStep object so the filter continues from the full
+    precision particles, it is written to the arrays when the next time step
+    is appended or when the arrays are accessed ('flush').
+
+    Args:
+     - T (int): initial capacity (number of time steps)
+     - dtype (numpy.dtype): type used to store the particles, defaults to the
+       type of the first appended particles
+     - index_dtype (numpy.dtype): type used to store the ancestral indices,
+       defaults to int
+    """
+    def __init__(self, T=None, dtype=None, index_dtype=None):
+        if (T is None or T < 1):
+            T = 16
+        self.capacity = T
+        self.dtype = dtype
+        if (index_dtype is None):
+            index_dtype = int
+        self.index_dtype = index_dtype
+        # Latest time step when storing the particles with reduced precision
+        self._head = None
+        self._keep_head = (dtype is not None)
+        self.N = None
+        self._part = None
+        self._w = None
+        self._anc = None
+        self._w_offset = None
+        # The step objects are created on first access and then reused
+        self._steps = []
+        super(ArrayTrajectory, self).__init__(self, 0, 0)
+
+    def _allocate(self, part):
+        part = numpy.asarray(part)
+        self.N = part.shape[0]
+        dtype = self.dtype
+        if (dtype is None):
+            dtype = part.dtype
+        self._part = numpy.empty((self.capacity,) + part.shape, dtype=dtype)
+        self._w = numpy.empty((self.capacity, self.N))
+        self._anc = numpy.empty((self.capacity, self.N), dtype=self.index_dtype)
+        self._w_offset = numpy.zeros((self.capacity,))
+
+    def _grow(self):
+        self.capacity *= 2
+        for name in ('_part', '_w', '_anc', '_w_offset'):
+            old = getattr(self, name)
+            new = numpy.empty((self.capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:len(self)] = old[:len(self)]
+            setattr(self, name, new)
+
+    def append(self, step):
+        """
+        Copy the data of step into the storage
+
+        Args:
+         - step (TrajectoryStep): time step to add
+        """
+        if (self._part is None):
+            self._allocate(step.pa.part)
+        elif (len(step.pa.part) != self.N):
+            raise ValueError('Array storage requires a constant number of particles')
+        self.flush()
+        if (len(self) == self.capacity):
+            self._grow()
+
+        ind = len(self)
+        if (ind < len(self._steps) and step.pa is self._steps[ind].pa):
+            # Already written in place, see next_step
+            if (step.ancestors is not None):
+                self._anc[ind] = step.ancestors
+        else:
+            self._write(ind, step)
+        if (ind < len(self._steps)):
+            self._steps[ind].pa.invalidate_weights()
+        self._stop += 1
+        if (self._keep_head):
+            self._head = step
+
+    def next_step(self):
+        """
+        Return the step object for the time step following the last one,
+        whose 'pa.part', 'pa.w' and 'ancestors' are views into the arrays, so
+        that a filter can compute the new time step in place. The contents
+        of the arrays are undefined until written. The time step is added by
+        passing a TrajectoryStep containing the returned 'pa' to 'append',
+        which then doesn't copy the particles and weights.
+
+        Returns:
+         (TrajectoryStep) the next time step, or None if the storage doesn't
+         support writing in place (particles stored with reduced precision,
+         or no time step has been appended yet)
+        """
+        if (self._keep_head or self._part is None):
+            return None
+        if (len(self) == self.capacity):
+            self._grow()
+        step = self._get_step(len(self))
+        step.pa.invalidate_weights()
+        return step
+
+    def _write(self, ind, step):
+        self._part[ind] = step.pa.part
+        self._w[ind] = step.pa.w
+        self._w_offset[ind] = step.pa.w_offset
+        if (step.ancestors is not None):
+            self._anc[ind] = step.ancestors
+        else:
+            self._anc[ind] = numpy.arange(self.N, dtype=int)
+
+    def flush(self):
+        """
+        Write the latest time step to the arrays, only needed when storing
+        the particles with reduced precision. Called automatically when
+        appending time steps and when accessing the arrays through the
+        members 'part', 'w' and 'ancestors'.
+        """
+        if (self._head is not None):
+            ind = self._stop - 1
+            self._write(ind, self._head)
+            if (ind < len(self._steps)):
+                self._steps[ind].pa.invalidate_weights()
+
+    def discard(self, k):
+        """
+        Remove the k oldest time steps, the remaining data is moved to the
+        start of the arrays
+
+        Args:
+         - k (int): number of time steps to remove
+        """
+        self.flush()
+        n = len(self) - k
+        for name in ('_part', '_w', '_anc', '_w_offset'):
+            arr = getattr(self, name)
+            arr[:n] = arr[k:len(self)]
+        for step in self._steps[:n]:
+            step.pa.invalidate_weights()
+        self._stop = n
+
+    def clear(self):
+        """
+        Remove all time steps, the allocated arrays are kept and reused
+        for the time steps appended afterwards
+        """
+        self._stop = 0
+        self._head = None
+
+    def attach(self, part, w, ancestors, w_offset, head=None):
+        """
+        Replace the contents of the storage with the given arrays, which are
+        used directly without copying them (e.g. memory mapped arrays).
+        They are copied when the storage grows.
+
+        Args:
+         - part (array-like): (T, N, ...) array of particles
+         - w (array-like): (T, N) array of log-weights
+         - ancestors (array-like): (T, N) array of ancestral indices
+         - w_offset (array-like): (T,) array of weight offsets
+         - head (TrajectoryStep): the latest time step, used instead of the
+           last row of the arrays when storing the particles with reduced
+           precision
+        """
+        self.N = part.shape[1]
+        self._part = part
+        self._w = w
+        self._anc = ancestors
+        self._w_offset = numpy.array(w_offset, dtype=float)
+        self.capacity = len(part)
+        self._stop = len(part)
+        self._steps = []
+        self._head = None
+        if (self._keep_head and head is not None):
+            self._head = head
+
+    def __getitem__(self, index):
+        if (isinstance(index, slice)):
+            return super(ArrayTrajectory, self).__getitem__(index)
+        if (index < 0):
+            index += self._stop
+        if (index < 0 or index >= self._stop):
+            raise IndexError('trajectory index out of range')
+        if (self._head is not None and index == self._stop - 1):
+            return self._head
+        return self._get_step(index)
+
+    def _get_step(self, index):
+        steps = self._steps
+        if (index >= len(steps)):
+            steps.extend([StoredTrajectoryStep(self, i)
+                          for i in range(len(steps), index + 1)])
+        return steps[index]
+
+
+
+class _ChunkedArray(object):
+    """
+    (T, ...) array stored as a sequence of memory mapped files with
+    chunk_size rows each, used by MemmapTrajectory. Supports reading and
+    writing single rows, reading a range of rows returns a copy. Rows in the
+    chunks loaded into memory by the storage are read from the loaded copy.
+
+    Args:
+     - store (MemmapTrajectory): the storage owning the array
+     - name (string): prefix of the file names
+     - shape (tuple): shape of each row
+     - dtype (numpy.dtype): type of the elements
+    """
+    def __init__(self, store, name, shape, dtype):
+        self._store = store
+        self.name = name
+        self.shape = shape
+        self.dtype = numpy.dtype(dtype)
+        self.chunks = []
+
+    def add_chunk(self):
+        fname = os.path.join(self._store.path,
+                             '%s_%06d.dat' % (self.name, len(self.chunks)))
+        self.chunks.append(numpy.memmap(fname, dtype=self.dtype, mode='w+',
+                                        shape=(self._store.chunk_size,) + self.shape))
+
+    def load(self, c):
+        """ Read-only in-memory copy of chunk c """
+        arr = numpy.array(self.chunks[c])
+        arr.flags.writeable = False
+        return arr
+
+    def __len__(self):
+        return len(self.chunks) * self._store.chunk_size
+
+    def __getitem__(self, index):
+        if (isinstance(index, slice)):
+            rows = [self[t] for t in range(*index.indices(len(self)))]
+            if (len(rows) == 0):
+                return numpy.empty((0,) + self.shape, dtype=self.dtype)
+            return numpy.array(rows)
+        (c, i) = divmod(index, self._store.chunk_size)
+        loaded = self._store._get_loaded(c)
+        if (loaded is not None):
+            return loaded[self.name][i]
+        return self.chunks[c][i]
+
+    def __setitem__(self, index, value):
+        (c, i) = divmod(index, self._store.chunk_size)
+        self._store._unload(c)
+        self.chunks[c][i] = value
+
+
+class MemmapTrajectory(ArrayTrajectory):
+    """
+    Out-of-core version of ArrayTrajectory for datasets too long to keep
+    all the particles in memory. The particles, log-weights and ancestral
+    indices are written to memory mapped files in time-major chunks of
+    chunk_size time steps, so only the pages in use are kept in memory by
+    the operating system. The latest time step is kept as the appended
+    TrajectoryStep object.
+
+    The backward smoothers traverse the trajectory in reverse, they call
+    'readahead' for each time index. The chunk containing that index is then
+    read into memory and the preceding chunk is read in a background thread,
+    so the disk access overlaps the computations. At most cache_chunks
+    chunks are kept in memory. The storage can be read from several threads
+    concurrently, e.g. by the parallel backward simulation.
+
+    Slicing the arrays ('part', 'w' and 'ancestors') returns copies. The
+    step objects are not cached, and 'discard' is not supported (use
+    ArrayTrajectory together with max_lag instead).
+
+    Args:
+     - path (string): directory for the files, a temporary directory which
+       is removed together with the storage is created if None
+     - chunk_size (int): number of time steps in each file
+     - cache_chunks (int): number of chunks to keep in memory, at least 2
+     - dtype (numpy.dtype): type used to store the particles, see
+       ArrayTrajectory
+     - index_dtype (numpy.dtype): type used to store the ancestral indices
+    """
+    def __init__(self, path=None, chunk_size=256, cache_chunks=3, dtype=None,
+                 index_dtype=None):
+        super(MemmapTrajectory, self).__init__(chunk_size, dtype, index_dtype)
+        self.capacity = 0
+        self._keep_head = True
+        self.chunk_size = int(chunk_size)
+        if (self.chunk_size < 1):
+            raise ValueError('chunk_size must be positive')
+        self.cache_chunks = max(int(cache_chunks), 2)
+        if (path is None):
+            path = tempfile.mkdtemp(prefix='pyparticleest-')
+            weakref.finalize(self, shutil.rmtree, path, True)
+        elif (not os.path.isdir(path)):
+            os.makedirs(path)
+        self.path = path
+        # Loaded chunks (dictionaries of arrays) or pending loads (futures),
+        # in least recently used order
+        self._cache = collections.OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._executor = None
+
+    def _allocate(self, part):
+        part = numpy.asarray(part)
+        self.N = part.shape[0]
+        dtype = self.dtype
+        if (dtype is None):
+            dtype = part.dtype
+        self._part = _ChunkedArray(self, 'part', part.shape, dtype)
+        self._w = _ChunkedArray(self, 'w', (self.N,), float)
+        self._anc = _ChunkedArray(self, 'anc', (self.N,), self.index_dtype)
+        self._w_offset = numpy.zeros((0,))
+        self._grow()
+
+    def _grow(self):
+        for arr in (self._part, self._w, self._anc):
+            arr.add_chunk()
+        self.capacity += self.chunk_size
+        if (self.capacity > len(self._w_offset)):
+            # Grown geometrically, the chunks are added one at a time
+            w_offset = numpy.zeros((max(self.capacity, 2 * len(self._w_offset)),))
+            w_offset[:len(self._w_offset)] = self._w_offset
+            self._w_offset = w_offset
+
+    def _load(self, c):
+        return dict((arr.name, arr.load(c))
+                    for arr in (self._part, self._w, self._anc))
+
+    def _get_loaded(self, c):
+        with self._cache_lock:
+            entry = self._cache.get(c, None)
+            if (entry is None):
+                return None
+            if (not isinstance(entry, dict)):
+                entry = entry.result()
+                self._cache[c] = entry
+            return entry
+
+    def _unload(self, c):
+        with self._cache_lock:
+            entry = self._cache.pop(c, None)
+            if (entry is not None and not isinstance(entry, dict)):
+                # Don't write to the file while it is being read
+                entry.result()
+
+    def readahead(self, t):
+        """
+        Load the chunk containing time index t into memory, and start reading
+        the preceding chunk in the background
+
+        Args:
+         - t (int): time index about to be accessed
+        """
+        if (t < 0 or t >= len(self)):
+            return
+        c = t // self.chunk_size
+        with self._cache_lock:
+            if (c not in self._cache):
+                self._cache[c] = self._load(c)
+            else:
+                self._cache.move_to_end(c)
+            if (c > 0 and (c - 1) not in self._cache):
+                if (self._executor is None):
+                    self._executor = concurrent.futures.ThreadPoolExecutor(1)
+                self._cache[c - 1] = self._executor.submit(self._load, c - 1)
+            while (len(self._cache) > self.cache_chunks):
+                (_c, entry) = self._cache.popitem(last=False)
+                if (not isinstance(entry, dict)):
+                    entry.cancel()
+
+    def discard(self, k):
+        raise ValueError('Memory mapped storage does not support discarding time steps')
+
+    def attach(self, part, w, ancestors, w_offset, head=None):
+        """
+        Replace the contents of the storage with the given arrays, unlike
+        ArrayTrajectory.attach the data is copied to the files of the storage
+
+        Args:
+         - part (array-like): (T, N, ...) array of particles
+         - w (array-like): (T, N) array of log-weights
+         - ancestors (array-like): (T, N) array of ancestral indices
+         - w_offset (array-like): (T,) array of weight offsets
+         - head (TrajectoryStep): the latest time step, replaces the last
+           row of the arrays
+        """
+        self.clear()
+        T = len(part)
+        for t in range(T):
+            if (t == T - 1 and head is not None):
+                step = head
+            else:
+                pa = ParticleApproximation(part[t], w[t])
+                pa.w_offset = w_offset[t]
+                step = TrajectoryStep(pa, ancestors[t])
+            self.append(step)
+
+    def clear(self):
+        """
+        Remove all time steps, the files are kept and reused for the time
+        steps appended afterwards
+        """
+        super(MemmapTrajectory, self).clear()
+        for c in list(self._cache.keys()):
+            self._unload(c)
+
+    def _get_step(self, index):
+        # Creating the step objects is cheap, caching them would keep
+        # the normalized weights for all the time steps in memory
+        return StoredTrajectoryStep(self, index)
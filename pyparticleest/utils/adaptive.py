@@ -0,0 +1,114 @@
+"""
+Strategies for adapting the number of particles used in the forward filter
+
+Each strategy is a callable f(pa) returning the number of particles to use
+for the next time step given the current ParticleApproximation pa. When the
+returned number differs from the current one the particle approximation is
+resampled to the new size.
+
+@author: Jerker Nordh
+"""
+
+import math
+import numpy
+
+
+def _normal_quantile(p):
+    """
+    Quantile function of the standard normal distribution, found by bisection
+    """
+    lo = -40.0
+    hi = 40.0
+    for _i in range(100):
+        mid = 0.5 * (lo + hi)
+        if (0.5 * math.erfc(-mid / math.sqrt(2.0)) < p):
+            lo = mid
+        else:
+            hi = mid
+    return 0.5 * (lo + hi)
+
+
+def _clip(N, N_min, N_max):
+    return int(min(max(N, N_min), N_max))
+
+
+class KLDSampling(object):
+    """
+    KLD-sampling, choose the number of particles so that with probability
+    1-delta the Kullback-Leibler divergence between the particle approximation
+    and the true distribution is less than epsilon. The complexity of the
+    distribution is measured by the number of bins k of a grid over the state
+    space that are in the support of the particle approximation.
+
+    Based on "Adapting the sample size in particle filters through
+    KLD-sampling" by Fox. Instead of counting the occupied bins while
+    drawing the new particles, a bin is counted if its probability mass is
+    large enough that it would be expected to be hit when resampling the
+    current particles.
+
+    Requires the particles to be represented as a (N, D) numpy array.
+
+    Args:
+     - bin_size (float or array-like): size of the bins in each dimension
+     - epsilon (float): bound on the KL divergence
+     - delta (float): probability of exceeding the bound
+     - N_min (int): minimum number of particles
+     - N_max (int): maximum number of particles
+    """
+    def __init__(self, bin_size, epsilon=0.05, delta=0.01, N_min=10,
+                 N_max=100000):
+        self.bin_size = numpy.asarray(bin_size, dtype=float)
+        self.epsilon = epsilon
+        self.z = _normal_quantile(1.0 - delta)
+        self.N_min = N_min
+        self.N_max = N_max
+
+    def count_bins(self, pa):
+        """
+        Count the number of bins in the support of the particle approximation
+
+        Args:
+         - pa (ParticleApproximation): the current particles and weights
+
+        Returns:
+         (int) number of bins
+        """
+        part = numpy.asarray(pa.part)
+        part = part.reshape((len(part), -1))
+        w = pa.get_normalized_weights()
+        bins = numpy.ascontiguousarray(numpy.floor(part / self.bin_size).astype(numpy.int64))
+        # View each row as a single element so that numpy.unique finds the
+        # distinct bins (unique(..., axis=0) requires numpy >= 1.13)
+        rows = bins.view(numpy.dtype((numpy.void, bins.dtype.itemsize * bins.shape[1])))
+        (_, inv) = numpy.unique(rows.ravel(), return_inverse=True)
+        mass = numpy.bincount(inv.ravel(), weights=w)
+        return numpy.count_nonzero(mass * len(w) >= 1.0)
+
+    def __call__(self, pa):
+        k = self.count_bins(pa)
+        if (k <= 1):
+            return self.N_min
+        a = 2.0 / (9.0 * (k - 1))
+        N = (k - 1) / (2.0 * self.epsilon) * (1.0 - a + math.sqrt(a) * self.z) ** 3
+        return _clip(math.ceil(N), self.N_min, self.N_max)
+
+
+class ESSTarget(object):
+    """
+    Choose the number of particles so that the effective number of particles
+    is close to a target value, assuming that the ratio of effective to
+    total number of particles stays the same as for the current step.
+
+    Args:
+     - target (float): desired effective number of particles
+     - N_min (int): minimum number of particles
+     - N_max (int): maximum number of particles
+    """
+    def __init__(self, target, N_min=10, N_max=100000):
+        self.target = target
+        self.N_min = N_min
+        self.N_max = N_max
+
+    def __call__(self, pa):
+        ratio = pa.calc_Neff() / pa.num
+        return _clip(math.ceil(self.target / ratio), self.N_min, self.N_max)
@@ -0,0 +1,149 @@
+"""
+Correlated pseudo-random numbers for pseudo-marginal methods
+
+The log-likelihood estimates of a particle filter run for two nearby
+parameter values are nearly independent when different random numbers are
+used. By computing all the random numbers from the same sequence of standard
+normal numbers, and only slowly changing that sequence between the runs, the
+estimates become positively correlated and their difference has a much
+lower variance.
+
+Based on "The correlated pseudo-marginal method" by Deligiannidis, Doucet
+and Pitt.
+
+Example:
+    rs = CorrelatedRandomState(numpy.random.normal(size=100000))
+    model.rng = rs
+    pt = ParticleTrajectory(model, N, resample=1.0, rng=rs,
+                            filter_options={'resample_order': sort_first_component})
+    ...
+    rs = rs.perturb(rho=0.99)
+
+@author: Jerker Nordh
+"""
+
+import numpy
+import scipy.special
+
+
+class CorrelatedRandomState(object):
+    """
+    Source of random numbers that provides the subset of the interface of
+    numpy.random.RandomState used by the filters, the resamplers and the
+    models in this package. All the random numbers are computed from the
+    supplied sequence of independent standard normal numbers z, which is
+    consumed in order. Normal numbers are scaled and shifted elements of z,
+    uniform numbers are computed as Phi(z) where Phi is the cumulative
+    distribution function of the standard normal distribution.
+
+    Two runs using the same sequence consume the same numbers for the same
+    purposes as long as the same number of random numbers are drawn at each
+    step, for the particle filters this is guaranteed by resampling at every
+    time step (resample=1.0).
+
+    Args:
+     - z (array-like): independent standard normal numbers
+    """
+    def __init__(self, z):
+        self.z = numpy.asarray(z, dtype=float).ravel()
+        self.pos = 0
+
+    def reset(self):
+        """
+        Restart from the beginning of the sequence
+        """
+        self.pos = 0
+
+    def perturb(self, rho, rng=None):
+        """
+        Create a new source where the sequence is correlated with this one,
+        z' = rho * z + sqrt(1 - rho^2) * e where e is independent standard
+        normal noise. This is a reversible move with respect to the standard
+        normal distribution (the Crank-Nicolson proposal).
+
+        Args:
+         - rho (float): correlation between the old and new sequence
+         - rng: random number generator used for e, defaults to numpy.random
+
+        Returns:
+         (CorrelatedRandomState) starting from the beginning of the new
+         sequence
+        """
+        if (rng is None):
+            rng = numpy.random
+        e = rng.normal(size=self.z.shape)
+        return CorrelatedRandomState(rho * self.z + numpy.sqrt(1.0 - rho ** 2) * e)
+
+    def _take(self, size):
+        if (size is None):
+            n = 1
+        else:
+            n = int(numpy.prod(size))
+        if (self.pos + n > len(self.z)):
+            raise ValueError('Not enough random numbers, %d more needed' %
+                             (self.pos + n - len(self.z)))
+        z = self.z[self.pos:self.pos + n]
+        self.pos += n
+        if (size is None):
+            return z[0]
+        return z.reshape(size)
+
+    def standard_normal(self, size=None):
+        return numpy.copy(self._take(size))
+
+    def normal(self, loc=0.0, scale=1.0, size=None):
+        return loc + scale * self._take(size)
+
+    def multivariate_normal(self, mean, cov, size=None):
+        mean = numpy.asarray(mean, dtype=float)
+        L = numpy.linalg.cholesky(cov)
+        if (size is None):
+            shape = mean.shape
+        else:
+            shape = tuple(numpy.atleast_1d(size)) + mean.shape
+        z = self._take(shape)
+        return mean + numpy.dot(z, L.T)
+
+    def random_sample(self, size=None):
+        return scipy.special.ndtr(self._take(size))
+
+    def rand(self, *args):
+        if (len(args) == 0):
+            return self.random_sample()
+        return self.random_sample(args)
+
+    def uniform(self, low=0.0, high=1.0, size=None):
+        return low + (high - low) * self.random_sample(size)
+
+    def randint(self, low, high=None, size=None):
+        if (high is None):
+            (low, high) = (0, low)
+        u = self.random_sample(size)
+        ind = numpy.minimum(numpy.floor(u * (high - low)), high - low - 1)
+        return low + numpy.asarray(ind, dtype=int)
+
+    def multinomial(self, n, pvals):
+        pvals = numpy.asarray(pvals, dtype=float)
+        wc = numpy.cumsum(pvals)
+        wc /= wc[-1]
+        ind = numpy.searchsorted(wc, self.random_sample(n), side='right')
+        numpy.clip(ind, 0, len(pvals) - 1, out=ind)
+        return numpy.bincount(ind, minlength=len(pvals))
+
+
+def sort_first_component(part):
+    """
+    Order the particles according to their first state component, pass as
+    the 'resample_order' filter option. Resampling particles in a fixed
+    order keeps the resampled particles for two nearby parameter values
+    close when using the same random numbers, without it the correlation
+    between the log-likelihood estimates is largely lost in the resampling.
+
+    Args:
+     - part (array-like): (N, D) array of particles
+
+    Returns:
+     (array-like) permutation of the N particles
+    """
+    part = numpy.asarray(part)
+    return numpy.argsort(part.reshape((len(part), -1))[:, 0], kind='stable')
@@ -52,6 +52,8 @@ class Instrumenter(object):
         - self.cnt_pdfsmooth
         - self.cnt_eval1st
 
+    The random number generator (rng) is that of the encapsulated model.
+
     Args:
      - model: Object of encapsulated model class
     """
@@ -61,6 +63,14 @@ class Instrumenter(object):
         self.model = model
         self.oc = OpCount()
 
+    @property
+    def rng(self):
+        return self.model.rng
+
+    @rng.setter
+    def rng(self, value):
+        self.model.rng = value
+
     def print_statistics(self):
         print("Modelclass : %s" % type(self.model))
         print("cnt_sample: %d" % self.cnt_sample)
@@ -0,0 +1,247 @@
+"""
+KD-tree for truncated evaluation of Gaussian kernels
+
+For a Gaussian transition density p(x_{t+1}|x_t) = N(x_{t+1}; f(x_t), Q)
+with the same covariance for all particles, the backward weights
+w_t^i*p(x_{t+1}^j|x_t^i) only depend on the distance between the whitened
+points q_j = Q^{-1/2}x_{t+1}^j and z_i = Q^{-1/2}f(x_t^i). Almost all of the
+N*M weights are then negligible. By storing both the reference points z and
+the query points q in KD-trees, complete pairs of tree nodes that are too far
+apart to contribute can be skipped (dual-tree traversal) and only the
+remaining blocks of weights are evaluated.
+
+The truncation is controlled by the relative error bound eps: for every
+query the total (unnormalized) weight of the skipped reference points is at
+most eps times the weight of the kept points. eps=0 evaluates all the
+weights.
+
+The implementation only uses numpy, the tree nodes are stored in flat
+arrays and the kernel is evaluated for complete leaves at a time.
+
+@author: Jerker Nordh
+"""
+
+import math
+import numpy
+
+
+def _logsumexp_rows(a):
+    """ log(sum(exp(a), axis=1)) for a 2D array, rows of -inf give -inf """
+    amax = numpy.max(a, axis=1)
+    amax[~numpy.isfinite(amax)] = 0.0
+    with numpy.errstate(divide='ignore'):
+        return numpy.log(numpy.sum(numpy.exp(a - amax[:, numpy.newaxis]),
+                                   axis=1)) + amax
+
+
+class KDTree(object):
+    """
+    KD-tree for a set of points, each node stores the bounding box of its
+    points. The points are split at the median of the widest dimension
+    until at most leaf_size points remain.
+
+    Args:
+     - points (array-like): (N, D) array of points
+     - leaf_size (int): maximum number of points in a leaf
+    """
+
+    def __init__(self, points, leaf_size=16):
+        points = numpy.asarray(points, dtype=float)
+        if (points.ndim == 1):
+            points = points[:, numpy.newaxis]
+        N = len(points)
+        self.points = points
+        self.perm = numpy.arange(N, dtype=int)
+        start = []
+        end = []
+        left = []
+        right = []
+        stack = [(0, N, -1, False)]
+        while (len(stack) > 0):
+            (s, e, parent, is_right) = stack.pop()
+            node = len(start)
+            start.append(s)
+            end.append(e)
+            left.append(-1)
+            right.append(-1)
+            if (parent >= 0):
+                if (is_right):
+                    right[parent] = node
+                else:
+                    left[parent] = node
+            if (e - s <= leaf_size):
+                continue
+            ind = self.perm[s:e]
+            pts = points[ind]
+            dim = numpy.argmax(numpy.max(pts, axis=0) - numpy.min(pts, axis=0))
+            mid = (e - s) // 2
+            self.perm[s:e] = ind[numpy.argpartition(pts[:, dim], mid)]
+            stack.append((s + mid, e, node, True))
+            stack.append((s, s + mid, node, False))
+
+        self.start = numpy.asarray(start, dtype=int)
+        self.end = numpy.asarray(end, dtype=int)
+        self.left = numpy.asarray(left, dtype=int)
+        self.right = numpy.asarray(right, dtype=int)
+        sorted_points = points[self.perm]
+        self.lo = numpy.empty((len(start), points.shape[1]))
+        self.hi = numpy.empty((len(start), points.shape[1]))
+        for node in range(len(start)):
+            self.lo[node] = numpy.min(sorted_points[start[node]:end[node]], axis=0)
+            self.hi[node] = numpy.max(sorted_points[start[node]:end[node]], axis=0)
+
+    def __len__(self):
+        return len(self.points)
+
+    def leaves(self):
+        """ Return the indices of all the leaf nodes """
+        return numpy.flatnonzero(self.left < 0)
+
+    def indices(self, node):
+        """ Return the indices of the points contained in node """
+        return self.perm[self.start[node]:self.end[node]]
+
+    def _min_dist2(self, lo, hi, nodes):
+        """
+        Squared distances between the boxes [lo, hi] and the boxes of nodes,
+        lo and hi are (D,) or (len(nodes), D) arrays
+        """
+        gap = numpy.maximum(numpy.maximum(self.lo[nodes] - hi, lo - self.hi[nodes]), 0.0)
+        return numpy.sum(gap ** 2, axis=1)
+
+    def _descend(self, points):
+        """ Find the leaf closest to each point by a greedy descent """
+        node = numpy.zeros(len(points), dtype=int)
+        todo = numpy.flatnonzero(self.left[node] >= 0)
+        while (len(todo) > 0):
+            p = points[todo]
+            left = self.left[node[todo]]
+            right = self.right[node[todo]]
+            closer = self._min_dist2(p, p, left) <= self._min_dist2(p, p, right)
+            node[todo] = numpy.where(closer, left, right)
+            todo = todo[self.left[node[todo]] >= 0]
+        return node
+
+    def _block(self, q, rind, logw):
+        diff = q[:, numpy.newaxis, :] - self.points[rind][numpy.newaxis, :, :]
+        return logw[rind] - 0.5 * numpy.sum(diff ** 2, axis=2)
+
+    def kernel_blocks(self, queries, logw, eps=1e-3):
+        """
+        Evaluate the truncated log-weights logw_i - 0.5*||q_j - z_i||^2,
+        where z are the points of this tree and q the points of the query
+        tree.
+
+        The kernel sum of the closest reference leaf gives a lower bound S0
+        on the kernel sum of every query in a query leaf. A reference node
+        with total weight W contributes at most W*exp(-0.5*d^2), where d is
+        the distance between the boxes of the two nodes, skipping it when this
+        is below eps*S0*W/W_total bounds the total skipped weight by eps*S0.
+        The pairs of nodes are refined one level at a time for all the
+        query leaves at once.
+
+        Args:
+         - queries (KDTree): tree of the query points
+         - logw (array-like): log-weights of the points of this tree
+         - eps (float): bound on the relative weight of the skipped points,
+           0 <= eps < 1
+
+        Returns:
+         Generator of (qind, rind, logk): qind are the indices of the queries
+         in one query leaf, rind the indices of the reference points that
+         were kept and logk the (len(qind), len(rind)) matrix of log-weights
+        """
+        if (eps < 0.0 or eps >= 1.0):
+            raise ValueError('eps must be in [0, 1)')
+        logw = numpy.asarray(logw, dtype=float)
+        lmax = numpy.max(logw)
+        logw = logw - lmax
+        log_total = math.log(numpy.sum(numpy.exp(logw)))
+
+        qleaves = queries.leaves()
+        if (eps > 0.0):
+            centers = 0.5 * (queries.lo[qleaves] + queries.hi[qleaves])
+            near = self._descend(centers)
+            logS0 = numpy.empty(len(qleaves))
+            for k in range(len(qleaves)):
+                q = queries.points[queries.indices(qleaves[k])]
+                logS0[k] = numpy.min(_logsumexp_rows(self._block(q, self.indices(near[k]), logw)))
+            with numpy.errstate(invalid='ignore'):
+                max_d2 = 2.0 * (log_total - math.log(eps) - logS0)
+            max_d2[numpy.isnan(max_d2)] = numpy.inf
+        else:
+            max_d2 = numpy.empty(len(qleaves))
+            max_d2.fill(numpy.inf)
+
+        # Refine the pairs (query leaf, reference node) until only pairs of
+        # leaves remain
+        pq = numpy.arange(len(qleaves), dtype=int)
+        pr = numpy.zeros(len(qleaves), dtype=int)
+        done_q = []
+        done_r = []
+        while (len(pq) > 0):
+            qn = qleaves[pq]
+            d2 = self._min_dist2(queries.lo[qn], queries.hi[qn], pr)
+            keep = d2 < max_d2[pq]
+            pq = pq[keep]
+            pr = pr[keep]
+            leaf = self.left[pr] < 0
+            done_q.append(pq[leaf])
+            done_r.append(pr[leaf])
+            pq = numpy.tile(pq[~leaf], 2)
+            pr = numpy.concatenate((self.left[pr[~leaf]], self.right[pr[~leaf]]))
+
+        done_q = numpy.concatenate(done_q)
+        done_r = numpy.concatenate(done_r)
+        order = numpy.argsort(done_q, kind='mergesort')
+        splits = numpy.searchsorted(done_q[order], numpy.arange(1, len(qleaves)))
+        for (k, rleaves) in enumerate(numpy.split(done_r[order], splits)):
+            qind = queries.indices(qleaves[k])
+            rind = numpy.concatenate([self.indices(r) for r in rleaves])
+            yield (qind, rind,
+                   self._block(queries.points[qind], rind, logw) + lmax)
+
+    def kernel_sum(self, queries, logw, eps=1e-3):
+        """
+        Return log(sum_i exp(logw_i - 0.5*||q_j - z_i||^2)) for all queries
+        q_j, with a relative error of at most eps
+
+        Args:
+         - queries (KDTree): tree of the query points
+         - logw (array-like): log-weights of the points of this tree
+         - eps (float): bound on the relative weight of the skipped points
+
+        Returns:
+         (array-like) of length len(queries)
+        """
+        res = numpy.empty(len(queries))
+        for (qind, _rind, logk) in self.kernel_blocks(queries, logw, eps):
+            res[qind] = _logsumexp_rows(logk)
+        return res
+
+    def kernel_sample(self, queries, logw, eps=1e-3, rng=None):
+        """
+        For each query q_j draw an index i with probability proportional to
+        exp(logw_i - 0.5*||q_j - z_i||^2), restricted to the points kept by
+        the truncation
+
+        Args:
+         - queries (KDTree): tree of the query points
+         - logw (array-like): log-weights of the points of this tree
+         - eps (float): bound on the relative weight of the skipped points
+         - rng: random number generator, defaults to numpy.random. See
+           pyparticleest.utils.rng
+
+        Returns:
+         (array-like) of len(queries) sampled indices
+        """
+        if (rng is None):
+            rng = numpy.random
+        res = numpy.empty(len(queries), dtype=int)
+        for (qind, rind, logk) in self.kernel_blocks(queries, logw, eps):
+            w = numpy.exp(logk - numpy.max(logk, axis=1)[:, numpy.newaxis])
+            wc = numpy.cumsum(w, axis=1)
+            u = rng.random_sample(len(qind)) * wc[:, -1]
+            ind = numpy.sum(wc <= u[:, numpy.newaxis], axis=1)
+            res[qind] = rind[numpy.minimum(ind, len(rind) - 1)]
+        return res
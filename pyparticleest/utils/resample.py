@@ -0,0 +1,322 @@
+"""
+Resampling algorithms for particle approximations
+
+All the resamplers take a vector of (not necessarily normalized) weights
+and the number of indices to draw, and return the drawn indices. None of them
+relies on a binary search of the cumulative weights, the cost of each
+resampler is O(N + n) (O(B * n) for the Metropolis resampler). Except for
+the Metropolis and rejection resamplers the indices are returned in
+increasing order.
+
+@author: Jerker Nordh
+"""
+
+import functools
+import numpy
+from pyparticleest.utils.rng import get_rng
+
+
+def _normalized_cumsum(w):
+    wc = numpy.cumsum(w, dtype=float)
+    wc /= wc[-1]
+    wc[-1] = 1.0
+    return wc
+
+def _counts_from_cumulative(cnt, N):
+    """
+    Convert cumulative number of offspring to the ancestral indices
+
+    Args:
+     - cnt (array-like): cnt[i] is the number of indices <= i
+     - N (int): number of particles
+    """
+    counts = numpy.diff(numpy.concatenate(((0,), cnt)))
+    return numpy.repeat(numpy.arange(N, dtype=int), counts)
+
+def systematic(w, n, rng=None):
+    """
+    Systematic resampling, a single uniform random number is used to
+    create n evenly spaced points in [0, 1)
+
+    Args:
+     - w (array-like): probability weights
+     - n (int): number of indices to sample
+     - rng: random number generator, defaults to numpy.random. See
+       pyparticleest.utils.rng
+
+    Returns:
+     (array-like) of n sampled indices
+    """
+    rng = get_rng(rng)
+    N = len(w)
+    wc = _normalized_cumsum(w)
+    u0 = rng.rand()
+    # Number of points (k + u0) / n below each cumulative weight, the
+    # points are evenly spaced so this can be computed in closed form
+    cnt = numpy.floor(n * wc - u0).astype(int) + 1
+    numpy.clip(cnt, 0, n, out=cnt)
+    return _counts_from_cumulative(cnt, N)
+
+def stratified(w, n, rng=None):
+    """
+    Stratified resampling, one uniform random number is drawn in each of the
+    n strata [k/n, (k+1)/n)
+
+    Args:
+     - w (array-like): probability weights
+     - n (int): number of indices to sample
+     - rng: random number generator, defaults to numpy.random. See
+       pyparticleest.utils.rng
+
+    Returns:
+     (array-like) of n sampled indices
+    """
+    rng = get_rng(rng)
+    N = len(w)
+    wc = _normalized_cumsum(w)
+    r = rng.rand(n)
+    # All strata below floor(n*wc) lie entirely below wc, the stratum
+    # containing wc contributes if its point is below wc
+    nwc = n * wc
+    k = numpy.floor(nwc).astype(int)
+    numpy.clip(k, 0, n, out=k)
+    partial = k < n
+    cnt = numpy.copy(k)
+    cnt[partial] += (r[k[partial]] <= (nwc[partial] - k[partial]))
+    return _counts_from_cumulative(cnt, N)
+
+def multinomial(w, n, rng=None):
+    """
+    Multinomial resampling, n independent draws from the categorical
+    distribution defined by w
+
+    Args:
+     - w (array-like): probability weights
+     - n (int): number of indices to sample
+     - rng: random number generator, defaults to numpy.random. See
+       pyparticleest.utils.rng
+
+    Returns:
+     (array-like) of n sampled indices
+    """
+    rng = get_rng(rng)
+    N = len(w)
+    p = numpy.asarray(w, dtype=float) / numpy.sum(w)
+    counts = rng.multinomial(n, p)
+    return numpy.repeat(numpy.arange(N, dtype=int), counts)
+
+def residual(w, n, rng=None):
+    """
+    Residual resampling, each particle is first deterministically given
+    floor(n*w[i]) offspring, the remaining ones are drawn using multinomial
+    resampling of the residual weights
+
+    Args:
+     - w (array-like): probability weights
+     - n (int): number of indices to sample
+     - rng: random number generator, defaults to numpy.random. See
+       pyparticleest.utils.rng
+
+    Returns:
+     (array-like) of n sampled indices
+    """
+    rng = get_rng(rng)
+    N = len(w)
+    nw = n * numpy.asarray(w, dtype=float) / numpy.sum(w)
+    counts = numpy.floor(nw).astype(int)
+    nres = n - numpy.sum(counts)
+    if (nres > 0):
+        wres = nw - counts
+        counts += rng.multinomial(nres, wres / numpy.sum(wres))
+    return numpy.repeat(numpy.arange(N, dtype=int), counts)
+
+def metropolis(w, n, B=20, rng=None):
+    """
+    Metropolis resampling, runs B steps of an independent Metropolis chain
+    for each of the n indices. Does not require the weights to be normalized
+    and avoids all collective operations (sums) over the weights, the result
+    is biased unless B is large enough for the chains to mix.
+
+    Based on "Parallel resampling in the particle filter" by
+    Murray, Lee and Jacob.
+
+    Args:
+     - w (array-like): probability weights
+     - n (int): number of indices to sample
+     - B (int): number of Metropolis steps
+     - rng: random number generator, defaults to numpy.random. See
+       pyparticleest.utils.rng
+
+    Returns:
+     (array-like) of n sampled indices
+    """
+    rng = get_rng(rng)
+    w = numpy.asarray(w, dtype=float)
+    N = len(w)
+    ind = numpy.arange(n, dtype=int) % N
+    for _i in range(B):
+        prop = rng.randint(0, N, size=n)
+        u = rng.rand(n)
+        accept = u * w[ind] <= w[prop]
+        ind[accept] = prop[accept]
+    return ind
+
+def rejection(w, n, rng=None):
+    """
+    Rejection resampling, for each index proposes particles uniformly and
+    accepts them with probability w[j]/max(w). Unbiased, but the run time
+    depends on the spread of the weights.
+
+    Based on "Parallel resampling in the particle filter" by
+    Murray, Lee and Jacob.
+
+    Args:
+     - w (array-like): probability weights
+     - n (int): number of indices to sample
+     - rng: random number generator, defaults to numpy.random. See
+       pyparticleest.utils.rng
+
+    Returns:
+     (array-like) of n sampled indices
+    """
+    rng = get_rng(rng)
+    w = numpy.asarray(w, dtype=float)
+    N = len(w)
+    wmax = numpy.max(w)
+    ind = numpy.empty(n, dtype=int)
+    todo = numpy.arange(n, dtype=int)
+    while (len(todo) > 0):
+        prop = rng.randint(0, N, size=len(todo))
+        u = rng.rand(len(todo))
+        accept = u * wmax <= w[prop]
+        ind[todo[accept]] = prop[accept]
+        todo = todo[~accept]
+    return ind
+
+def systematic_segmented(w, n, rng=None):
+    """
+    Systematic resampling performed independently for each row of w, used
+    when several independent particle approximations are stored in one array
+
+    Args:
+     - w (array-like): (K, N) probability weights, one row for each segment
+     - n (int): number of indices to sample for each segment
+     - rng: random number generator, defaults to numpy.random. See
+       pyparticleest.utils.rng
+
+    Returns:
+     (K, n) array of sampled indices, w[k, ind[k]] are the weights of the
+     particles sampled from segment k
+    """
+    rng = get_rng(rng)
+    w = numpy.asarray(w, dtype=float)
+    (K, N) = w.shape
+    wc = numpy.cumsum(w, axis=1)
+    wc /= wc[:, -1:]
+    wc[:, -1] = 1.0
+    u0 = rng.rand(K, 1)
+    cnt = numpy.floor(n * wc - u0).astype(int) + 1
+    numpy.clip(cnt, 0, n, out=cnt)
+    counts = numpy.diff(numpy.hstack((numpy.zeros((K, 1), dtype=int), cnt)), axis=1)
+    ind = numpy.repeat(numpy.tile(numpy.arange(N, dtype=int), K), counts.ravel())
+    return ind.reshape((K, n))
+
+class AliasTable(object):
+    """
+    Walker's alias table for drawing independent samples from one
+    categorical distribution many times. Building the table is O(N log N),
+    each draw is O(1) using two random numbers.
+
+    The table is constructed without an explicit loop over the particles:
+    the deficits (1 - q) of the buckets with q = N*w < 1 are filled in order
+    from the surpluses (q - 1) of the buckets with q >= 1, a surplus bucket
+    that has given away more than its surplus becomes an alias for the
+    next surplus bucket. This gives the same kind of table as Vose's method.
+
+    Args:
+     - w (array-like): probability weights
+    """
+    def __init__(self, w):
+        w = numpy.asarray(w, dtype=float)
+        N = len(w)
+        q = w * (N / numpy.sum(w))
+        self.N = N
+        self.prob = numpy.ones(N)
+        self.alias = numpy.arange(N, dtype=int)
+
+        small = numpy.nonzero(q < 1.0)[0]
+        large = numpy.nonzero(q >= 1.0)[0]
+        if (len(small) == 0 or len(large) == 0):
+            return
+
+        deficit = 1.0 - q[small]
+        dend = numpy.cumsum(deficit)
+        dstart = dend - deficit
+        surplus = numpy.cumsum(q[large] - 1.0)
+
+        # Each small bucket takes its deficit from the large bucket whose
+        # surplus interval contains the start of the deficit
+        j = numpy.searchsorted(surplus, dstart, side='right')
+        numpy.clip(j, 0, len(large) - 1, out=j)
+        self.prob[small] = q[small]
+        self.alias[small] = large[j]
+
+        # Amount taken from each large bucket beyond its surplus, it then
+        # takes the remaining probability mass from the next large bucket
+        last = numpy.searchsorted(dstart, surplus, side='left') - 1
+        over = numpy.where(last >= 0, dend[numpy.maximum(last, 0)] - surplus, 0.0)
+        over[-1] = 0.0
+        over = numpy.clip(over, 0.0, 1.0)
+        exhausted = numpy.nonzero(over > 0.0)[0]
+        self.prob[large[exhausted]] = 1.0 - over[exhausted]
+        self.alias[large[exhausted]] = large[exhausted + 1]
+
+    def sample(self, n, rng=None):
+        """
+        Draw n independent indices
+
+        Args:
+         - n (int): number of indices to draw
+         - rng: random number generator, defaults to numpy.random. See
+           pyparticleest.utils.rng
+
+        Returns:
+         (array-like) of n sampled indices
+        """
+        rng = get_rng(rng)
+        ind = rng.randint(0, self.N, size=n)
+        u = rng.rand(n)
+        return numpy.where(u < self.prob[ind], ind, self.alias[ind])
+
+
+resamplers = {'systematic': systematic,
+              'stratified': stratified,
+              'multinomial': multinomial,
+              'residual': residual,
+              'metropolis': metropolis,
+              'rejection': rejection, }
+
+def get_resampler(resampler, rng=None):
+    """
+    Look up resampling function
+
+    Args:
+     - resampler (string/callable): name of one of the resamplers in this
+       module, or a function with the signature f(w, n) returning n indices
+     - rng: random number generator used by the resamplers in this module,
+       defaults to numpy.random. Other functions are responsible for their
+       own random numbers.
+
+    Returns:
+     (callable) resampling function f(w, n)
+    """
+    if (resampler is None):
+        resampler = systematic
+    elif (not callable(resampler)):
+        try:
+            resampler = resamplers[resampler.lower()]
+        except KeyError:
+            raise ValueError('Unknown resampler: %s' % resampler)
+    if (rng is None or resampler not in resamplers.values()):
+        return resampler
+    return functools.partial(resampler, rng=get_rng(rng))
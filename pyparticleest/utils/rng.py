@@ -0,0 +1,191 @@
+"""
+Random number generators
+
+All the random numbers in the framework are drawn from an explicit random
+number generator with the interface of numpy.random.RandomState, by default
+the global numpy.random. 'get_rng' converts seeds and numpy.random.Generator
+objects to such a generator, 'spawn' creates independent streams for
+running several filters in parallel, e.g. one for each worker.
+
+Example:
+    rng = get_rng(1234)
+    sim = Simulator(model, u, y, rng=rng)
+    ...
+    streams = spawn(rng, 4)
+
+@author: Jerker Nordh
+"""
+
+import numpy
+try:
+    from numpy.random import Generator, SeedSequence
+except ImportError:
+    # numpy < 1.17, only the RandomState interface is available
+    Generator = None
+    SeedSequence = None
+
+
+class GeneratorAdapter(object):
+    """
+    Wrap a numpy.random.Generator to provide the subset of the
+    numpy.random.RandomState interface used in this package (rand, randint,
+    random_sample). All other attributes are forwarded to the generator.
+
+    Args:
+     - generator (numpy.random.Generator): the wrapped generator
+    """
+    def __init__(self, generator):
+        self.generator = generator
+
+    def __getattr__(self, name):
+        # Only called for the attributes not defined by the adapter
+        if (name.startswith('__') or name == 'generator'):
+            raise AttributeError(name)
+        return getattr(self.generator, name)
+
+    def rand(self, *args):
+        if (len(args) == 0):
+            return self.generator.random()
+        return self.generator.random(args)
+
+    def random_sample(self, size=None):
+        return self.generator.random(size)
+
+    def randn(self, *args):
+        if (len(args) == 0):
+            return self.generator.standard_normal()
+        return self.generator.standard_normal(args)
+
+    def randint(self, low, high=None, size=None, dtype=int):
+        return self.generator.integers(low, high, size=size, dtype=dtype)
+
+
+def get_rng(rng=None):
+    """
+    Convert rng to a random number generator with the interface of
+    numpy.random.RandomState
+
+    Args:
+     - rng: None (the global numpy.random), an integer seed, a
+       numpy.random.SeedSequence, a numpy.random.Generator or an object with
+       the RandomState interface (returned unchanged)
+
+    Returns:
+     random number generator
+    """
+    if (rng is None):
+        return numpy.random
+    if (isinstance(rng, (int, numpy.integer))):
+        if (Generator is None):
+            return numpy.random.RandomState(rng)
+        return GeneratorAdapter(numpy.random.default_rng(rng))
+    if (SeedSequence is not None and isinstance(rng, SeedSequence)):
+        return GeneratorAdapter(numpy.random.default_rng(rng))
+    if (Generator is not None and isinstance(rng, Generator)):
+        return GeneratorAdapter(rng)
+    return rng
+
+
+def _seed_sequence(rng):
+    if (isinstance(rng, GeneratorAdapter)):
+        rng = rng.generator
+    if (isinstance(rng, SeedSequence)):
+        return rng
+    if (isinstance(rng, (int, numpy.integer))):
+        return SeedSequence(int(rng))
+    if (isinstance(rng, Generator)):
+        seq = getattr(rng.bit_generator, 'seed_seq', None)
+        if (seq is None):
+            seq = rng.bit_generator._seed_seq
+        if (isinstance(seq, SeedSequence)):
+            return seq
+    # No seed sequence available (e.g. the global numpy.random), derive the
+    # entropy from the generator so the streams are reproducible given its state
+    return SeedSequence(get_rng(rng).randint(0, 2 ** 31 - 1, size=4))
+
+
+def spawn(rng, n):
+    """
+    Create n independent random number generators, e.g. one for each
+    worker when running in parallel. Generators created from a seed,
+    SeedSequence or Generator use numpy.random.SeedSequence.spawn, so calling
+    spawn repeatedly on the same rng gives new independent streams each time.
+    Otherwise the entropy is drawn from rng.
+
+    Args:
+     - rng: source of the streams, see get_rng
+     - n (int): number of generators to create
+
+    Returns:
+     (list) of n random number generators
+    """
+    if (SeedSequence is None):
+        seeds = get_rng(rng).randint(0, 2 ** 31 - 1, size=n)
+        return [numpy.random.RandomState(seed) for seed in seeds]
+    return [GeneratorAdapter(numpy.random.default_rng(seq))
+            for seq in _seed_sequence(rng).spawn(n)]
+
+
+def _json_compatible(obj):
+    if (isinstance(obj, dict)):
+        return dict((key, _json_compatible(val)) for (key, val) in obj.items())
+    if (isinstance(obj, (list, tuple))):
+        return [_json_compatible(val) for val in obj]
+    if (isinstance(obj, numpy.ndarray)):
+        return obj.tolist()
+    if (isinstance(obj, numpy.integer)):
+        return int(obj)
+    if (isinstance(obj, numpy.floating)):
+        return float(obj)
+    return obj
+
+
+def get_state(rng):
+    """
+    Get the state of a random number generator in a form that can be
+    stored as JSON, used when saving checkpoints
+
+    Args:
+     - rng: random number generator, see get_rng
+
+    Returns:
+     (dict) the state, None if the state of rng can not be retrieved
+    """
+    rng = get_rng(rng)
+    if (isinstance(rng, GeneratorAdapter)):
+        return {'type': 'generator',
+                'state': _json_compatible(rng.generator.bit_generator.state)}
+    if (hasattr(rng, 'get_state')):
+        return {'type': 'randomstate',
+                'global': rng is numpy.random,
+                'state': _json_compatible(rng.get_state())}
+    return None
+
+
+def from_state(state):
+    """
+    Recreate a random number generator from the output of get_state. When
+    the state was retrieved from the global numpy.random its state is
+    restored and numpy.random is returned.
+
+    Args:
+     - state (dict): state returned by get_state
+
+    Returns:
+     random number generator, see get_rng
+    """
+    if (state['type'] == 'generator'):
+        bit_generator = getattr(numpy.random, state['state']['bit_generator'])()
+        bit_generator.state = state['state']
+        return GeneratorAdapter(Generator(bit_generator))
+    if (state['type'] == 'randomstate'):
+        (name, keys, pos, has_gauss, cached_gaussian) = state['state']
+        st = (name, numpy.asarray(keys, dtype=numpy.uint32), pos, has_gauss,
+              cached_gaussian)
+        if (state['global']):
+            numpy.random.set_state(st)
+            return numpy.random
+        rng = numpy.random.RandomState()
+        rng.set_state(st)
+        return rng
+    raise ValueError('Unknown random number generator state: %s' % state['type'])
@@ -0,0 +1,56 @@
+'''
+Created on Oct 16, 2026
+
+@author: ajn
+'''
+import unittest
+from pyparticleest.utils.adaptive import KLDSampling, ESSTarget
+from pyparticleest.filter import ParticleApproximation
+import numpy
+import math
+
+class Test(unittest.TestCase):
+
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+
+    def testKLD(self):
+        # 10 equally weighted bins
+        part = numpy.repeat(numpy.arange(10.0), 10).reshape((-1, 1))
+        pa = ParticleApproximation(part)
+        kld = KLDSampling(1.0, epsilon=0.05, delta=0.01, N_min=1)
+        self.assertEqual(kld.count_bins(pa), 10)
+        a = 2.0 / 81.0
+        N = 9.0 / 0.1 * (1.0 - a + math.sqrt(a) * 2.3263478740) ** 3
+        self.assertEqual(kld(pa), math.ceil(N))
+        # Negligible weight on all but one bin
+        w = numpy.zeros(len(part))
+        w[10:] = -100.0
+        pa.w = w
+        self.assertEqual(kld(pa), 1)
+
+    def testKLDMultidim(self):
+        # 3x4 bins in two dimensions, including negative coordinates, each
+        # bin is only distinct in one of the components from some other bin
+        (x, y) = numpy.meshgrid(numpy.arange(-1.5, 1.5), numpy.arange(-2.5, 1.5))
+        part = numpy.repeat(numpy.vstack((x.ravel(), y.ravel())).T, 5, 0)
+        pa = ParticleApproximation(part)
+        self.assertEqual(KLDSampling((1.0, 1.0)).count_bins(pa), 12)
+        self.assertEqual(KLDSampling((1.0, 10.0)).count_bins(pa), 6)
+
+    def testESS(self):
+        w = numpy.zeros(100)
+        w[50:] = -numpy.inf
+        pa = ParticleApproximation(numpy.zeros((100, 1)), w)
+        self.assertAlmostEqual(ESSTarget(100, N_max=1000)(pa), 200, delta=1)
+        self.assertEqual(ESSTarget(1000, N_max=1000)(pa), 1000)
+
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
@@ -0,0 +1,76 @@
+'''
+Created on Oct 16, 2026
+
+@author: ajn
+'''
+import unittest
+import pyparticleest.models.nlg as nlg
+import pyparticleest.smoother as smoother
+from pyparticleest.filter import ParticleApproximation, TrajectoryStep
+from pyparticleest.utils.intrument import Instrumenter
+import numpy
+import numpy.testing as npt
+
+class Model(nlg.NonlinearGaussianInitialGaussian):
+    """ x_{k+1} = x_k + v_k, v_k ~ N(0,1)
+        y_k = x_k + e_k, e_k ~ N(0,1),
+        x(0) ~ N(0,1) """
+
+    def __init__(self):
+        super(Model, self).__init__(x0=numpy.zeros((1, 1)),
+                                    Px0=numpy.eye(1), Q=numpy.eye(1),
+                                    R=numpy.eye(1))
+
+    def calc_f(self, particles, u, t):
+        return particles
+
+    def calc_g(self, particles, t):
+        return particles
+
+class Test(unittest.TestCase):
+
+
+    def setUp(self):
+        self.N = 20
+        self.part = numpy.linspace(-3.0, 3.0, self.N).reshape((-1, 1))
+        self.pa = ParticleApproximation(self.part)
+        self.ft = [TrajectoryStep(ParticleApproximation(numpy.asarray((2.5,)).reshape((-1, 1))))]
+
+    def tearDown(self):
+        pass
+
+    def testCache(self):
+        cache = smoother.BackwardCache(4)
+        cache.record(numpy.asarray((0, 2, 0)), numpy.asarray((1, 3, 1)),
+                     numpy.asarray((-1.0, -2.0, -1.0)))
+        cache.record(numpy.asarray((0,)), numpy.asarray((2,)), numpy.asarray((-3.0,)))
+        (ind, logp) = cache.get(0)
+        npt.assert_array_equal(ind, (1, 2))
+        npt.assert_array_equal(logp, (-1.0, -3.0))
+        self.assertEqual(len(cache.get(1)[0]), 0)
+        self.assertAlmostEqual(cache.mean_count(numpy.asarray((0, 1, 2))), 1.0)
+
+    def testFallback(self):
+        model = Instrumenter(Model())
+        M = 5000
+        R = 3
+        find = numpy.arange(M, dtype=int)
+        ft = [TrajectoryStep(ParticleApproximation(numpy.repeat(self.ft[0].pa.part, M, 0)))]
+        rng = numpy.random.RandomState(0)
+        # A bound far above the real maximum makes almost all proposals fail
+        ind = smoother.bsi_rs(model, self.pa, None, numpy.arange(self.N), ft, find,
+                              ut=[None], yt=[None], tt=[0], cur_ind=0,
+                              maxpdf=5.0, max_iter=R, rng=rng)
+        # Without the cache the fallback would evaluate N more densities for
+        # each trajectory, only repeated proposals are now evaluated twice
+        self.assertLess(model.oc.cnt_pdfxn, M * (self.N + 1))
+
+        w = model.logp_xnext(self.part, numpy.repeat(self.ft[0].pa.part, self.N, 0), None, 0)
+        w = numpy.exp(w - numpy.max(w))
+        npt.assert_array_almost_equal(numpy.bincount(ind, minlength=self.N) / float(M),
+                                      w / numpy.sum(w), 2)
+
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
@@ -0,0 +1,84 @@
+'''
+Created on Oct 16, 2026
+
+@author: ajn
+'''
+import unittest
+import shutil
+import tempfile
+import json
+import os
+import pyparticleest.models.nlg as nlg
+from pyparticleest.filter import ParticleTrajectory
+from pyparticleest.utils.rng import get_state, from_state
+import numpy
+import numpy.testing as npt
+
+class Model(nlg.NonlinearGaussianInitialGaussian):
+    """ x_{k+1} = sin(x_k) + v_k, v_k ~ N(0,1)
+        y_k = x_k + e_k, e_k ~ N(0,1),
+        x(0) ~ N(0,1) """
+
+    def __init__(self, rng=None):
+        super(Model, self).__init__(x0=numpy.zeros((1, 1)),
+                                    Px0=numpy.eye(1), Q=numpy.eye(1),
+                                    R=numpy.eye(1), rng=rng)
+
+    def calc_f(self, particles, u, t):
+        return numpy.sin(particles)
+
+    def calc_g(self, particles, t):
+        return particles
+
+class Test(unittest.TestCase):
+
+
+    def setUp(self):
+        self.y = numpy.random.RandomState(0).normal(size=30)
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def run_filter(self, pt, y):
+        for yt in y:
+            pt.forward(None, yt)
+
+    def testResume(self):
+        for storage in ('list', 'array'):
+            for precision in ('double', 'single'):
+                pt = ParticleTrajectory(Model(rng=1), 20, storage=storage,
+                                        precision=precision, rng=2)
+                pt.measure(self.y[0])
+                self.run_filter(pt, self.y[1:15])
+                pt.save(self.path)
+                # Continue from the same model random number stream
+                model = Model(rng=from_state(get_state(pt.pf.model.rng)))
+                self.run_filter(pt, self.y[15:])
+
+                pt2 = ParticleTrajectory.load(self.path, model)
+                self.assertEqual(pt2.precision, precision)
+                self.run_filter(pt2, self.y[15:])
+                self.assertEqual(len(pt2), len(pt))
+                self.assertEqual(pt2.logp_y, pt.logp_y)
+                for t in range(len(pt)):
+                    npt.assert_array_equal(pt2[t].pa.part, pt[t].pa.part)
+                    npt.assert_array_equal(pt2[t].pa.w, pt[t].pa.w)
+                    npt.assert_array_equal(pt2[t].ancestors, pt[t].ancestors)
+
+    def testVersion(self):
+        pt = ParticleTrajectory(Model(), 10)
+        pt.measure(self.y[0])
+        pt.save(self.path)
+        fname = os.path.join(self.path, 'checkpoint.json')
+        with open(fname, 'r') as f:
+            meta = json.load(f)
+        meta['version'] += 1
+        with open(fname, 'w') as f:
+            json.dump(meta, f)
+        self.assertRaises(ValueError, ParticleTrajectory.load, self.path, Model())
+
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
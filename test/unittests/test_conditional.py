@@ -0,0 +1,113 @@
+'''
+Created on Oct 16, 2026
+
+@author: ajn
+'''
+import unittest
+import pyparticleest.models.nlg as nlg
+from pyparticleest.simulator import Simulator
+from pyparticleest.filter import ParticleApproximation
+import numpy
+import numpy.testing as npt
+
+class Model(nlg.NonlinearGaussianInitialGaussian):
+    """ x_{k+1} = sin(x_k) + v_k, v_k ~ N(0,1)
+        y_k = x_k + e_k, e_k ~ N(0,1),
+        x(0) ~ N(0,1) """
+
+    def __init__(self, rng=None):
+        super(Model, self).__init__(x0=numpy.zeros((1, 1)),
+                                    Px0=numpy.eye(1), Q=numpy.eye(1),
+                                    R=numpy.eye(1), rng=rng)
+
+    def calc_f(self, particles, u, t):
+        return numpy.sin(particles)
+
+    def calc_g(self, particles, t):
+        return particles
+
+class Test(unittest.TestCase):
+
+
+    def setUp(self):
+        self.y = numpy.random.RandomState(0).normal(size=80)
+
+    def tearDown(self):
+        pass
+
+    def cond_traj(self, y):
+        sim = Simulator(Model(rng=2), None, y, rng=3)
+        sim.simulate(20, 1, filter='pf', smoother='ancestor', meas_first=True)
+        return sim.straj.traj
+
+    def run_filter(self, y, ctraj, filter, storage, iterations):
+        sim = Simulator(Model(rng=4), None, y, rng=5)
+        for _k in range(iterations):
+            sim.simulate_conditional(20, 0, ctraj, filter=filter,
+                                     meas_first=True, storage=storage)
+        return sim
+
+    def count_approximations(self, T, filter, storage):
+        """ Number of ParticleApproximation objects created by a rerun """
+        y = self.y[:T]
+        ctraj = self.cond_traj(y)
+        sim = self.run_filter(y, ctraj, filter, storage, 1)
+        count = [0]
+        init = ParticleApproximation.__init__
+        def counting_init(pa, *args, **kwargs):
+            count[0] += 1
+            init(pa, *args, **kwargs)
+        ParticleApproximation.__init__ = counting_init
+        try:
+            sim.simulate_conditional(20, 0, ctraj, filter=filter,
+                                     meas_first=True, storage=storage)
+        finally:
+            ParticleApproximation.__init__ = init
+        return count[0]
+
+    def testStorage(self):
+        ctraj = self.cond_traj(self.y)
+        cond = numpy.asarray([step.pa.part[0] for step in ctraj])
+        for filter in ('cpf', 'cpfas'):
+            ref = self.run_filter(self.y, ctraj, filter, 'list', 3)
+            sim = self.run_filter(self.y, ctraj, filter, 'array', 3)
+            # Writing the time steps in place gives the same estimates
+            self.assertAlmostEqual(sim.pt.logp_y, ref.pt.logp_y)
+            self.assertEqual(len(sim.pt.traj), len(ref.pt.traj))
+            for (s1, s2) in zip(ref.pt.traj, sim.pt.traj):
+                npt.assert_array_equal(s1.pa.part, s2.pa.part)
+                npt.assert_array_almost_equal(s1.pa.w, s2.pa.w)
+                npt.assert_array_equal(s1.ancestors, s2.ancestors)
+            npt.assert_array_equal(sim.pt.traj.part[:, -1], cond)
+
+    def testInPlace(self):
+        ctraj = self.cond_traj(self.y)
+        for filter in ('cpf', 'cpfas'):
+            sim = self.run_filter(self.y, ctraj, filter, 'array', 1)
+            store = sim.pt.traj
+            arrays = (store._part, store._w, store._anc, store._w_offset)
+            steps = [store[t] for t in range(len(store))]
+            for _k in range(3):
+                sim.simulate_conditional(20, 0, ctraj, filter=filter,
+                                         meas_first=True)
+                # The arrays allocated on the first call are kept, and the
+                # time steps are views into them
+                self.assertIs(sim.pt.traj, store)
+                for (arr, cur) in zip(arrays, (store._part, store._w,
+                                               store._anc, store._w_offset)):
+                    self.assertIs(cur, arr)
+                for t in range(len(store)):
+                    self.assertIs(store[t], steps[t])
+
+    def testAllocations(self):
+        for filter in ('cpf', 'cpfas'):
+            # Independent of the length of the dataset with array storage
+            self.assertEqual(self.count_approximations(20, filter, 'array'),
+                             self.count_approximations(80, filter, 'array'))
+            self.assertGreater(self.count_approximations(80, filter, 'list'),
+                               self.count_approximations(20, filter, 'list'))
+
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
@@ -0,0 +1,90 @@
+'''
+Created on Oct 16, 2026
+
+@author: ajn
+'''
+import unittest
+import pyparticleest.models.nlg as nlg
+from pyparticleest.filter import ParticleTrajectory
+from pyparticleest.utils.correlated import CorrelatedRandomState, \
+    sort_first_component
+import numpy
+import numpy.testing as npt
+import math
+
+class Model(nlg.NonlinearGaussianInitialGaussian):
+    """ x_{k+1} = a*x_k + v_k, v_k ~ N(0,1)
+        y_k = x_k + e_k, e_k ~ N(0,0.1),
+        x(0) ~ N(0,1) """
+
+    def __init__(self, a):
+        self.a = a
+        super(Model, self).__init__(x0=numpy.zeros((1, 1)),
+                                    Px0=numpy.eye(1),
+                                    Q=numpy.eye(1),
+                                    R=0.1 * numpy.eye(1))
+
+    def calc_f(self, particles, u, t):
+        return self.a * particles
+
+    def calc_g(self, particles, t):
+        return particles
+
+class Test(unittest.TestCase):
+
+
+    def setUp(self):
+        numpy.random.seed(0)
+        self.T = 20
+        x = numpy.random.normal()
+        self.y = numpy.empty(self.T)
+        for t in range(self.T):
+            if (t > 0):
+                x = 0.9 * x + numpy.random.normal()
+            self.y[t] = x + math.sqrt(0.1) * numpy.random.normal()
+
+    def tearDown(self):
+        pass
+
+    def filter(self, a, rs, N=50):
+        rs.reset()
+        model = Model(a)
+        model.rng = rs
+        pt = ParticleTrajectory(model, N, resample=1.0, rng=rs,
+                                filter_options={'resample_order': sort_first_component})
+        pt.measure(self.y[0])
+        for t in range(1, self.T):
+            pt.forward(None, self.y[t])
+        return pt.logp_y
+
+    def testDistribution(self):
+        rs = CorrelatedRandomState(numpy.random.normal(size=400000))
+        u = rs.rand(100000)
+        self.assertAlmostEqual(numpy.mean(u), 0.5, 2)
+        self.assertAlmostEqual(numpy.var(u), 1.0 / 12.0, 2)
+        counts = rs.multinomial(100000, (0.2, 0.3, 0.5))
+        npt.assert_allclose(counts / 100000.0, (0.2, 0.3, 0.5), atol=0.01)
+        ind = rs.randint(3, 7, size=100000)
+        npt.assert_array_equal(numpy.unique(ind), (3, 4, 5, 6))
+        self.assertRaises(ValueError, rs.rand, 200001)
+
+    def testReproducible(self):
+        rs = CorrelatedRandomState(numpy.random.normal(size=(self.T + 1) * 51))
+        self.assertEqual(self.filter(0.9, rs), self.filter(0.9, rs))
+
+    def testCorrelated(self):
+        # The difference of the log-likelihood estimates for two nearby
+        # parameter values varies much less when using the same random numbers
+        d_crn = []
+        d_ind = []
+        for _i in range(10):
+            rs = CorrelatedRandomState(numpy.random.normal(size=(self.T + 1) * 51))
+            d_crn.append(self.filter(0.9, rs) - self.filter(0.92, rs))
+            rs2 = CorrelatedRandomState(numpy.random.normal(size=(self.T + 1) * 51))
+            d_ind.append(self.filter(0.9, rs) - self.filter(0.92, rs2))
+        self.assertLess(numpy.std(d_crn), numpy.std(d_ind))
+
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
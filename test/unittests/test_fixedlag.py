@@ -0,0 +1,99 @@
+'''
+Created on Oct 16, 2026
+
+@author: ajn
+'''
+import unittest
+import pyparticleest.models.nlg as nlg
+from pyparticleest.filter import ParticleTrajectory
+import numpy
+import numpy.testing as npt
+
+class Model(nlg.NonlinearGaussianInitialGaussian):
+    """ x_{k+1} = sin(x_k) + v_k, v_k ~ N(0,1)
+        y_k = x_k + e_k, e_k ~ N(0,1),
+        x(0) ~ N(0,1) """
+
+    def __init__(self):
+        super(Model, self).__init__(x0=numpy.zeros((1, 1)),
+                                    Px0=numpy.eye(1), Q=numpy.eye(1),
+                                    R=numpy.eye(1))
+
+    def calc_f(self, particles, u, t):
+        return numpy.sin(particles)
+
+    def calc_g(self, particles, t):
+        return particles
+
+class Test(unittest.TestCase):
+
+
+    def setUp(self):
+        self.y = numpy.random.RandomState(0).normal(size=60)
+
+    def tearDown(self):
+        pass
+
+    def lineage_estimate(self, pt):
+        L = pt.max_lag
+        w = pt.traj[-1].pa.get_normalized_weights()
+        ind = numpy.arange(len(w), dtype=int)
+        for k in range(1, L + 1):
+            ind = pt.traj[-k].ancestors[ind]
+        return numpy.tensordot(w, pt.traj[-(L + 1)].pa.part[ind], axes=(0, 0))
+
+    def testAncestral(self):
+        for L in (0, 1, 4):
+            pt = ParticleTrajectory(Model(), 20, max_lag=L, rng=1)
+            pt.measure(self.y[0])
+            for t in range(1, len(self.y)):
+                pt.forward(None, self.y[t])
+                if (t >= L):
+                    self.assertEqual(pt.fixed_lag_t, t - L)
+                    npt.assert_array_almost_equal(pt.fixed_lag_est,
+                                                  self.lineage_estimate(pt))
+                else:
+                    self.assertIsNone(pt.fixed_lag_t)
+
+    def testBoundedMemory(self):
+        L = 3
+        for storage in ('list', 'array'):
+            pt = ParticleTrajectory(Model(), 20, max_lag=L, rng=1,
+                                    storage=storage, utype=float, ytype=float)
+            pt.measure(self.y[0])
+            for t in range(1, len(self.y)):
+                pt.forward(None, self.y[t])
+                self.assertLessEqual(len(pt.traj), 2 * (L + 1))
+                self.assertGreaterEqual(len(pt.traj), min(t + 1, L + 1))
+                # The indices are relative to the oldest retained time step
+                self.assertEqual(pt.offset + len(pt.traj) - 1, t)
+                self.assertEqual(pt.ind, len(pt.traj) - 1)
+                npt.assert_array_equal(pt.tvec[:pt.ind + 1],
+                                       numpy.arange(pt.offset, t + 1))
+                npt.assert_array_equal(pt.yvec[:pt.ind + 1],
+                                       self.y[pt.offset:t + 1])
+            self.assertGreater(pt.offset, 0)
+            # The data buffers aren't grown beyond what the window needs
+            self.assertLessEqual(pt.T, 4 * (L + 1))
+            if (storage == 'array'):
+                self.assertLessEqual(pt.traj.capacity, 4 * (L + 1))
+
+    def testBSI(self):
+        L = 5
+        pt = ParticleTrajectory(Model(), 20, max_lag=L, rng=1,
+                                lag_smoother='bsi', lag_options={'M': 5})
+        pt.measure(self.y[0])
+        for t in range(1, len(self.y)):
+            pt.forward(None, self.y[t])
+            if (t >= L):
+                self.assertEqual(pt.fixed_lag_t, t - L)
+                self.assertEqual(pt.fixed_lag_est.shape, (1,))
+                # Only the densities inside the window are kept
+                self.assertLessEqual(len(pt.lag_estimator._cache), L)
+        self.assertRaises(ValueError, ParticleTrajectory, Model(), 20,
+                          max_lag=L, lag_smoother='none')
+
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
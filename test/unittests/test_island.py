@@ -0,0 +1,84 @@
+'''
+Created on Oct 16, 2026
+
+@author: ajn
+'''
+import unittest
+import pyparticleest.models.nlg as nlg
+from pyparticleest.filter import ParticleTrajectory
+from pyparticleest.island import IslandParticleFilter, InProcessTransport, \
+    PipeTransport
+from pyparticleest.utils.rng import spawn
+import numpy
+import numpy.testing as npt
+
+class Model(nlg.NonlinearGaussianInitialGaussian):
+    """ x_{k+1} = sin(x_k) + v_k, v_k ~ N(0,Q)
+        y_k = x_k + e_k, e_k ~ N(0,R),
+        x(0) ~ N(0,P0) """
+
+    def __init__(self, P0, Q, R):
+        x0 = numpy.zeros((1, 1))
+        super(Model, self).__init__(x0=x0,
+                                    Px0=numpy.asarray(P0).reshape((1, 1)),
+                                    Q=numpy.asarray(Q).reshape((1, 1)),
+                                    R=numpy.asarray(R).reshape((1, 1)))
+
+    def calc_f(self, particles, u, t):
+        return numpy.sin(particles)
+
+    def calc_g(self, particles, t):
+        return particles
+
+class Test(unittest.TestCase):
+
+
+    def setUp(self):
+        # The tests seed the global generator, restore it afterwards
+        self.state = numpy.random.get_state()
+        numpy.random.seed(0)
+        self.model = Model(1.0, 1.0, 1.0)
+        self.y = numpy.random.normal(size=(20,))
+
+    def tearDown(self):
+        numpy.random.set_state(self.state)
+
+    def run_filter(self, pf):
+        pf.measure(self.y[0])
+        for t in range(1, len(self.y)):
+            pf.forward(None, self.y[t])
+
+    def testSingleIsland(self):
+        # A single island is identical to a regular particle filter
+        ipf = IslandParticleFilter(self.model, 50, 1, seed=1,
+                                   transport=InProcessTransport())
+        self.run_filter(ipf)
+        ipf.close()
+
+        # The island uses the second stream spawned from the seed
+        rng = spawn(1, 2)[1]
+        self.model.rng = rng
+        pt = ParticleTrajectory(self.model, 50, rng=rng)
+        self.run_filter(pt)
+        self.assertAlmostEqual(ipf.logp_y, pt.logp_y)
+        npt.assert_array_almost_equal(ipf.get_filtered_mean()[-1],
+                                      pt.traj[-1].pa.part.T.dot(numpy.exp(pt.traj[-1].pa.w)) /
+                                      numpy.sum(numpy.exp(pt.traj[-1].pa.w)))
+
+    def testInteraction(self):
+        # Interact at every time step
+        ipf = IslandParticleFilter(self.model, 100, 4, island_res=2.0, seed=1,
+                                   transport=PipeTransport())
+        self.run_filter(ipf)
+        ipf.close()
+        self.assertEqual(ipf.get_filtered_mean().shape, (len(self.y), 1))
+
+        numpy.random.seed(1)
+        pt = ParticleTrajectory(self.model, 4000)
+        self.run_filter(pt)
+        self.assertAlmostEqual(ipf.logp_y, pt.logp_y, delta=1.0)
+
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
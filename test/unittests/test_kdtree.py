@@ -0,0 +1,120 @@
+'''
+Created on Oct 16, 2026
+
+@author: ajn
+'''
+import unittest
+import pyparticleest.models.nlg as nlg
+from pyparticleest.simulator import Simulator
+from pyparticleest.utils.kdtree import KDTree
+from pyparticleest.utils.adaptive import ESSTarget
+import numpy
+import numpy.testing as npt
+import scipy.special
+
+class Model(nlg.NonlinearGaussianInitialGaussian):
+    """ x_{k+1} = 0.8*x_k + v_k, v_k ~ N(0,1)
+        y_k = x_k + e_k, e_k ~ N(0,1),
+        x(0) ~ N(0,1) """
+
+    def __init__(self):
+        super(Model, self).__init__(x0=numpy.zeros((1, 1)),
+                                    Px0=numpy.eye(1), Q=numpy.eye(1),
+                                    R=numpy.eye(1))
+
+    def calc_f(self, particles, u, t):
+        return 0.8 * particles
+
+    def calc_g(self, particles, t):
+        return particles
+
+def rts_means(y):
+    """ Smoothed means for the model above """
+    T = len(y)
+    (m, P) = (numpy.zeros(T), numpy.zeros(T))
+    (mp, Pp) = (0.0, 1.0)
+    for t in range(T):
+        K = Pp / (Pp + 1.0)
+        m[t] = mp + K * (y[t] - mp)
+        P[t] = (1.0 - K) * Pp
+        (mp, Pp) = (0.8 * m[t], 0.64 * P[t] + 1.0)
+    ms = numpy.copy(m)
+    for t in reversed(range(T - 1)):
+        G = 0.8 * P[t] / (0.64 * P[t] + 1.0)
+        ms[t] = m[t] + G * (ms[t + 1] - 0.8 * m[t])
+    return ms
+
+class Test(unittest.TestCase):
+
+
+    def setUp(self):
+        rs = numpy.random.RandomState(0)
+        self.z = rs.normal(size=(500, 2)) * 10.0
+        self.q = rs.normal(size=(300, 2)) * 10.0
+        self.logw = rs.normal(size=500)
+        diff = self.q[:, numpy.newaxis, :] - self.z[numpy.newaxis, :, :]
+        self.logk = self.logw - 0.5 * numpy.sum(diff ** 2, axis=2)
+
+        self.T = 30
+        x = rs.normal()
+        self.y = numpy.empty(self.T)
+        for t in range(self.T):
+            if (t > 0):
+                x = 0.8 * x + rs.normal()
+            self.y[t] = x + rs.normal()
+
+    def tearDown(self):
+        pass
+
+    def testExactSum(self):
+        tree = KDTree(self.z, leaf_size=8)
+        res = tree.kernel_sum(KDTree(self.q, leaf_size=8), self.logw, eps=0.0)
+        npt.assert_array_almost_equal(res, scipy.special.logsumexp(self.logk, axis=1))
+
+    def testTruncatedSum(self):
+        tree = KDTree(self.z, leaf_size=8)
+        eps = 1e-3
+        res = tree.kernel_sum(KDTree(self.q, leaf_size=8), self.logw, eps=eps)
+        correct = scipy.special.logsumexp(self.logk, axis=1)
+        self.assertTrue(numpy.all(res <= correct + 1e-12))
+        self.assertTrue(numpy.all(res >= correct + numpy.log1p(-eps)))
+        # Only a fraction of all the pairs are evaluated
+        evaluated = sum(logk.size for (_q, _r, logk) in
+                        tree.kernel_blocks(KDTree(self.q, leaf_size=8), self.logw, eps))
+        self.assertLess(evaluated, self.logk.size / 2)
+
+    def testSample(self):
+        tree = KDTree(self.z[:5], leaf_size=2)
+        q = numpy.zeros((20000, 2))
+        rng = numpy.random.RandomState(1)
+        ind = tree.kernel_sample(KDTree(q, leaf_size=2), self.logw[:5], eps=0.0, rng=rng)
+        p = numpy.exp(self.logw[:5] - 0.5 * numpy.sum(self.z[:5] ** 2, axis=1))
+        p /= numpy.sum(p)
+        npt.assert_array_almost_equal(numpy.bincount(ind, minlength=5) / 20000.0, p, 2)
+
+    def testSmoothers(self):
+        ms = rts_means(self.y)
+        sim = Simulator(Model(), None, self.y, rng=1)
+        sim.simulate(300, 100, smoother='kdtree', meas_first=True)
+        est = sim.get_smoothed_mean().ravel()
+        self.assertLess(numpy.max(numpy.abs(est - ms)), 0.5)
+
+        sim = Simulator(Model(), None, self.y, rng=1)
+        sim.simulate(300, 1, smoother='ffbsm', meas_first=True)
+        est = sim.get_smoothed_mean().ravel()
+        self.assertLess(numpy.max(numpy.abs(est - ms)), 0.3)
+
+    def testVaryingN(self):
+        ms = rts_means(self.y)
+        sim = Simulator(Model(), None, self.y, rng=1)
+        sim.simulate(300, 1, smoother='ffbsm', meas_first=True,
+                     filter_options={'adaptive': ESSTarget(250)})
+        self.assertGreater(len(set(len(step.pa) for step in sim.pt.traj)), 1)
+        est = sim.get_smoothed_mean().ravel()
+        self.assertLess(numpy.max(numpy.abs(est - ms)), 0.3)
+        self.assertRaises(ValueError, sim.get_smoothed_estimates)
+
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
@@ -5,6 +5,8 @@ Created on Jul 23, 2015
 '''
 import unittest
 import pyparticleest.models.nlg as nlg
+import pyparticleest.smoother as smoother
+from pyparticleest.filter import ParticleApproximation, TrajectoryStep
 import numpy
 import numpy.testing as npt
 import math
@@ -27,6 +29,12 @@ class Model(nlg.NonlinearGaussianInitialGaussian):
     def calc_g(self, particles, t):
         return particles
 
+class AffineModel(Model):
+    """ Model with the affine measurement equation made explicit """
+
+    def get_meas_dynamics(self, t):
+        return (numpy.eye(1), None, None)
+
 class Test(unittest.TestCase):
 
 
@@ -54,6 +62,21 @@ class Test(unittest.TestCase):
 
         npt.assert_array_equal(logpy, logpy_correct)
 
+    def testScalarNoise(self):
+        model = Model(1.0, 4.0, 9.0)
+        particles = numpy.asarray((-1.0, 0.0, 2.0)).reshape((-1, 1))
+        y = 1.0
+        logpy = model.measure(particles, y, None)
+        logpy_correct = (-0.5 * math.log(2.0 * math.pi * 9.0) -
+                         0.5 * (y - particles.ravel()) ** 2 / 9.0)
+        npt.assert_array_almost_equal(logpy, logpy_correct)
+
+        nxt = numpy.asarray((0.5, -0.5, 1.0)).reshape((-1, 1))
+        lpx = model.logp_xnext(particles, nxt, None, 0)
+        lpx_correct = (-0.5 * math.log(2.0 * math.pi * 4.0) -
+                       0.5 * (nxt - numpy.sin(particles)).ravel() ** 2 / 4.0)
+        npt.assert_array_almost_equal(lpx, lpx_correct)
+
     def testInitial(self):
         N = 10000000
         particles = self.model.create_initial_estimate(N)
@@ -63,6 +86,51 @@ class Test(unittest.TestCase):
         self.assertAlmostEqual(m, 0.0, 3)
         self.assertAlmostEqual(s, 1.0, 3)
 
+    def testAdapted(self):
+        model = AffineModel(1.0, 1.0, 1.0)
+        particles = numpy.asarray((-1.0, 0.0, 2.0)).reshape((-1, 1))
+        y = 0.5
+        # y_{t+1} | x_t ~ N(sin(x_t), Q + R)
+        logpy = model.eval_predictive_loglik(particles, None, y, 0)
+        logpy_correct = (-0.5 * math.log(2.0 * math.pi * 2.0) -
+                         0.25 * (y - numpy.sin(particles.ravel())) ** 2)
+        npt.assert_array_almost_equal(logpy, logpy_correct)
+        self.assertRaises(ValueError, self.model.eval_predictive_loglik,
+                          particles, None, y, 0)
+
+        # x_{t+1} | x_t, y_{t+1} ~ N((sin(x_t) + y) / 2, 1/2)
+        model.rng = numpy.random.RandomState(0)
+        part = model.sample_adapted(numpy.repeat(particles[2:], 100000, 0),
+                                    None, y, 0)
+        self.assertAlmostEqual(numpy.mean(part), (math.sin(2.0) + y) / 2.0, 2)
+        self.assertAlmostEqual(numpy.var(part), 0.5, 2)
+
+    def testBatch(self):
+        model = Model(1.0, 2.0, 1.0)
+        part = numpy.asarray((-1.0, 0.0, 2.0)).reshape((-1, 1))
+        nxt = numpy.asarray((0.5, -0.5)).reshape((-1, 1))
+        ft = [TrajectoryStep(ParticleApproximation(nxt))]
+        lpx = model.logp_xnext_full_batch(part, None, None, ft,
+                                          numpy.asarray((1, 0, 1)),
+                                          ut=[None], yt=[None], tt=[0],
+                                          cur_ind=0)
+        self.assertEqual(lpx.shape, (3, 3))
+        for (j, k) in enumerate((1, 0, 1)):
+            npt.assert_array_almost_equal(lpx[j],
+                                          model.logp_xnext(part, numpy.repeat(nxt[k:k + 1], 3, 0),
+                                                           None, 0))
+
+        # Batched and sequential sampling give the same distribution
+        pa = ParticleApproximation(part, numpy.asarray((0.0, -1.0, 0.5)))
+        find = numpy.zeros(20000, dtype=int)
+        rng = numpy.random.RandomState(1)
+        ind = smoother.bsi_full(model, pa, None, None, ft, find, ut=[None],
+                                yt=[None], tt=[0], cur_ind=0, rng=rng)
+        w = pa.w + model.logp_xnext(part, numpy.repeat(nxt[:1], 3, 0), None, 0)
+        w = numpy.exp(w - numpy.max(w))
+        npt.assert_array_almost_equal(numpy.bincount(ind, minlength=3) / 20000.0,
+                                      w / numpy.sum(w), 2)
+
 
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
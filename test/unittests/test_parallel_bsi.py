@@ -0,0 +1,100 @@
+'''
+Created on Oct 16, 2026
+
+@author: ajn
+'''
+import unittest
+import pyparticleest.models.nlg as nlg
+from pyparticleest.simulator import Simulator
+import numpy
+
+class Model(nlg.NonlinearGaussianInitialGaussian):
+    """ x_{k+1} = 0.8*x_k + v_k, v_k ~ N(0,1)
+        y_k = x_k + e_k, e_k ~ N(0,1),
+        x(0) ~ N(0,1) """
+
+    def __init__(self):
+        super(Model, self).__init__(x0=numpy.zeros((1, 1)),
+                                    Px0=numpy.eye(1), Q=numpy.eye(1),
+                                    R=numpy.eye(1))
+
+    def calc_f(self, particles, u, t):
+        return 0.8 * particles
+
+    def calc_g(self, particles, t):
+        return particles
+
+class ScratchModel(Model):
+    """ Model keeping scratch state between the calls """
+
+    def __init__(self):
+        super(ScratchModel, self).__init__()
+        self.scratch = []
+
+    def calc_f(self, particles, u, t):
+        self.scratch.append(t)
+        return super(ScratchModel, self).calc_f(particles, u, t)
+
+class Test(unittest.TestCase):
+
+
+    def setUp(self):
+        self.y = numpy.random.RandomState(0).normal(size=20)
+
+    def tearDown(self):
+        pass
+
+    def run_smoother(self, options, smoother='full', model=None, **kwargs):
+        if (model is None):
+            model = Model()
+        sim = Simulator(model, None, self.y, rng=3)
+        sim.simulate(100, 50, smoother=smoother, meas_first=True,
+                     smoother_options=options, **kwargs)
+        return sim
+
+    def testParallel(self):
+        ref = self.run_smoother(None)
+        for pool in ('process', 'thread'):
+            sim = self.run_smoother({'workers': 3, 'pool': pool})
+            est = sim.get_smoothed_estimates()
+            self.assertEqual(est.shape, (len(self.y), 50, 1))
+            # Same forward filter, the smoothed means only differ by the
+            # Monte Carlo error of the backward simulation
+            numpy.testing.assert_array_equal(sim.get_filtered_mean(),
+                                             ref.get_filtered_mean())
+            self.assertLess(numpy.max(numpy.abs(sim.get_smoothed_mean() -
+                                                ref.get_smoothed_mean())), 0.6)
+            # Reproducible given the seed
+            sim2 = self.run_smoother({'workers': 3, 'pool': pool})
+            numpy.testing.assert_array_equal(est, sim2.get_smoothed_estimates())
+
+    def testRejectionSampling(self):
+        sim = self.run_smoother({'workers': 2}, smoother='rs')
+        self.assertEqual(sim.get_smoothed_estimates().shape, (len(self.y), 50, 1))
+
+    def testMemmap(self):
+        # The memory mapped storage isn't forked, threads are used instead
+        # which gives the same result
+        ref = self.run_smoother({'workers': 2, 'pool': 'thread'})
+        sim = self.run_smoother({'workers': 2, 'pool': 'process'},
+                                storage='memmap',
+                                storage_options={'chunk_size': 4})
+        numpy.testing.assert_array_equal(sim.get_smoothed_estimates(),
+                                         ref.get_smoothed_estimates())
+        # The chunks were read by this process
+        self.assertIsNotNone(sim.pt.traj._executor)
+
+    def testModelCopy(self):
+        # Each thread works on its own copy of the model, only the forward
+        # filter uses the original
+        model = ScratchModel()
+        self.run_smoother(None, smoother=None, model=model)
+        calls = len(model.scratch)
+        model = ScratchModel()
+        self.run_smoother({'workers': 2, 'pool': 'thread'}, model=model)
+        self.assertEqual(len(model.scratch), calls)
+
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
@@ -0,0 +1,79 @@
+'''
+Created on Oct 16, 2026
+
+@author: ajn
+'''
+import unittest
+import pyparticleest.models.nlg as nlg
+from pyparticleest.simulator import Simulator
+import numpy
+
+class Model(nlg.NonlinearGaussianInitialGaussian):
+    """ x_{k+1} = 0.8*x_k + v_k, v_k ~ N(0,1)
+        y_k = x_k + e_k, e_k ~ N(0,1),
+        x(0) ~ N(0,1) """
+
+    def __init__(self):
+        super(Model, self).__init__(x0=numpy.zeros((1, 1)),
+                                    Px0=numpy.eye(1), Q=numpy.eye(1),
+                                    R=numpy.eye(1))
+
+    def calc_f(self, particles, u, t):
+        return 0.8 * particles
+
+    def calc_g(self, particles, t):
+        return particles
+
+def rts_smoother(y):
+    """ Smoothed means and E[x_t*x_{t+1}] for the model above """
+    T = len(y)
+    (m, P) = (numpy.zeros(T), numpy.zeros(T))
+    (mp, Pp) = (0.0, 1.0)
+    for t in range(T):
+        K = Pp / (Pp + 1.0)
+        m[t] = mp + K * (y[t] - mp)
+        P[t] = (1.0 - K) * Pp
+        (mp, Pp) = (0.8 * m[t], 0.64 * P[t] + 1.0)
+    (ms, Ps) = (numpy.copy(m), numpy.copy(P))
+    cross = numpy.zeros(T - 1)
+    for t in reversed(range(T - 1)):
+        G = 0.8 * P[t] / (0.64 * P[t] + 1.0)
+        ms[t] = m[t] + G * (ms[t + 1] - 0.8 * m[t])
+        Ps[t] = P[t] + G ** 2 * (Ps[t + 1] - (0.64 * P[t] + 1.0))
+        cross[t] = G * Ps[t + 1] + ms[t] * ms[t + 1]
+    return (ms, cross)
+
+class Test(unittest.TestCase):
+
+
+    def setUp(self):
+        rs = numpy.random.RandomState(0)
+        self.T = 30
+        x = rs.normal()
+        self.y = numpy.empty(self.T)
+        for t in range(self.T):
+            if (t > 0):
+                x = 0.8 * x + rs.normal()
+            self.y[t] = x + rs.normal()
+
+    def tearDown(self):
+        pass
+
+    def testAdditive(self):
+        def func(prev, part, u, y, t):
+            if (prev is None):
+                return numpy.hstack((part, numpy.zeros_like(part)))
+            return numpy.hstack((part, prev * part))
+
+        sim = Simulator(Model(), None, self.y, rng=1)
+        est = sim.smooth_additive(300, func, K=2, meas_first=True)
+        (ms, cross) = rts_smoother(self.y)
+        self.assertLess(abs(est[0] - numpy.sum(ms)), 1.5)
+        self.assertLess(abs(est[1] - numpy.sum(cross)), 10.0)
+        # Only the last time steps are kept
+        self.assertLessEqual(len(sim.pt.traj), 4)
+
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
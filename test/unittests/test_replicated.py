@@ -0,0 +1,89 @@
+'''
+Created on Oct 16, 2026
+
+@author: ajn
+'''
+import unittest
+import pyparticleest.models.nlg as nlg
+from pyparticleest.simulator import Simulator
+import numpy
+import numpy.testing as npt
+
+class Model(nlg.NonlinearGaussianInitialGaussian):
+    """ x_{k+1} = 0.9*x_k + v_k, v_k ~ N(0,1)
+        y_k = x_k + e_k, e_k ~ N(0,1),
+        x(0) ~ N(0,1) """
+
+    def __init__(self):
+        super(Model, self).__init__(x0=numpy.zeros((1, 1)),
+                                    Px0=numpy.eye(1), Q=numpy.eye(1),
+                                    R=numpy.eye(1))
+
+    def calc_f(self, particles, u, t):
+        return 0.9 * particles
+
+    def calc_g(self, particles, t):
+        return particles
+
+def kalman(y):
+    """ Filtered means and log p(y_{0:T}) for the model above """
+    m = numpy.zeros(len(y))
+    logp_y = 0.0
+    (mp, Pp) = (0.0, 1.0)
+    for t in range(len(y)):
+        S = Pp + 1.0
+        logp_y += -0.5 * (numpy.log(2.0 * numpy.pi * S) + (y[t] - mp) ** 2 / S)
+        m[t] = mp + Pp / S * (y[t] - mp)
+        P = Pp - Pp ** 2 / S
+        (mp, Pp) = (0.9 * m[t], 0.81 * P + 1.0)
+    return (m, logp_y)
+
+class Test(unittest.TestCase):
+
+
+    def setUp(self):
+        rs = numpy.random.RandomState(0)
+        self.T = 20
+        x = rs.normal()
+        self.y = numpy.empty(self.T)
+        for t in range(self.T):
+            if (t > 0):
+                x = 0.9 * x + rs.normal()
+            self.y[t] = x + rs.normal()
+        self.K = 8
+
+    def tearDown(self):
+        pass
+
+    def testLikelihood(self):
+        (m, logp_y) = kalman(self.y)
+        sim = Simulator(Model(), None, self.y, rng=3)
+        sim.simulate_replicates(2000, self.K, meas_first=True)
+
+        est = sim.get_replicated_loglikelihood()
+        self.assertEqual(est.shape, (self.K,))
+        # Each replicate is an estimate of the exact likelihood
+        npt.assert_allclose(est, logp_y, atol=0.5)
+        self.assertLess(abs(numpy.mean(est) - logp_y), 0.2)
+        # The replicates are independent
+        self.assertEqual(len(numpy.unique(est)), self.K)
+
+        mean = sim.get_replicated_mean()
+        self.assertEqual(mean.shape, (self.T, self.K, 1))
+        npt.assert_allclose(mean[:, :, 0], m[:, numpy.newaxis].repeat(self.K, 1),
+                            atol=0.2)
+
+    def testResampler(self):
+        (_m, logp_y) = kalman(self.y)
+        sim = Simulator(Model(), None, self.y, rng=3)
+        resamplings = sim.simulate_replicates(2000, self.K, meas_first=True,
+                                              resampler='stratified')
+        self.assertEqual(resamplings.shape, (self.K,))
+        self.assertTrue(numpy.all(resamplings > 0))
+        npt.assert_allclose(sim.get_replicated_loglikelihood(), logp_y, atol=0.5)
+        self.assertEqual(sim.get_replicated_mean().shape, (self.T, self.K, 1))
+
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
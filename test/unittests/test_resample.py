@@ -0,0 +1,82 @@
+'''
+Created on Oct 16, 2026
+
+@author: ajn
+'''
+import unittest
+import pyparticleest.utils.resample as resample
+import numpy
+import numpy.testing as npt
+
+class Test(unittest.TestCase):
+
+
+    def setUp(self):
+        numpy.random.seed(0)
+        self.w = numpy.asarray((0.1, 0.0, 0.45, 0.05, 0.4))
+
+    def tearDown(self):
+        pass
+
+
+    def testSystematic(self):
+        # Compare with the reference implementation based on searchsorted
+        N = 1000
+        for _i in range(100):
+            w = numpy.random.rand(50)
+            w[numpy.random.rand(50) < 0.2] = 0.0
+            numpy.random.seed(_i)
+            ind = resample.systematic(w, N)
+            numpy.random.seed(_i)
+            wc = numpy.cumsum(w)
+            wc /= wc[-1]
+            u = (numpy.arange(N) + numpy.random.rand(1)) / N
+            npt.assert_array_equal(ind, numpy.searchsorted(wc, u))
+
+    def testCounts(self):
+        N = 100000
+        for name in ('systematic', 'stratified', 'residual', 'multinomial',
+                     'metropolis', 'rejection'):
+            ind = resample.get_resampler(name)(self.w, N)
+            self.assertEqual(len(ind), N)
+            freq = numpy.bincount(ind, minlength=len(self.w)) / float(N)
+            npt.assert_array_almost_equal(freq, self.w, 2)
+
+    def testResidual(self):
+        N = 20
+        ind = resample.residual(self.w, N)
+        counts = numpy.bincount(ind, minlength=len(self.w))
+        # Deterministic part of the residual resampler
+        self.assertTrue(numpy.all(counts >= numpy.floor(N * self.w)))
+
+    def testSegmented(self):
+        # Each row should be identical to systematic resampling of that row
+        w = numpy.random.rand(10, 50)
+        w[numpy.random.rand(10, 50) < 0.2] = 0.0
+        numpy.random.seed(1)
+        ind = resample.systematic_segmented(w, 30)
+        numpy.random.seed(1)
+        for k in range(10):
+            npt.assert_array_equal(ind[k], resample.systematic(w[k], 30))
+
+    def testAliasTable(self):
+        for w in (self.w, numpy.asarray((0.0, 0.0, 1.0, 0.0)),
+                  numpy.exp(numpy.random.normal(scale=10.0, size=50))):
+            table = resample.AliasTable(w)
+            # Probability implied by the table
+            p = numpy.copy(table.prob)
+            numpy.add.at(p, table.alias, 1.0 - table.prob)
+            npt.assert_array_almost_equal(p / len(w), w / numpy.sum(w))
+
+        N = 100000
+        ind = resample.AliasTable(self.w).sample(N)
+        freq = numpy.bincount(ind, minlength=len(self.w)) / float(N)
+        npt.assert_array_almost_equal(freq, self.w, 2)
+
+    def testUnknown(self):
+        self.assertRaises(ValueError, resample.get_resampler, 'foo')
+
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
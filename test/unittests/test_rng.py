@@ -0,0 +1,93 @@
+'''
+Created on Oct 16, 2026
+
+@author: ajn
+'''
+import unittest
+import pyparticleest.models.nlg as nlg
+import pyparticleest.utils.resample as resample
+from pyparticleest.simulator import Simulator
+from pyparticleest.utils.rng import get_rng, spawn
+import numpy
+import numpy.testing as npt
+
+class Model(nlg.NonlinearGaussianInitialGaussian):
+    """ x_{k+1} = sin(x_k) + v_k, v_k ~ N(0,Q)
+        y_k = x_k + e_k, e_k ~ N(0,R),
+        x(0) ~ N(0,P0) """
+
+    def __init__(self, P0, Q, R, rng=None):
+        x0 = numpy.zeros((1, 1))
+        super(Model, self).__init__(x0=x0,
+                                    Px0=numpy.asarray(P0).reshape((1, 1)),
+                                    Q=numpy.asarray(Q).reshape((1, 1)),
+                                    R=numpy.asarray(R).reshape((1, 1)),
+                                    rng=rng)
+
+    def calc_f(self, particles, u, t):
+        return numpy.sin(particles)
+
+    def calc_g(self, particles, t):
+        return particles
+
+class Test(unittest.TestCase):
+
+
+    def setUp(self):
+        numpy.random.seed(0)
+        self.y = numpy.random.normal(size=(20,))
+
+    def tearDown(self):
+        pass
+
+    def simulate(self, rng, smoother):
+        sim = Simulator(Model(1.0, 1.0, 1.0), None, self.y, rng=rng)
+        sim.simulate(50, 5, smoother=smoother)
+        return (sim.get_filtered_mean(), sim.get_smoothed_mean())
+
+    def testReproducible(self):
+        for smoother in ('full', 'rs', 'mcmc', 'mhips'):
+            (fmean1, smean1) = self.simulate(5, smoother)
+            # Changing the global state must not affect the results
+            numpy.random.seed(1)
+            (fmean2, smean2) = self.simulate(numpy.random.default_rng(5), smoother)
+            npt.assert_array_equal(fmean1, fmean2)
+            npt.assert_array_equal(smean1, smean2)
+
+    def testWorkers(self):
+        # The stream of each run is used by the model also when it is
+        # wrapped by the Instrumenter, so the results don't depend on how the
+        # runs are divided between the workers
+        res = []
+        for workers in (1, 3):
+            sim = Simulator(Model(1.0, 1.0, 1.0), None, self.y, rng=5)
+            res.append(sim.simulate_many(6, 20, 0, workers=workers,
+                                         simulate_options={'smoother': None},
+                                         instrument=True))
+        npt.assert_array_equal(res[0][0], res[1][0])
+        npt.assert_array_equal(res[0][2], res[1][2])
+
+    def testSpawn(self):
+        # Spawning repeatedly from a generator gives new streams
+        rng = get_rng(3)
+        rngs = spawn(rng, 2) + spawn(rng, 2) + [rng]
+        u = [r.rand(10) for r in rngs]
+        for i in range(len(u)):
+            for j in range(i):
+                self.assertFalse(numpy.any(u[i] == u[j]))
+        # Spawning from a seed is reproducible
+        npt.assert_array_equal(spawn(3, 1)[0].rand(10), u[0])
+
+    def testResample(self):
+        w = numpy.asarray((0.1, 0.0, 0.45, 0.05, 0.4))
+        for name in ('systematic', 'stratified', 'residual', 'multinomial',
+                     'metropolis', 'rejection'):
+            ind1 = resample.get_resampler(name, get_rng(7))(w, 100)
+            ind2 = resample.get_resampler(name, numpy.random.default_rng(7))(w, 100)
+            npt.assert_array_equal(ind1, ind2)
+            self.assertEqual(numpy.count_nonzero(ind1 == 1), 0)
+
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
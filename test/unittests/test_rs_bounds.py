@@ -0,0 +1,114 @@
+'''
+Created on Oct 16, 2026
+
+@author: ajn
+'''
+import unittest
+import pyparticleest.models.nlg as nlg
+import pyparticleest.smoother as smoother
+import pyparticleest.interfaces as interfaces
+from pyparticleest.filter import ParticleApproximation, TrajectoryStep, \
+    _has_particle_bounds
+from pyparticleest.simulator import Simulator
+from pyparticleest.utils.intrument import Instrumenter
+import numpy
+import numpy.testing as npt
+
+class Model(nlg.NonlinearGaussianInitialGaussian):
+    """ x_{k+1} = x_k + v_k, v_k ~ N(0,Q(x_k)), Q(x_k) = 0.01 + x_k^2
+        y_k = x_k + e_k, e_k ~ N(0,1),
+        x(0) ~ N(0,1) """
+
+    def __init__(self):
+        super(Model, self).__init__(x0=numpy.zeros((1, 1)),
+                                    Px0=numpy.eye(1), Q=numpy.eye(1),
+                                    R=numpy.eye(1))
+
+    def calc_f(self, particles, u, t):
+        return particles
+
+    def calc_Q(self, particles, u, t):
+        return (0.01 + particles ** 2).reshape((-1, 1, 1))
+
+    def calc_g(self, particles, t):
+        return particles
+
+class ConstModel(Model):
+    """ Model with constant Q """
+
+    def calc_Q(self, particles, u, t):
+        return None
+
+class ScalarModel(interfaces.FFBSiRS):
+    """ Only provides the scalar bound """
+
+    def logp_xnext(self, particles, next_part, u, t):
+        return numpy.zeros(len(particles))
+
+    def logp_xnext_max(self, particles, u, t):
+        return 0.0
+
+class Test(unittest.TestCase):
+
+
+    def setUp(self):
+        self.model = Model()
+        self.N = 20
+        self.part = numpy.linspace(-3.0, 3.0, self.N).reshape((-1, 1))
+        self.pa = ParticleApproximation(self.part)
+        self.M = 2000
+        self.ft = [TrajectoryStep(ParticleApproximation(1.5 * numpy.ones((self.M, 1))))]
+
+    def tearDown(self):
+        pass
+
+    def testBounds(self):
+        pmax = self.model.logp_xnext_max_particles(self.part, None, 0)
+        Q = 0.01 + self.part.ravel() ** 2
+        npt.assert_array_almost_equal(pmax, -0.5 * numpy.log(2.0 * numpy.pi * Q))
+        self.assertAlmostEqual(self.model.logp_xnext_max(self.part, None, 0),
+                               numpy.max(pmax))
+
+    def run_rs(self, maxpdf):
+        model = Instrumenter(self.model)
+        rng = numpy.random.RandomState(0)
+        ind = smoother.bsi_rs(model, self.pa, None, numpy.arange(self.N), self.ft,
+                              numpy.arange(self.M), ut=[None], yt=[None], tt=[0],
+                              cur_ind=0, maxpdf=maxpdf, max_iter=10, rng=rng)
+        return (ind, model.oc.cnt_pdfxn)
+
+    def testRejectionSampling(self):
+        (ind, cnt) = self.run_rs(self.model.logp_xnext_max_particles(self.part, None, 0))
+        (_ind, cnt_scalar) = self.run_rs(self.model.logp_xnext_max(self.part, None, 0))
+        # The loose scalar bound mostly ends up in the full evaluation
+        self.assertLess(2 * cnt, cnt_scalar)
+
+        w = self.model.logp_xnext(self.part, 1.5 * numpy.ones((self.N, 1)), None, 0)
+        w = numpy.exp(w - numpy.max(w))
+        npt.assert_array_almost_equal(numpy.bincount(ind, minlength=self.N) / float(self.M),
+                                      w / numpy.sum(w), 2)
+
+    def testParticleBounds(self):
+        # The interface defaults only repeat the scalar bound
+        self.assertFalse(_has_particle_bounds(ScalarModel()))
+        self.assertFalse(_has_particle_bounds(Instrumenter(self.model)))
+        self.assertTrue(_has_particle_bounds(self.model))
+
+    def testSmoothing(self):
+        y = numpy.random.RandomState(0).normal(size=10)
+        for model in (self.model, ConstModel()):
+            for method in ('rs', 'rsas'):
+                sim = Simulator(model, None, y, rng=1)
+                sim.simulate(50, 10, smoother=method, meas_first=True)
+                # The smoothed trajectories are drawn from the particles
+                # of each time step
+                est = sim.get_smoothed_estimates()
+                self.assertEqual(est.shape, (len(y), 10, 1))
+                for t in range(len(y)):
+                    part = sim.pt.traj[t].pa.part.ravel()
+                    self.assertTrue(numpy.all(numpy.in1d(est[t].ravel(), part)))
+
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
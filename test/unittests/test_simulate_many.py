@@ -0,0 +1,84 @@
+'''
+Created on Oct 16, 2026
+
+@author: ajn
+'''
+import unittest
+import pyparticleest.models.nlg as nlg
+from pyparticleest.simulator import Simulator
+from pyparticleest.utils.intrument import OpCount
+import numpy
+import numpy.testing as npt
+
+class Model(nlg.NonlinearGaussianInitialGaussian):
+    """ x_{k+1} = x_k + v_k, v_k ~ N(0,1)
+        y_k = x_k + e_k, e_k ~ N(0,1),
+        x(0) ~ N(0,1) """
+
+    def __init__(self):
+        super(Model, self).__init__(x0=numpy.zeros((1, 1)),
+                                    Px0=numpy.eye(1), Q=numpy.eye(1),
+                                    R=numpy.eye(1))
+
+    def calc_f(self, particles, u, t):
+        return particles
+
+    def calc_g(self, particles, t):
+        return particles
+
+class Test(unittest.TestCase):
+
+
+    def setUp(self):
+        rs = numpy.random.RandomState(0)
+        self.T = 15
+        self.y = numpy.cumsum(rs.normal(size=self.T)) + rs.normal(size=self.T)
+        self.n_runs = 4
+
+    def tearDown(self):
+        pass
+
+    def simulate_many(self, workers, **kwargs):
+        sim = Simulator(Model(), None, self.y, rng=2)
+        return sim.simulate_many(self.n_runs, 30, 5, workers=workers,
+                                 simulate_options={'smoother': 'full'},
+                                 **kwargs)
+
+    def testShapes(self):
+        (fmean, smean, logp_y, opcounts) = self.simulate_many(2)
+        # The initial state is included since meas_first is False
+        self.assertEqual(fmean.shape, (self.n_runs, self.T + 1, 1))
+        self.assertEqual(smean.shape, (self.n_runs, self.T + 1, 1))
+        self.assertEqual(logp_y.shape, (self.n_runs,))
+        self.assertTrue(numpy.all(numpy.isfinite(logp_y)))
+        self.assertEqual(len(opcounts), self.n_runs)
+        for oc in opcounts:
+            self.assertTrue(isinstance(oc, OpCount))
+            self.assertGreater(oc.cnt_sample, 0)
+        # The runs are independent
+        self.assertFalse(numpy.all(fmean[0] == fmean[1]))
+
+        (_fmean, _smean, _logp_y, opcounts) = self.simulate_many(2, instrument=False)
+        self.assertEqual(opcounts, [None, ] * self.n_runs)
+
+    def testWorkers(self):
+        res1 = self.simulate_many(1)
+        res2 = self.simulate_many(2)
+        # One worker per cpu
+        res3 = self.simulate_many(None)
+        for i in range(3):
+            npt.assert_array_equal(res1[i], res2[i])
+            npt.assert_array_equal(res1[i], res3[i])
+        for (oc1, oc2) in zip(res1[3], res2[3]):
+            self.assertEqual(vars(oc1), vars(oc2))
+
+    def testSeeds(self):
+        res1 = self.simulate_many(2, seeds=range(self.n_runs))
+        res2 = self.simulate_many(1, seeds=range(self.n_runs))
+        npt.assert_array_equal(res1[0], res2[0])
+        npt.assert_array_equal(res1[1], res2[1])
+
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
@@ -0,0 +1,215 @@
+'''
+Created on Oct 16, 2026
+
+@author: ajn
+'''
+import unittest
+from pyparticleest.storage import ArrayTrajectory, MemmapTrajectory
+from pyparticleest.filter import ParticleApproximation, TrajectoryStep
+import numpy
+import numpy.testing as npt
+
+class Test(unittest.TestCase):
+
+
+    def setUp(self):
+        self.N = 5
+        self.store = ArrayTrajectory(T=2)
+        self.parts = list()
+        for t in range(10):
+            part = numpy.random.normal(size=(self.N, 2))
+            self.parts.append(part)
+            pa = ParticleApproximation(part)
+            self.store.append(TrajectoryStep(pa, numpy.arange(self.N)[::-1]))
+
+    def tearDown(self):
+        pass
+
+
+    def testAppend(self):
+        self.assertEqual(len(self.store), 10)
+        self.assertEqual(self.store.part.shape, (10, self.N, 2))
+        for t in range(10):
+            npt.assert_array_equal(self.store[t].pa.part, self.parts[t])
+            npt.assert_array_equal(self.store[t].ancestors,
+                                   numpy.arange(self.N)[::-1])
+        npt.assert_array_equal(self.store[-1].pa.part, self.parts[-1])
+
+    def testWriteThrough(self):
+        pa = self.store[3].pa
+        pa.w = pa.w + numpy.arange(self.N)
+        pa.w -= numpy.max(pa.w)
+        pa.w_offset += 1.0
+        npt.assert_array_almost_equal(self.store.w[3],
+                                      numpy.arange(self.N) - (self.N - 1))
+        self.assertEqual(self.store[3].pa.w_offset, 1.0)
+
+    def check_cache(self, pa, w):
+        wnorm = numpy.exp(w - numpy.max(w))
+        wnorm /= numpy.sum(wnorm)
+        npt.assert_array_almost_equal(pa.get_normalized_weights(), wnorm)
+        npt.assert_array_almost_equal(pa.get_cumulative_weights(), numpy.cumsum(wnorm))
+        self.assertAlmostEqual(pa.calc_Neff(), 1.0 / numpy.sum(wnorm ** 2))
+        self.assertAlmostEqual(pa.get_log_normalizer(),
+                               numpy.log(numpy.sum(numpy.exp(w))))
+
+    def testWeightCache(self):
+        for pa in (ParticleApproximation(self.parts[0]), self.store[3].pa):
+            w = numpy.copy(pa.w)
+            self.check_cache(pa, w)
+            pa.w += numpy.arange(self.N)
+            w += numpy.arange(self.N)
+            self.check_cache(pa, w)
+            # In-place element writes are followed by invalidate_weights
+            pa.w[1] = 2.0
+            w[1] = 2.0
+            pa.invalidate_weights()
+            self.check_cache(pa, w)
+            pa.w[2:4] -= 1.0
+            w[2:4] -= 1.0
+            pa.invalidate_weights()
+            self.check_cache(pa, w)
+            # The same table is returned until the weights change
+            self.assertIs(pa.get_alias_table(), pa.get_alias_table())
+            # The alias table samples according to the new weights
+            pa.w = -numpy.inf * numpy.ones(self.N)
+            pa.w[4] = 0.0
+            pa.invalidate_weights()
+            ind = pa.get_alias_table().sample(20, numpy.random.RandomState(0))
+            npt.assert_array_equal(ind, 4)
+
+        # Writes made directly to the storage arrays
+        pa = self.store[5].pa
+        w = numpy.copy(pa.w)
+        self.check_cache(pa, w)
+        self.store.w[5, 0] += 3.0
+        w[0] += 3.0
+        self.store[5].pa.invalidate_weights()
+        self.check_cache(pa, w)
+        # Appending over the time step discards the cache
+        w = -numpy.arange(self.N, dtype=float)
+        self.store.clear()
+        for t in range(6):
+            self.store.append(TrajectoryStep(ParticleApproximation(self.parts[t], w)))
+        self.assertIs(self.store[5].pa, pa)
+        self.check_cache(pa, w)
+
+    def testSlice(self):
+        view = self.store[:7]
+        self.assertEqual(len(view), 7)
+        npt.assert_array_equal(view[-1].pa.part, self.parts[6])
+        self.assertEqual(len(view[:-1]), 6)
+        npt.assert_array_equal(view[2:][0].pa.part, self.parts[2])
+        self.assertEqual(len(self.store[:0]), 0)
+
+    def testClear(self):
+        w = self.store[0].pa.get_normalized_weights()
+        step = self.store[0]
+        self.store.clear()
+        self.assertEqual(len(self.store), 0)
+        pa = ParticleApproximation(self.parts[1], numpy.arange(self.N))
+        self.store.append(TrajectoryStep(pa))
+        # The arrays and step objects are reused, the cached weights are not
+        self.assertIs(self.store[0], step)
+        npt.assert_array_equal(self.store[0].pa.part, self.parts[1])
+        self.assertFalse(numpy.allclose(self.store[0].pa.get_normalized_weights(), w))
+        npt.assert_array_almost_equal(self.store[0].pa.get_normalized_weights(),
+                                      pa.get_normalized_weights())
+
+    def testNextStep(self):
+        part = self.store.part
+        step = self.store.next_step()
+        self.assertEqual(len(self.store), 10)
+        # Written in place, appending the step doesn't copy anything
+        step.pa.part[:] = self.parts[0]
+        step.pa.w[:] = numpy.arange(self.N)
+        step.pa.invalidate_weights()
+        step.ancestors[:] = numpy.arange(self.N)
+        self.store.append(TrajectoryStep(step.pa, step.ancestors))
+        self.assertEqual(len(self.store), 11)
+        self.assertIs(self.store[10], step)
+        npt.assert_array_equal(self.store.part[10], self.parts[0])
+        npt.assert_array_equal(self.store.w[10], numpy.arange(self.N))
+        npt.assert_array_equal(self.store.ancestors[10], numpy.arange(self.N))
+        npt.assert_array_equal(self.store.part[:10], part)
+        # Not supported when storing the particles with reduced precision
+        store = ArrayTrajectory(T=2, dtype=numpy.float32)
+        store.append(TrajectoryStep(ParticleApproximation(self.parts[0])))
+        self.assertIsNone(store.next_step())
+        self.assertIsNone(ArrayTrajectory().next_step())
+
+    def testCompact(self):
+        store = ArrayTrajectory(T=2, dtype=numpy.float32, index_dtype=numpy.int32)
+        for t in range(5):
+            pa = ParticleApproximation(self.parts[t])
+            store.append(TrajectoryStep(pa, numpy.arange(self.N)[::-1]))
+        self.assertEqual(store.part.dtype, numpy.float32)
+        self.assertEqual(store.ancestors.dtype, numpy.int32)
+        # The latest time step is kept in full precision until the next
+        # one is appended
+        self.assertEqual(store[-1].pa.part.dtype, numpy.float64)
+        store[-1].pa.part += 1.0
+        npt.assert_array_almost_equal(store.part[4], self.parts[4] + 1.0, 6)
+        store.append(TrajectoryStep(ParticleApproximation(self.parts[5])))
+        self.assertEqual(store[4].pa.part.dtype, numpy.float32)
+        npt.assert_array_almost_equal(store[4].pa.part, self.parts[4] + 1.0, 6)
+        npt.assert_array_equal(store[0].ancestors, numpy.arange(self.N)[::-1])
+
+    def testMemmap(self):
+        store = MemmapTrajectory(chunk_size=3, cache_chunks=2)
+        for t in range(10):
+            pa = ParticleApproximation(self.parts[t])
+            store.append(TrajectoryStep(pa, numpy.arange(self.N)[::-1]))
+        self.assertEqual(len(store._part.chunks), 4)
+        npt.assert_array_equal(store.part, numpy.asarray(self.parts))
+        # Traverse backwards reading from the loaded chunks
+        for t in reversed(range(10)):
+            store.readahead(t)
+            self.assertLessEqual(len(store._cache), 2)
+            npt.assert_array_equal(store[t].pa.part, self.parts[t])
+            npt.assert_array_equal(store[t].ancestors,
+                                   numpy.arange(self.N)[::-1])
+        # Writing invalidates the loaded copy of the chunk
+        store[1].pa.w = numpy.arange(self.N, dtype=float)
+        npt.assert_array_equal(store[1].pa.w, numpy.arange(self.N))
+        self.assertRaises(ValueError, store.discard, 2)
+
+    def testMemmapGrowth(self):
+        store = MemmapTrajectory(chunk_size=1, cache_chunks=2)
+        reallocs = 0
+        w_offset = None
+        for t in range(100):
+            pa = ParticleApproximation(self.parts[t % 10])
+            pa.w_offset = float(t)
+            store.append(TrajectoryStep(pa))
+            if (store._w_offset is not w_offset):
+                reallocs += 1
+                w_offset = store._w_offset
+        # The weight offsets are grown geometrically, not once per chunk
+        self.assertLessEqual(reallocs, 8)
+        npt.assert_array_equal(store.w_offset, numpy.arange(100))
+
+    def testMemmapThreads(self):
+        from concurrent.futures import ThreadPoolExecutor
+        store = MemmapTrajectory(chunk_size=2, cache_chunks=2)
+        for t in range(10):
+            store.append(TrajectoryStep(ParticleApproximation(self.parts[t])))
+
+        def traverse(_k):
+            for t in reversed(range(10)):
+                store.readahead(t)
+                npt.assert_array_equal(store[t].pa.part, self.parts[t])
+            return len(store._cache)
+
+        with ThreadPoolExecutor(4) as pool:
+            sizes = list(pool.map(traverse, range(20)))
+        self.assertLessEqual(max(sizes), 2)
+
+    def testConstantN(self):
+        pa = ParticleApproximation(numpy.zeros((self.N + 1, 2)))
+        self.assertRaises(ValueError, self.store.append, TrajectoryStep(pa))
+
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
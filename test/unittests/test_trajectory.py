@@ -0,0 +1,121 @@
+'''
+Created on Oct 16, 2026
+
+@author: ajn
+'''
+import unittest
+import pyparticleest.models.nlg as nlg
+from pyparticleest.filter import ParticleTrajectory, has_measurement
+import numpy
+import numpy.testing as npt
+
+class Model(nlg.NonlinearGaussianInitialGaussian):
+    """ x_{k+1} = sin(x_k) + v_k, v_k ~ N(0,1)
+        y_k = x_k + e_k, e_k ~ N(0,1),
+        x(0) ~ N(0,1) """
+
+    def __init__(self, rng=None):
+        super(Model, self).__init__(x0=numpy.zeros((1, 1)),
+                                    Px0=numpy.eye(1), Q=numpy.eye(1),
+                                    R=numpy.eye(1), rng=rng)
+
+    def calc_f(self, particles, u, t):
+        return numpy.sin(particles)
+
+    def calc_g(self, particles, t):
+        return particles
+
+class Test(unittest.TestCase):
+
+
+    def setUp(self):
+        self.y = numpy.random.RandomState(0).normal(size=50)
+        # Every third measurement is missing
+        self.missing = (numpy.arange(len(self.y)) % 3 == 2)
+
+    def tearDown(self):
+        pass
+
+    def run_filter(self, ytype, missing_value, shape=()):
+        pt = ParticleTrajectory(Model(rng=2), 20, rng=1, utype=float, ytype=ytype)
+        pt.measure(self.y[0].reshape(shape))
+        for t in range(1, len(self.y)):
+            if (self.missing[t]):
+                pt.forward(None, missing_value)
+            else:
+                pt.forward(None, self.y[t].reshape(shape))
+        return pt
+
+    def testHasMeasurement(self):
+        self.assertFalse(has_measurement(None))
+        self.assertFalse(has_measurement(numpy.nan))
+        self.assertFalse(has_measurement(numpy.asarray((numpy.nan, numpy.nan))))
+        self.assertTrue(has_measurement(0.0))
+        self.assertTrue(has_measurement(numpy.asarray((1.0, numpy.nan))))
+        self.assertTrue(has_measurement({'y': 1.0}))
+
+    def testGrowth(self):
+        pt = ParticleTrajectory(Model(), 20, rng=1, utype=float, ytype=float)
+        pt.measure(self.y[0])
+        sizes = [pt.T, ]
+        for t in range(1, len(self.y)):
+            pt.forward(None, self.y[t])
+            self.assertGreaterEqual(pt.T, pt.ind + 1)
+            if (pt.T != sizes[-1]):
+                sizes.append(pt.T)
+        # The buffers are reallocated a logarithmic number of times
+        for (prev, cur) in zip(sizes[:-1], sizes[1:]):
+            self.assertGreaterEqual(cur, 2 * prev)
+        self.assertLessEqual(len(sizes), numpy.log2(len(self.y)) + 2)
+        for buf in (pt.uvec, pt.yvec, pt.tvec, pt.ymask):
+            self.assertEqual(len(buf), pt.T)
+        npt.assert_array_equal(pt.yvec[:len(self.y)], self.y)
+        npt.assert_array_equal(pt.tvec[:len(self.y)], numpy.arange(len(self.y)))
+
+        # Reserving space up front avoids the reallocations
+        pt = ParticleTrajectory(Model(), 20, rng=1, utype=float, ytype=float)
+        pt.reserve(len(self.y))
+        yvec = pt.yvec
+        pt.measure(self.y[0])
+        for t in range(1, len(self.y)):
+            pt.forward(None, self.y[t])
+        self.assertIs(pt.yvec, yvec)
+
+    def testNumericBuffers(self):
+        pt = self.run_filter(float, numpy.nan, shape=(1,))
+        T = len(self.y)
+        # The element shape is taken from the first measurement
+        self.assertEqual(pt.yvec.dtype, numpy.float64)
+        self.assertEqual(pt.yvec.shape, (pt.T, 1))
+        npt.assert_array_equal(pt.yvec[:T][~self.missing, 0], self.y[~self.missing])
+        self.assertTrue(numpy.all(numpy.isnan(pt.yvec[:T][self.missing])))
+        # Missing inputs are stored as NaN
+        self.assertTrue(numpy.all(numpy.isnan(pt.uvec[:T - 1])))
+
+    def testMissing(self):
+        T = len(self.y)
+        pt1 = self.run_filter(numpy.ndarray, None)
+        pt2 = self.run_filter(float, numpy.nan)
+        pt3 = self.run_filter(float, None)
+        for pt in (pt1, pt2, pt3):
+            npt.assert_array_equal(pt.ymask[:T], ~self.missing)
+        # None and NaN are both treated as a missing measurement
+        for pt in (pt2, pt3):
+            self.assertEqual(pt.logp_y, pt1.logp_y)
+            for (s1, s2) in zip(pt1.traj, pt.traj):
+                npt.assert_array_equal(s1.pa.part, s2.pa.part)
+                npt.assert_array_equal(s1.pa.w, s2.pa.w)
+
+        # The weights aren't updated at the steps without measurement
+        for t in numpy.nonzero(self.missing)[0]:
+            if (numpy.all(pt1.traj[t].ancestors == numpy.arange(20))):
+                npt.assert_array_almost_equal(pt1.traj[t].pa.get_normalized_weights(),
+                                              pt1.traj[t - 1].pa.get_normalized_weights())
+
+        pt1.reset()
+        self.assertFalse(numpy.any(pt1.ymask))
+
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
@@ -0,0 +1,107 @@
+'''
+Created on Oct 16, 2026
+
+@author: ajn
+'''
+import unittest
+import pyparticleest.models.nlg as nlg
+import pyparticleest.interfaces as interfaces
+from pyparticleest.simulator import Simulator
+import numpy
+import scipy.stats
+
+class Model(nlg.NonlinearGaussianInitialGaussian, interfaces.TwoFilterSmoothing):
+    """ x_{k+1} = 0.8*x_k + v_k, v_k ~ N(0,1)
+        y_k = x_k + e_k, e_k ~ N(0,1),
+        x(0) ~ N(0,1)
+
+        The artificial prior is N(0, 4) for all time steps """
+
+    def __init__(self):
+        super(Model, self).__init__(x0=numpy.zeros((1, 1)),
+                                    Px0=numpy.eye(1), Q=numpy.eye(1),
+                                    R=numpy.eye(1))
+
+    def calc_f(self, particles, u, t):
+        return 0.8 * particles
+
+    def calc_g(self, particles, t):
+        return particles
+
+    def sample_artificial_prior(self, N, t):
+        return 2.0 * self.rng.normal(size=(N, 1))
+
+    def logp_artificial_prior(self, particles, t):
+        return scipy.stats.norm.logpdf(particles.ravel(), scale=2.0)
+
+class DenseModel(Model):
+    """ Same model, but with Q given per particle so that the densities
+        can't be evaluated using the KD-trees """
+
+    def calc_Q(self, particles, u, t):
+        return numpy.repeat(numpy.eye(1)[numpy.newaxis], len(particles), 0)
+
+def rts_means(y):
+    """ Smoothed means for the model above """
+    T = len(y)
+    (m, P) = (numpy.zeros(T), numpy.zeros(T))
+    (mp, Pp) = (0.0, 1.0)
+    for t in range(T):
+        K = Pp / (Pp + 1.0)
+        m[t] = mp + K * (y[t] - mp)
+        P[t] = (1.0 - K) * Pp
+        (mp, Pp) = (0.8 * m[t], 0.64 * P[t] + 1.0)
+    ms = numpy.copy(m)
+    for t in reversed(range(T - 1)):
+        G = 0.8 * P[t] / (0.64 * P[t] + 1.0)
+        ms[t] = m[t] + G * (ms[t + 1] - 0.8 * m[t])
+    return ms
+
+class Test(unittest.TestCase):
+
+
+    def setUp(self):
+        rs = numpy.random.RandomState(0)
+        self.T = 30
+        x = rs.normal()
+        self.y = numpy.empty(self.T)
+        for t in range(self.T):
+            if (t > 0):
+                x = 0.8 * x + rs.normal()
+            self.y[t] = x + rs.normal()
+        self.ms = rts_means(self.y)
+
+    def tearDown(self):
+        pass
+
+    def testTwoFilter(self):
+        sim = Simulator(Model(), None, self.y, rng=1)
+        sim.simulate(300, 1, smoother='twofilter', meas_first=True)
+        est = sim.get_smoothed_mean().ravel()
+        self.assertLess(numpy.max(numpy.abs(est - self.ms)), 0.3)
+
+    def testDense(self):
+        y = self.y[:10]
+        sim = Simulator(DenseModel(), None, y, rng=1)
+        sim.simulate(100, 1, smoother='twofilter', meas_first=True)
+        est = sim.get_smoothed_mean().ravel()
+        self.assertLess(numpy.max(numpy.abs(est - rts_means(y))), 0.4)
+
+    def testConcurrent(self):
+        sim = Simulator(Model(), None, self.y, rng=1)
+        sim.simulate(300, 1, smoother='twofilter', meas_first=True,
+                     smoother_options={'concurrent': True})
+        est = sim.get_smoothed_mean().ravel()
+        self.assertLess(numpy.max(numpy.abs(est - self.ms)), 0.3)
+
+        sim = Simulator(Model(), None, self.y[1:], rng=1)
+        sim.simulate(300, 1, smoother='twofilter', meas_first=False,
+                     smoother_options={'concurrent': True})
+        est = sim.get_smoothed_mean().ravel()
+        self.assertEqual(len(est), self.T)
+        self.assertLess(numpy.max(numpy.abs(est[1:] - self.ms[1:])), 0.5)
+
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()